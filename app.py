@@ -1,204 +1,729 @@
+import contextlib
+import contextvars
+import functools
+import hashlib
 import json
+import logging
+import math
+import mimetypes
 import os
+import time
 import requests
-from flask import Flask, render_template, request, redirect, url_for, jsonify
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, abort, g, make_response, render_template, request, redirect, send_file, send_from_directory, url_for, jsonify
+from werkzeug.http import http_date, quote_etag
 from dotenv import load_dotenv
+from assets import AssetManifest
+from weather_cache import GridCache, MemoryBackend, SQLiteBackend
+from spatial_index import SpatialIndex
+from geocoding import GeocodeCache, Gazetteer
+from theme_store import ThemeStore
+from ratelimit import TokenBucket
+from refresher import Refresher
+from broadcast import Broadcaster, Subscription
+from cassette import Cassette
+from owm_client import OWMClient, deadline as upstream_deadline
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from scheduler import BACKGROUND, QuotaExceededError, UpstreamScheduler, priority as upstream_priority
+from metrics import Registry
+from request_log import BackgroundHandler, JSONFormatter, RequestLog
 
 app = Flask(__name__)
 load_dotenv() # Load .env file here
 
 app.config.setdefault('THEME_CONFIG_FILE', 'theme_config.json')
+app.config.setdefault('ASSET_MAX_AGE', 365 * 24 * 3600) # Seconds; asset URLs change with their content
+app.config.setdefault('ASSET_PRECOMPRESS', True) # Serve gzip/brotli variants of static assets, built on warm-up or first use
+app.config.setdefault('ASSET_BUILD_DIR', os.path.join(app.root_path, 'build', 'assets')) # Where the variants go
+app.config.setdefault('OPENWEATHER_API_URL', os.getenv('OPENWEATHER_API_URL', 'https://api.openweathermap.org'))
+app.config.setdefault('UPSTREAM_POOL_SIZE', 10) # Keep-alive connections per worker process
+app.config.setdefault('UPSTREAM_MAX_RETRIES', 2)
+app.config.setdefault('UPSTREAM_BACKOFF', 0.1) # Seconds, doubled on each retry
+app.config.setdefault('UPSTREAM_DEADLINE', 10) # Seconds of upstream time per request, retries included
+app.config.setdefault('UPSTREAM_BREAKER_THRESHOLD', 5) # Consecutive failed calls that open the circuit
+app.config.setdefault('UPSTREAM_BREAKER_RESET', 30) # Seconds the circuit stays open before a probe call
+app.config.setdefault('UPSTREAM_CALLS_PER_MINUTE', 600) # This worker's share of the API quota, background refreshes included
+app.config.setdefault('UPSTREAM_QUEUE_MAX', 1000) # Calls waiting for quota before further ones are rejected
+app.config.setdefault('UPSTREAM_QUEUE_TIMEOUT', 2) # Seconds a user's call waits for quota before falling back to cache
+# 'record' saves every upstream response to UPSTREAM_CASSETTE; 'replay' answers from it without any network.
+app.config.setdefault('UPSTREAM_MODE', os.getenv('UPSTREAM_MODE', 'live'))
+app.config.setdefault('UPSTREAM_CASSETTE', os.getenv('UPSTREAM_CASSETTE', 'upstream_cassette.jsonl'))
+app.config.setdefault('UPSTREAM_REPLAY_TIME_SCALE', float(os.getenv('UPSTREAM_REPLAY_TIME_SCALE', 1.0))) # x recorded latency; 0 is instant
+app.config.setdefault('UPSTREAM_REPLAY_STRICT', False) # Fail unrecorded requests instead of reusing the endpoint's responses
+app.config.setdefault('ASYNC_UPSTREAM_MAX_CONNECTIONS', 1000) # In-flight upstream calls in async mode (asgi.py)
+app.config.setdefault('ASGI_WSGI_THREADS', 32) # Threads serving the requests asgi.py hands to Flask
+app.config.setdefault('BATCH_MAX_POINTS', 500)
+app.config.setdefault('BATCH_MAX_CONCURRENCY', 16) # Upstream calls in flight per batch request
+app.config.setdefault('GEOCODE_CACHE_FILE', 'geocode_cache.json')
+app.config.setdefault('GAZETTEER_FILE', os.getenv('GAZETTEER_FILE', os.path.join(app.root_path, 'data', 'cities.tsv'))) # Cities resolved in-process
+app.config.setdefault('WEATHER_CACHE_GRID', 0.01) # Degrees; ~1.1 km of latitude
+app.config.setdefault('WEATHER_CACHE_TTL', 60) # Seconds
+app.config.setdefault('WEATHER_CACHE_MAX_ENTRIES', 10000)
+app.config.setdefault('WEATHER_CACHE_STALE_TTL', 240) # Seconds past the TTL a value may be served while it is refreshed
+app.config.setdefault('WEATHER_NEARBY_RADIUS_KM', 1.0) # A miss is answered from a fresh observation this close; 0 disables
+# 'memory' keeps a cache per worker process; 'sqlite' shares one file between all workers on the host.
+app.config.setdefault('WEATHER_CACHE_BACKEND', os.getenv('WEATHER_CACHE_BACKEND', 'memory'))
+app.config.setdefault('WEATHER_CACHE_PATH', os.getenv('WEATHER_CACHE_PATH', 'weather_cache.sqlite3'))
+app.config.setdefault('WEATHER_REFRESH_ENABLED', True) # Background refresh of hot locations (off when TESTING)
+app.config.setdefault('WEATHER_REFRESH_PER_MINUTE', 30) # Upstream calls the refresher may spend
+app.config.setdefault('WEATHER_STREAM_INTERVAL', 1.0) # Seconds between checks of streamed cells for new values
+app.config.setdefault('WEATHER_STREAM_KEEPALIVE', 15) # Seconds of silence before a comment keeps a stream open
+app.config.setdefault('WEATHER_STREAM_WAIT', 15) # Seconds a stream served by Flask holds its thread waiting for an update
+# Have the page subscribe to /weather/stream. Meant for asgi.py, where an open stream holds no thread.
+app.config.setdefault('WEATHER_STREAM_LIVE', os.getenv('WEATHER_STREAM_LIVE') == '1')
+app.config.setdefault('LOG_FILE', os.getenv('LOG_FILE')) # JSON-lines request/upstream log; stderr if unset
+app.config.setdefault('LOG_SAMPLE_RATE', float(os.getenv('LOG_SAMPLE_RATE', 0.1))) # Share of requests logged in full
+app.config.setdefault('LOG_SLOW_MS', 1000) # Requests and upstream calls this slow are always logged, as are failures
+app.config.setdefault('LOG_QUEUE_MAX', 10000) # Log records waiting to be written before further ones are dropped
+
+if app.config['WEATHER_CACHE_BACKEND'] == 'sqlite':
+    weather_cache_backend = SQLiteBackend(
+        app.config['WEATHER_CACHE_PATH'],
+        max_entries=app.config['WEATHER_CACHE_MAX_ENTRIES'],
+        max_age=app.config['WEATHER_CACHE_TTL'] + app.config['WEATHER_CACHE_STALE_TTL'],
+    )
+elif app.config['WEATHER_CACHE_BACKEND'] == 'memory':
+    weather_cache_backend = MemoryBackend(app.config['WEATHER_CACHE_MAX_ENTRIES'])
+else:
+    raise ValueError(f"Unknown WEATHER_CACHE_BACKEND {app.config['WEATHER_CACHE_BACKEND']!r}; use 'memory' or 'sqlite'.")
+weather_cache = GridCache(
+    grid=app.config['WEATHER_CACHE_GRID'],
+    ttl=app.config['WEATHER_CACHE_TTL'],
+    stale_ttl=app.config['WEATHER_CACHE_STALE_TTL'],
+    backend=weather_cache_backend,
+    nearby=SpatialIndex(
+        app.config['WEATHER_NEARBY_RADIUS_KM'],
+        max_age=app.config['WEATHER_CACHE_TTL'],
+        max_entries=app.config['WEATHER_CACHE_MAX_ENTRIES'],
+    ) if app.config['WEATHER_NEARBY_RADIUS_KM'] > 0 else None,
+)
+# Shared by the sync and async clients: both talk to the same upstream.
+upstream_breaker = CircuitBreaker(
+    failure_threshold=app.config['UPSTREAM_BREAKER_THRESHOLD'],
+    reset_timeout=app.config['UPSTREAM_BREAKER_RESET'],
+)
+upstream_scheduler = UpstreamScheduler(
+    # Bursts of up to ten seconds' worth of the per-minute quota
+    TokenBucket(app.config['UPSTREAM_CALLS_PER_MINUTE'] / 60, max(1, app.config['UPSTREAM_CALLS_PER_MINUTE'] / 6)),
+    max_queue=app.config['UPSTREAM_QUEUE_MAX'],
+    max_wait=app.config['UPSTREAM_QUEUE_TIMEOUT'],
+)
+if app.config['UPSTREAM_MODE'] == 'live':
+    upstream_cassette = None
+elif app.config['UPSTREAM_MODE'] in (Cassette.RECORD, Cassette.REPLAY):
+    upstream_cassette = Cassette(
+        app.config['UPSTREAM_CASSETTE'],
+        app.config['UPSTREAM_MODE'],
+        time_scale=app.config['UPSTREAM_REPLAY_TIME_SCALE'],
+        strict=app.config['UPSTREAM_REPLAY_STRICT'],
+    )
+else:
+    raise ValueError(f"Unknown UPSTREAM_MODE {app.config['UPSTREAM_MODE']!r}; use 'live', 'record' or 'replay'.")
+upstream = OWMClient(
+    pool_maxsize=app.config['UPSTREAM_POOL_SIZE'],
+    max_retries=app.config['UPSTREAM_MAX_RETRIES'],
+    backoff_factor=app.config['UPSTREAM_BACKOFF'],
+    breaker=upstream_breaker,
+    scheduler=upstream_scheduler,
+    cassette=upstream_cassette,
+)
+geocode_cache = GeocodeCache()
+geocode_cache.load(app.config['GEOCODE_CACHE_FILE'])
+gazetteer = Gazetteer(app.config['GAZETTEER_FILE'])
+
+# Written by a background thread; see request_log.py.
+event_logger = logging.getLogger('weather.events')
+event_logger.setLevel(logging.INFO)
+event_logger.propagate = False
+log_output = logging.FileHandler(app.config['LOG_FILE'], delay=True) if app.config['LOG_FILE'] else logging.StreamHandler()
+log_output.setFormatter(JSONFormatter())
+log_handler = BackgroundHandler(log_output, max_queue=app.config['LOG_QUEUE_MAX'])
+event_logger.addHandler(log_handler)
+request_log = RequestLog(event_logger, sample_rate=app.config['LOG_SAMPLE_RATE'], slow_ms=app.config['LOG_SLOW_MS'])
+
+def note_cache_outcome(key, outcome):
+    request_log.annotate(cache=outcome)
+
+weather_cache.on_lookup = note_cache_outcome
+
+metrics_registry = Registry()
+REQUEST_LATENCY = metrics_registry.histogram(
+    'http_request_duration_seconds', 'HTTP request latency by route.', ('route', 'method', 'status'))
+REQUESTS_IN_FLIGHT = metrics_registry.gauge(
+    'http_requests_in_flight', 'HTTP requests currently being served.', ('route',))
+STAGE_LATENCY = metrics_registry.histogram(
+    'weather_stage_duration_seconds', 'Latency of hot-path stages (geocoding, weather, render, theme_read).', ('stage',))
+UPSTREAM_IN_FLIGHT = metrics_registry.gauge(
+    'upstream_requests_in_flight', 'OpenWeatherMap calls currently in progress.', ('api',))
+UPSTREAM_ERRORS_TOTAL = metrics_registry.counter(
+    'upstream_errors_total', 'Failed OpenWeatherMap calls by API and error category.', ('api', 'category'))
+for stat in ('entries', 'hits', 'misses', 'evictions', 'coalesced', 'stale_hits', 'refreshes', 'nearby_hits'):
+    metrics_registry.callback(
+        f'weather_cache_{stat}' if stat == 'entries' else f'weather_cache_{stat}_total',
+        f'Weather grid cache {stat.replace("_", " ")}.',
+        'gauge' if stat == 'entries' else 'counter',
+        functools.partial(lambda stat: weather_cache.stats()[stat], stat),
+    )
+metrics_registry.callback(
+    'upstream_circuit_open', 'Whether upstream calls are being failed fast (1) or not (0).', 'gauge',
+    lambda: upstream_breaker.state != CircuitBreaker.CLOSED,
+)
+metrics_registry.callback(
+    'upstream_queue_depth', 'Upstream calls waiting for API quota.', 'gauge', lambda: upstream_scheduler.queued())
+for stat, help in (('coalesced', 'Upstream calls that shared an identical pending call.'),
+                   ('rejected', 'Upstream calls refused for lack of API quota.'),
+                   ('throttled', 'Upstream 429 responses.')):
+    metrics_registry.callback(
+        f'upstream_{stat}_total', help, 'counter', functools.partial(getattr, upstream_scheduler, stat))
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.request_log = request_log.begin(request.headers.get('X-Request-ID'), method=request.method,
+                                      path=request.path, endpoint=request.endpoint)
+    REQUESTS_IN_FLIGHT.inc(request.endpoint or 'unmatched')
+
+@app.after_request
+def observe_request_latency(response):
+    REQUEST_LATENCY.observe(time.perf_counter() - g.request_started,
+                            request.endpoint or 'unmatched', request.method, str(response.status_code))
+    g.response_status = response.status_code
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    if 'request_started' in g:
+        REQUESTS_IN_FLIGHT.dec(request.endpoint or 'unmatched')
+    if 'request_log' in g:
+        request_log.end(g.pop('request_log'), g.get('response_status', 500), type(exc).__name__ if exc else None)
+
+theme_store = ThemeStore()
+asset_manifest = AssetManifest(
+    app.static_folder, build_dir=app.config['ASSET_BUILD_DIR'] if app.config['ASSET_PRECOMPRESS'] else None)
+rendered_pages = {} # (message, theme, script root) -> (html, etag) of index pages without weather data
 
 def get_current_theme():
     try:
-        with open(app.config['THEME_CONFIG_FILE'], 'r') as f:
-            config = json.load(f)
-            return config.get('theme', 'light')
+        with STAGE_LATENCY.time('theme_read'):
+            return theme_store.get(app.config['THEME_CONFIG_FILE'])
     except (FileNotFoundError, json.JSONDecodeError):
         # If file not found or JSON is invalid, default to 'light' and recreate the file.
-        # Need to ensure app context for set_current_theme if called from here,
-        # or pass app explicitly. For simplicity, we assume app context is available.
         set_current_theme('light')
         return 'light'
 
 def set_current_theme(theme_name):
-    with open(app.config['THEME_CONFIG_FILE'], 'w') as f:
-        json.dump({'theme': theme_name}, f)
+    theme_store.set(app.config['THEME_CONFIG_FILE'], theme_name)
 
-def get_weather_for_lodz(api_key):
-    city_name = "Lodz"
-    country_code = "PL"
-    # Initialize weather_data with all expected keys to avoid KeyErrors in template
-    weather_data = {"temperature": None, "error": None, "emoji": None}
+def with_upstream_deadline(func):
+    # All upstream calls made by func, retries included, share one UPSTREAM_DEADLINE budget.
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with upstream_deadline(app.config['UPSTREAM_DEADLINE']):
+            return func(*args, **kwargs)
+    return wrapper
+
+# Everything an upstream call can raise: transport/HTTP errors and JSON decoding errors.
+UPSTREAM_ERRORS = (requests.exceptions.RequestException, ValueError)
 
-    # Step 1: Geocoding
-    geo_url = "http://api.openweathermap.org/geo/1.0/direct"
+def upstream_error_category(e):
+    # Label for UPSTREAM_ERRORS_TOTAL; mirrors the cases of upstream_error_message.
+    if isinstance(e, CircuitOpenError):
+        return "circuit_open"
+    if isinstance(e, QuotaExceededError):
+        return "quota"
+    if isinstance(e, requests.exceptions.Timeout):
+        return "timeout"
+    if isinstance(e, requests.exceptions.HTTPError):
+        return "http_error"
+    if isinstance(e, requests.exceptions.RequestException):
+        return "request_error"
+    return "json_parse"
+
+@contextlib.contextmanager
+def upstream_call(api):
+    # Measures one upstream call for metrics and the request log. The block
+    # puts the response in call["response"] so its status can be logged.
+    call = {}
+    error = None
+    started = time.perf_counter()
+    try:
+        with STAGE_LATENCY.time(api), UPSTREAM_IN_FLIGHT.track_in_progress(api):
+            yield call
+    except BaseException as e:
+        error = upstream_error_category(e) if isinstance(e, UPSTREAM_ERRORS) else type(e).__name__
+        raise
+    finally:
+        status = call["response"].status_code if "response" in call else None
+        if error is None and status is not None and status >= 400:
+            error = "http_error"
+        request_log.upstream_call(api, (time.perf_counter() - started) * 1000, status, error)
+
+def upstream_error_message(api_name, e):
+    # Every failed upstream call is reported through here, so this is where it is counted.
+    UPSTREAM_ERRORS_TOTAL.inc(api_name.lower(), upstream_error_category(e))
+    if isinstance(e, requests.exceptions.Timeout):
+        return f"{api_name} API request timed out."
+    if isinstance(e, requests.exceptions.HTTPError):
+        return f"{api_name} API request failed with HTTP status: {e.response.status_code}"
+    if isinstance(e, requests.exceptions.RequestException):
+        return f"{api_name} API request failed: {e}"
+    return f"Error parsing {api_name} JSON response: {e}" # ValueError from JSON decoding
+
+def geocoding_request(query, api_key):
+    geo_url = app.config['OPENWEATHER_API_URL'] + "/geo/1.0/direct"
     geo_params = {
-        "q": f"{city_name},{country_code}",
+        "q": query,
         "limit": 1,
         "appid": api_key
     }
-    try:
-        response = requests.get(geo_url, params=geo_params, timeout=10)
-        response.raise_for_status() # Raise an exception for HTTP errors (4xx or 5xx)
-        geo_data = response.json()
-        if not geo_data: # Check if the list is empty
-            weather_data["error"] = "City (Lodz) not found by Geocoding API."
-            return weather_data
-
-        # Ensure geo_data[0] exists and has lat/lon
-        if isinstance(geo_data, list) and len(geo_data) > 0:
-            lat = geo_data[0].get("lat")
-            lon = geo_data[0].get("lon")
-        else:
-            lat, lon = None, None
-
-        if lat is None or lon is None:
-            weather_data["error"] = "Latitude or Longitude not found in Geocoding response."
-            return weather_data
-
-    except requests.exceptions.Timeout:
-        weather_data["error"] = "Geocoding API request timed out."
-        return weather_data
-    except requests.exceptions.HTTPError as e:
-        weather_data["error"] = f"Geocoding API request failed with HTTP status: {e.response.status_code}"
-        return weather_data
-    except requests.exceptions.RequestException as e: # Catch other request-related errors
-        weather_data["error"] = f"Geocoding API request failed: {e}"
-        return weather_data
-    except ValueError as e: # Handles JSON decoding errors
-        weather_data["error"] = f"Error parsing Geocoding JSON response: {e}"
-        return weather_data
-
-    # Step 2: Weather Data
-    weather_url = "https://api.openweathermap.org/data/2.5/weather"
+    return geo_url, geo_params
+
+def parse_geocoding_response(response, city_name):
+    # Returns ((lat, lon), None) on success or (None, error message).
+    response.raise_for_status() # Raise an exception for HTTP errors (4xx or 5xx)
+    geo_data = response.json()
+    if not geo_data: # Check if the list is empty
+        return None, f"City ({city_name}) not found by Geocoding API."
+
+    # Ensure geo_data[0] exists and has lat/lon
+    if isinstance(geo_data, list) and len(geo_data) > 0:
+        lat = geo_data[0].get("lat")
+        lon = geo_data[0].get("lon")
+    else:
+        lat, lon = None, None
+
+    if lat is None or lon is None:
+        return None, "Latitude or Longitude not found in Geocoding response."
+    return (lat, lon), None
+
+def weather_request(lat, lon, api_key):
+    weather_url = app.config['OPENWEATHER_API_URL'] + "/data/2.5/weather"
     weather_params = {
         "lat": lat,
         "lon": lon,
         "appid": api_key,
         "units": "metric"
     }
+    return weather_url, weather_params
+
+def parse_weather_response(response):
+    weather_data = {"temperature": None, "error": None, "emoji": None}
+    response.raise_for_status() # Raise an exception for HTTP errors
+    current_weather = response.json()
+    temp = current_weather.get("main", {}).get("temp")
+
+    if temp is not None:
+        weather_data["temperature"] = float(temp) # Ensure temp is float
+        if weather_data["temperature"] > 20:
+            weather_data["emoji"] = ":)"
+        elif weather_data["temperature"] < 20:
+            weather_data["emoji"] = ":("
+        # If temp == 20, emoji remains None as per user spec
+    else:
+        weather_data["error"] = "Temperature data (main.temp) not found in weather API response."
+    return weather_data
+
+def city_query(city_name, country_code=None):
+    return f"{city_name},{country_code}" if country_code else city_name
+
+def local_city_coords(city_name, country_code=None):
+    # Resolves a city without a network call: the gazetteer first, then earlier Geocoding API results.
+    coords = gazetteer.lookup(city_name, country_code)
+    if coords is None:
+        coords = geocode_cache.get(city_query(city_name, country_code))
+    return coords
+
+def resolve_city(city_name, country_code, api_key):
+    # Returns ((lat, lon), None) or (None, error message). Cities never move, so a
+    # remote result is persisted and each city is geocoded remotely at most once.
+    coords = local_city_coords(city_name, country_code)
+    if coords is not None:
+        return coords, None
+    query = city_query(city_name, country_code)
+    geo_url, geo_params = geocoding_request(query, api_key)
     try:
-        response = requests.get(weather_url, params=weather_params, timeout=10)
-        response.raise_for_status() # Raise an exception for HTTP errors
-        current_weather = response.json()
-
-        temp = current_weather.get("main", {}).get("temp")
-
-        if temp is not None:
-            weather_data["temperature"] = float(temp) # Ensure temp is float
-            if weather_data["temperature"] > 20:
-                weather_data["emoji"] = ":)"
-            elif weather_data["temperature"] < 20:
-                weather_data["emoji"] = ":("
-            # If temp == 20, emoji remains None as per user spec
-        else:
-            weather_data["error"] = "Temperature data (main.temp) not found in weather API response."
-
-    except requests.exceptions.Timeout:
-        weather_data["error"] = "Weather API request timed out."
-    except requests.exceptions.HTTPError as e:
-        weather_data["error"] = f"Weather API request failed with HTTP status: {e.response.status_code}"
-    except requests.exceptions.RequestException as e:
-        weather_data["error"] = f"Weather API request failed: {e}"
-    except ValueError as e: # Handles JSON decoding errors
-        weather_data["error"] = f"Error parsing Weather JSON response: {e}"
+        with upstream_call('geocoding') as call:
+            response = call["response"] = upstream.get(geo_url, params=geo_params, timeout=10)
+        coords, error = parse_geocoding_response(response, city_name)
+    except UPSTREAM_ERRORS as e:
+        error = upstream_error_message("Geocoding", e)
+    if error:
+        return None, error
+    return geocode_cache.set(query, *coords), None
+
+@with_upstream_deadline
+def get_weather_for_city(city_name, country_code, api_key):
+    coords, error = resolve_city(city_name, country_code, api_key)
+    if error:
+        # Initialize weather_data with all expected keys to avoid KeyErrors in template
+        return {"temperature": None, "error": error, "emoji": None}
+    return get_weather_by_coords(*coords, api_key)
 
+@with_upstream_deadline
+def get_weather_for_lodz(api_key):
+    weather_data = get_weather_for_city("Lodz", "PL", api_key)
+    pin_lodz()
     return weather_data
 
+def describe_lodz_weather(weather_info):
+    # Returns the index page message for a Lodz weather lookup.
+    if weather_info.get("error"):
+        return "Failed to fetch weather."
+    if weather_info.get("temperature") is not None:
+        if weather_info.get("stale"):
+            return "Weather in Lodz, Poland (last known, service unavailable):"
+        return "Weather in Lodz, Poland:"
+    message = "Weather data not available or an unknown error occurred."
+    weather_info["error"] = message
+    return message
+
+DEFAULT_MESSAGE = "Please click a button."
+
 @app.route('/', methods=['GET', 'POST'])
 def index():
     api_key = os.getenv("OPENWEATHER_API_KEY")
     current_theme = get_current_theme()
-    message = "Please click a button."
+    message = DEFAULT_MESSAGE
     weather_info = {"temperature": None, "error": None, "emoji": None} # Ensure this is always defined
 
     if request.method == 'POST':
         if 'button1' in request.form:
             if api_key:
                 weather_info = get_weather_for_lodz(api_key)
-                if weather_info.get("error"):
-                    message = "Failed to fetch weather."
-                elif weather_info.get("temperature") is not None:
-                    message = "Weather in Lodz, Poland:"
-                else:
-                    message = "Weather data not available or an unknown error occurred."
-                    if not weather_info.get("error"):
-                        weather_info["error"] = message
+                message = describe_lodz_weather(weather_info)
             else:
                 message = "API Key for weather service is not configured."
                 weather_info["error"] = message
         elif 'button2' in request.form:
             message = "Button 2 was clicked!"
 
-    return render_template('index.html', message=message, current_theme=current_theme, weather_info=weather_info)
+    if weather_info["temperature"] is None and weather_info["error"] is None:
+        html, etag = cached_index(message, current_theme)
+    else:
+        html = render_index(message, current_theme, weather_info)
+        etag = None
+    response = make_response(html)
+    if request.method == 'POST':
+        response.cache_control.no_store = True
+        return response
+    # The page only changes with the theme, which may be toggled at any time:
+    # clients revalidate every view and get a 304 while it is unchanged.
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+def render_index(message, current_theme, weather_info):
+    with STAGE_LATENCY.time('render'):
+        return render_template('index.html', message=message, current_theme=current_theme, weather_info=weather_info)
+
+def cached_index(message, current_theme):
+    # Without weather data the page depends only on the message and theme, so
+    # each variant is rendered and hashed once (every time in debug mode).
+    key = (message, current_theme, request.script_root)
+    page = rendered_pages.get(key)
+    if page is None or app.debug:
+        html = render_index(message, current_theme, {"temperature": None, "error": None, "emoji": None})
+        page = rendered_pages[key] = (html, hashlib.sha1(html.encode()).hexdigest())
+    return page
+
+@app.template_global()
+def asset_url(path):
+    if app.debug:
+        asset_manifest.reload()
+    return url_for('asset', filename=asset_manifest.hashed_name(path))
+
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    path = asset_manifest.resolve(filename)
+    if path is None:
+        abort(404)
+    # A hashed name always refers to the same bytes, so caches never need to revalidate it.
+    # Files go out through send_file, which uses the server's sendfile support when it has one.
+    for encoding, variant_path in asset_manifest.variants(filename):
+        if request.accept_encodings[encoding]:
+            response = send_file(variant_path, mimetype=mimetypes.guess_type(path)[0], max_age=app.config['ASSET_MAX_AGE'])
+            response.content_encoding = encoding
+            break
+    else:
+        response = send_from_directory(app.static_folder, path, max_age=app.config['ASSET_MAX_AGE'])
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
 
 @app.route('/toggle-theme', methods=['POST'])
 def toggle_theme():
-    current_theme = get_current_theme()
-    new_theme = 'dark' if current_theme == 'light' else 'light'
-    set_current_theme(new_theme)
+    # Read-modify-write under the store's lock so concurrent toggles do not interleave.
+    theme_store.update(app.config['THEME_CONFIG_FILE'], lambda current_theme: 'dark' if current_theme == 'light' else 'light')
     return redirect(url_for('index'))
 
+@with_upstream_deadline
 def get_weather_by_coords(lat, lon, api_key):
-    weather_data = {"temperature": None, "error": None, "emoji": None}
-    weather_url = "https://api.openweathermap.org/data/2.5/weather"
-    weather_params = {
-        "lat": lat,
-        "lon": lon,
-        "appid": api_key,
-        "units": "metric"
-    }
-    try:
-        response = requests.get(weather_url, params=weather_params, timeout=10)
-        response.raise_for_status()
-        current_weather = response.json()
-        temp = current_weather.get("main", {}).get("temp")
-
-        if temp is not None:
-            weather_data["temperature"] = float(temp)
-            if weather_data["temperature"] > 20:
-                weather_data["emoji"] = ":)"
-            elif weather_data["temperature"] < 20:
-                weather_data["emoji"] = ":("
-        else:
-            weather_data["error"] = "Temperature data (main.temp) not found in weather API response."
-
-    except requests.exceptions.Timeout:
-        weather_data["error"] = "Weather API request timed out."
-    except requests.exceptions.HTTPError as e:
-        weather_data["error"] = f"Weather API request failed with HTTP status: {e.response.status_code}"
-    except requests.exceptions.RequestException as e:
-        weather_data["error"] = f"Weather API request failed: {e}"
-    except ValueError as e: # Handles JSON decoding errors
-        weather_data["error"] = f"Error parsing Weather JSON response: {e}"
+    # Users in the same grid cell share one upstream result for WEATHER_CACHE_TTL seconds,
+    # and a user with no result in their cell borrows one within WEATHER_NEARBY_RADIUS_KM.
+    # Failed lookups are not cached so the next request retries upstream.
+    track_weather_request(lat, lon)
+    return weather_cache.get_or_fetch(
+        lat, lon,
+        lambda cell_lat, cell_lon: fetch_weather_by_coords(cell_lat, cell_lon, api_key),
+        cacheable=is_cacheable_weather,
+    )
+
+def is_cacheable_weather(weather_data):
+    return weather_data["error"] is None and not weather_data.get("stale")
 
+def weather_cache_headers(lat, lon, weather_data):
+    # Lets browsers and edge caches reuse a result for as long as the grid cache would.
+    headers = {'ETag': quote_etag(hashlib.sha1(json.dumps(weather_data, sort_keys=True).encode()).hexdigest())}
+    age = weather_cache.age(weather_cache.cell(lat, lon)) if is_cacheable_weather(weather_data) else None
+    if weather_data["error"] is not None:
+        headers['Cache-Control'] = 'no-store'
+    elif age is None:
+        headers['Cache-Control'] = 'no-cache' # Last known value while upstream is down, or a nearby cell's
+    else:
+        remaining = app.config['WEATHER_CACHE_TTL'] - age
+        max_age = max(0, int(remaining))
+        stale_while_revalidate = max(0, int(remaining + app.config['WEATHER_CACHE_STALE_TTL']) - max_age)
+        headers['Cache-Control'] = f"public, max-age={max_age}, stale-while-revalidate={stale_while_revalidate}"
+        headers['Last-Modified'] = http_date(time.time() - age)
+    return headers
+
+def last_known_weather(lat, lon):
+    # While upstream cannot be called, the last cached observation of any age beats an error.
+    weather_data = weather_cache.peek(lat, lon)
+    if weather_data is not None:
+        weather_data["stale"] = True
     return weather_data
 
-@app.route('/weather_by_coords', methods=['POST'])
-def weather_by_coords_route():
+def refresh_weather(lat, lon):
     api_key = os.getenv("OPENWEATHER_API_KEY")
     if not api_key:
-        return jsonify({"error": "API Key for weather service is not configured."}), 500
+        return {"temperature": None, "error": "API Key for weather service is not configured.", "emoji": None}
+    with upstream_deadline(app.config['UPSTREAM_DEADLINE']), upstream_priority(BACKGROUND):
+        return fetch_weather_by_coords(lat, lon, api_key)
+
+refresher = Refresher(
+    weather_cache,
+    refresh_weather,
+    # Bursts of up to ten seconds' worth of the per-minute budget
+    budget=TokenBucket(app.config['WEATHER_REFRESH_PER_MINUTE'] / 60, max(1, app.config['WEATHER_REFRESH_PER_MINUTE'] / 6)),
+    cacheable=is_cacheable_weather,
+)
+weather_cache.on_stale = refresher.request_refresh
+# Streamed cells are kept warm by the refresher for as long as anyone is subscribed.
+weather_broadcaster = Broadcaster(
+    weather_cache,
+    interval=app.config['WEATHER_STREAM_INTERVAL'],
+    on_first=refresher.watch,
+    on_last=refresher.unwatch,
+)
+weather_cache.on_store = weather_broadcaster.notify
+
+def pin_lodz():
+    # Lodz is always kept warm. Resolving it loads the gazetteer, so this waits
+    # for warm_up() or the refresher's start rather than running at import.
+    coords = local_city_coords("Lodz", "PL")
+    if coords is not None:
+        refresher.pin(*coords)
+
+def track_weather_request(lat, lon):
+    # Feeds the refresher's popularity counts and starts it in this process on first use.
+    refresher.track(lat, lon)
+    if app.config['WEATHER_REFRESH_ENABLED'] and not app.testing and not refresher.running:
+        pin_lodz()
+        refresher.ensure_started()
 
-    data = request.get_json()
+def fetch_weather_by_coords(lat, lon, api_key):
+    weather_url, weather_params = weather_request(lat, lon, api_key)
+    try:
+        with upstream_call('weather') as call:
+            response = call["response"] = upstream.get(weather_url, params=weather_params, timeout=10)
+        return parse_weather_response(response)
+    except (CircuitOpenError, QuotaExceededError) as e:
+        return last_known_weather(lat, lon) or {"temperature": None, "error": upstream_error_message("Weather", e), "emoji": None}
+    except UPSTREAM_ERRORS as e:
+        return {"temperature": None, "error": upstream_error_message("Weather", e), "emoji": None}
+
+def parse_coords(data):
+    # Returns ((lat, lon), None) for a valid JSON payload or (None, error message).
     if not data:
-        return jsonify({"error": "Invalid request: No JSON payload."}), 400
+        return None, "Invalid request: No JSON payload."
 
     lat = data.get('lat')
     lon = data.get('lon')
 
     if lat is None or lon is None:
-        return jsonify({"error": "Missing latitude or longitude in request."}), 400
+        return None, "Missing latitude or longitude in request."
 
     try:
         lat = float(lat)
         lon = float(lon)
-    except ValueError:
-        return jsonify({"error": "Latitude and longitude must be valid numbers."}), 400
+    except (TypeError, ValueError):
+        return None, "Latitude and longitude must be valid numbers."
+    # float() also accepts "nan", "inf" and 1e308, which no grid cell can hold.
+    if not (math.isfinite(lat) and math.isfinite(lon)) or abs(lat) > 90 or abs(lon) > 180:
+        return None, "Latitude must be within ±90 and longitude within ±180."
+    return (lat, lon), None
+
+@app.route('/weather_by_coords', methods=['GET', 'POST'])
+def weather_by_coords_route():
+    api_key = os.getenv("OPENWEATHER_API_KEY")
+    if not api_key:
+        return jsonify({"error": "API Key for weather service is not configured."}), 500
+
+    # GET ?lat=..&lon=.. is the cacheable form; POST takes the same fields as JSON.
+    coords, error = parse_coords(request.args if request.method == 'GET' else request.get_json())
+    if error:
+        return jsonify({"error": error}), 400
+
+    lat, lon = coords
+    weather_result = get_weather_by_coords(lat, lon, api_key)
+    response = jsonify(weather_result)
+    response.headers.update(weather_cache_headers(lat, lon, weather_result))
+    return response.make_conditional(request)
+
+@app.route('/weather/stream', methods=['GET'])
+def weather_stream_route():
+    # Server-Sent Events: the current weather, then a push each time the cached
+    # observation for the cell changes. All subscribers of a cell share one refresh.
+    api_key = os.getenv("OPENWEATHER_API_KEY")
+    if not api_key:
+        return jsonify({"error": "API Key for weather service is not configured."}), 500
+
+    coords, error = parse_coords(request.args)
+    if error:
+        return jsonify({"error": error}), 400
 
+    lat, lon = coords
     weather_result = get_weather_by_coords(lat, lon, api_key)
-    return jsonify(weather_result)
+    return Response(weather_events(lat, lon, weather_result), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/weather_by_city', methods=['GET'])
+def weather_by_city_route():
+    api_key = os.getenv("OPENWEATHER_API_KEY")
+    if not api_key:
+        return jsonify({"error": "API Key for weather service is not configured."}), 500
+
+    city_name = request.args.get('name', '').strip()
+    if not city_name:
+        return jsonify({"error": "Missing city name in request."}), 400
+    country_code = request.args.get('country', '').strip() or None
+
+    with upstream_deadline(app.config['UPSTREAM_DEADLINE']):
+        coords, error = resolve_city(city_name, country_code, api_key)
+    if error:
+        return jsonify({"temperature": None, "error": error, "emoji": None}), 200, {'Cache-Control': 'no-store'}
+    lat, lon = coords
+    weather_result = get_weather_by_coords(lat, lon, api_key)
+    response = jsonify(weather_result)
+    response.headers.update(weather_cache_headers(lat, lon, weather_result))
+    return response.make_conditional(request)
+
+@app.route('/cities', methods=['GET'])
+def cities_route():
+    # Autocomplete over the gazetteer: ?q=<prefix>[&country=PL]. Never calls upstream.
+    prefix = request.args.get('q', '')
+    country_code = request.args.get('country', '').strip() or None
+    response = jsonify({"cities": gazetteer.search(prefix, country_code)})
+    response.headers['Cache-Control'] = 'public, max-age=3600'
+    return response
+
+def sse_event(weather_data):
+    return f"event: weather\ndata: {app.json.dumps(weather_data)}\n\n"
+
+def weather_events(lat, lon, initial):
+    # Each open stream holds a worker thread here, so it ends after one update or
+    # WEATHER_STREAM_WAIT seconds and the browser reconnects (a long poll).
+    # asgi.py serves streams that stay open. Subscribing here rather than in the
+    # view means a body that is never read (a HEAD request) subscribes nothing.
+    subscription = Subscription(initial)
+    key = weather_broadcaster.subscribe(lat, lon, subscription)
+    try:
+        yield sse_event(initial)
+        weather_data = subscription.wait(app.config['WEATHER_STREAM_WAIT'])
+        if weather_data is not None:
+            yield sse_event(weather_data)
+    finally:
+        weather_broadcaster.unsubscribe(key, subscription)
+
+def parse_batch(data):
+    # Returns (per-point parse_coords results, None) or (None, error message).
+    if not isinstance(data, dict) or not isinstance(data.get('points'), list):
+        return None, "Invalid request: expected a JSON object with a 'points' list."
+    points = data['points']
+    if len(points) > app.config['BATCH_MAX_POINTS']:
+        return None, f"Too many points in batch (maximum is {app.config['BATCH_MAX_POINTS']})."
+    return [parse_coords(point) if isinstance(point, dict) else (None, "Each point must be an object with lat and lon.")
+            for point in points], None
+
+def unique_cells(parsed_points):
+    # Maps each grid cell in the batch to the first valid point that falls in it.
+    cells = {}
+    for coords, error in parsed_points:
+        if not error:
+            cells.setdefault(weather_cache.cell(*coords), coords)
+    return cells
+
+def batch_results(parsed_points, weather_by_cell):
+    return [
+        {"temperature": None, "error": error, "emoji": None} if error
+        else dict(weather_by_cell[weather_cache.cell(*coords)])
+        for coords, error in parsed_points
+    ]
+
+@app.route('/weather_by_coords/batch', methods=['POST'])
+def weather_by_coords_batch_route():
+    api_key = os.getenv("OPENWEATHER_API_KEY")
+    if not api_key:
+        return jsonify({"error": "API Key for weather service is not configured."}), 500
+
+    parsed_points, error = parse_batch(request.get_json())
+    if error:
+        return jsonify({"error": error}), 400
+
+    # Points sharing a grid cell need one lookup; distinct cells are fetched concurrently.
+    cells = unique_cells(parsed_points)
+    weather_by_cell = {}
+    if cells:
+        with upstream_deadline(app.config['UPSTREAM_DEADLINE']):
+            workers = min(app.config['BATCH_MAX_CONCURRENCY'], len(cells))
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                # Each task runs in a copy of this context so the batch deadline applies to it.
+                futures = {
+                    cell: pool.submit(contextvars.copy_context().run, get_weather_by_coords, lat, lon, api_key)
+                    for cell, (lat, lon) in cells.items()
+                }
+            weather_by_cell = {cell: future.result() for cell, future in futures.items()}
+    return jsonify({"results": batch_results(parsed_points, weather_by_cell)})
+
+@app.route('/metrics', methods=['GET'])
+def metrics_route():
+    return metrics_registry.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route('/weather_by_coords/cache_stats', methods=['GET'])
+def weather_cache_stats_route():
+    return jsonify(weather_cache.stats())
+
+def warm_up():
+    """Do the start-up work that would otherwise slow down the first requests.
+
+    Meant to run once in a preforking master (see gunicorn.conf.py) so every
+    worker starts with it done; calling it again is harmless.
+    """
+    asset_manifest.prepare()
+    gazetteer.prepare()
+    pin_lodz()
+    current_theme = get_current_theme()
+    with app.test_request_context('/'):
+        # Compiles the template and fills rendered_pages for the default page in both themes.
+        for theme in {current_theme, 'light', 'dark'}:
+            cached_index(DEFAULT_MESSAGE, theme)
+    upstream.session # Builds the HTTP client; connections are still opened per process
+
+def after_fork():
+    """Drop state a forked worker must not share with its parent."""
+    upstream.close() # Pooled sockets belong to the process that opened them
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
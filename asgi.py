@@ -0,0 +1,362 @@
+"""Async serving mode for the weather app.
+
+Run it with any ASGI server, for example::
+
+    uvicorn asgi:application
+
+The weather routes (``POST /`` with ``button1`` and ``/weather_by_coords``)
+run on the event loop with a non-blocking upstream client, so a slow
+OpenWeatherMap response no longer holds a worker thread and one process can
+keep thousands of upstream calls in flight. ``GET /weather/stream`` is served
+here too, so an open Server-Sent Events stream holds no thread; set
+``WEATHER_STREAM_LIVE=1`` to have the page subscribe to it. Every other
+request is served by the regular Flask app on a pool of ``ASGI_WSGI_THREADS``
+threads. Requires the optional ``httpx`` and ``asgiref`` packages.
+"""
+import asyncio
+import functools
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, parse_qsl
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from werkzeug.http import is_resource_modified
+
+from app import (
+    REQUEST_LATENCY, REQUESTS_IN_FLIGHT, UPSTREAM_ERRORS, app as flask_app,
+    batch_results, city_query, describe_lodz_weather, geocode_cache, geocoding_request, get_current_theme,
+    is_cacheable_weather, last_known_weather, local_city_coords, parse_batch, parse_coords, parse_geocoding_response,
+    parse_weather_response, refresher, render_index, request_log, sse_event, track_weather_request, unique_cells,
+    upstream_breaker, upstream_call, upstream_cassette, upstream_error_message, upstream_scheduler,
+    weather_broadcaster, weather_cache, weather_cache_headers, weather_request,
+)
+from broadcast import AsyncSubscription
+from circuit_breaker import CircuitOpenError
+from scheduler import QuotaExceededError
+from owm_client import AsyncOWMClient, deadline as upstream_deadline
+
+async_upstream = AsyncOWMClient(
+    max_connections=flask_app.config['ASYNC_UPSTREAM_MAX_CONNECTIONS'],
+    max_keepalive_connections=flask_app.config['UPSTREAM_POOL_SIZE'],
+    max_retries=flask_app.config['UPSTREAM_MAX_RETRIES'],
+    backoff_factor=flask_app.config['UPSTREAM_BACKOFF'],
+    breaker=upstream_breaker,
+    scheduler=upstream_scheduler,
+    cassette=upstream_cassette,
+)
+wsgi_executor = ThreadPoolExecutor(flask_app.config['ASGI_WSGI_THREADS'], thread_name_prefix='wsgi')
+
+
+class PooledWsgiToAsgiInstance(WsgiToAsgiInstance):
+    # asgiref runs every WSGI request on one shared thread, so Flask would serve
+    # them one at a time; run each on the pool instead.
+    run_wsgi_app = sync_to_async(vars(WsgiToAsgiInstance)['run_wsgi_app'].func, thread_sensitive=False,
+                                 executor=wsgi_executor)
+
+
+class PooledWsgiToAsgi(WsgiToAsgi):
+    async def __call__(self, scope, receive, send):
+        await PooledWsgiToAsgiInstance(self.wsgi_application, self.duplicate_header_limit)(scope, receive, send)
+
+
+flask_asgi = PooledWsgiToAsgi(flask_app)
+
+
+async def fetch_weather_by_coords_async(lat, lon, api_key):
+    weather_url, weather_params = weather_request(lat, lon, api_key)
+    try:
+        with upstream_call('weather') as call:
+            response = call["response"] = await async_upstream.get(weather_url, params=weather_params, timeout=10)
+        return parse_weather_response(response)
+    except (CircuitOpenError, QuotaExceededError) as e:
+        return await weather_cache.off_loop(last_known_weather, lat, lon) or {"temperature": None, "error": upstream_error_message("Weather", e), "emoji": None}
+    except UPSTREAM_ERRORS as e:
+        return {"temperature": None, "error": upstream_error_message("Weather", e), "emoji": None}
+
+
+async def get_weather_by_coords_async(lat, lon, api_key):
+    track_weather_request(lat, lon)
+    with upstream_deadline(flask_app.config['UPSTREAM_DEADLINE']):
+        return await weather_cache.get_or_fetch_async(
+            lat, lon,
+            lambda cell_lat, cell_lon: fetch_weather_by_coords_async(cell_lat, cell_lon, api_key),
+            cacheable=is_cacheable_weather,
+        )
+
+
+async def resolve_city_async(city_name, country_code, api_key):
+    coords = local_city_coords(city_name, country_code)
+    if coords is not None:
+        return coords, None
+    query = city_query(city_name, country_code)
+    geo_url, geo_params = geocoding_request(query, api_key)
+    try:
+        with upstream_call('geocoding') as call:
+            response = call["response"] = await async_upstream.get(geo_url, params=geo_params, timeout=10)
+        coords, error = parse_geocoding_response(response, city_name)
+    except UPSTREAM_ERRORS as e:
+        error = upstream_error_message("Geocoding", e)
+    if error:
+        return None, error
+    return geocode_cache.set(query, *coords), None
+
+
+async def get_weather_for_lodz_async(api_key):
+    with upstream_deadline(flask_app.config['UPSTREAM_DEADLINE']):
+        coords, error = await resolve_city_async("Lodz", "PL", api_key)
+        if error:
+            return {"temperature": None, "error": error, "emoji": None}
+        refresher.pin(*coords)
+        return await get_weather_by_coords_async(*coords, api_key)
+
+
+def load_json(body):
+    try:
+        return json.loads(body) if body else None
+    except ValueError:
+        return None
+
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+def query_args(scope):
+    return dict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+
+
+def replay_body(body):
+    """Return a ``receive`` callable that yields an already consumed request body."""
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+
+    async def receive():
+        return messages.pop() if messages else {'type': 'http.disconnect'}
+    return receive
+
+
+def wsgi_environ(scope, body):
+    # The minimal WSGI environ Flask needs to build a request context (url_for, request.form).
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        key = name.decode('latin-1').upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+        environ[key] = value.decode('latin-1')
+    return environ
+
+
+async def send_response(send, status, body, content_type, headers=None):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode()), (b'content-length', str(len(body)).encode())]
+                   + [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_json(send, data, status=200, headers=None):
+    await send_response(send, status, flask_app.json.dumps(data).encode() + b'\n', 'application/json', headers)
+
+
+async def send_not_modified(send, headers):
+    await send({
+        'type': 'http.response.start',
+        'status': 304,
+        'headers': [(name.lower().encode(), value.encode()) for name, value in headers.items()],
+    })
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+def observed(endpoint):
+    # Request metrics for routes served on the event loop, labelled like the Flask
+    # endpoints; requests handed to Flask are measured by its own hooks.
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(scope, *args):
+            *args, send = args
+            status = 500
+            started = time.perf_counter()
+
+            async def send_and_record_status(message):
+                nonlocal status
+                if message['type'] == 'http.response.start':
+                    status = message['status']
+                await send(message)
+
+            headers = dict(scope.get('headers') or ())
+            token = request_log.begin(headers.get(b'x-request-id', b'').decode('latin-1') or None,
+                                      method=scope['method'], path=scope['path'], endpoint=endpoint)
+            error = None
+            try:
+                with REQUESTS_IN_FLIGHT.track_in_progress(endpoint):
+                    return await handler(scope, *args, send_and_record_status)
+            except BaseException as e:
+                error = type(e).__name__
+                raise
+            finally:
+                REQUEST_LATENCY.observe(time.perf_counter() - started, endpoint, scope['method'], str(status))
+                request_log.end(token, status, error)
+        return wrapper
+    return decorator
+
+
+async def index(scope, receive, send):
+    body = await read_body(receive)
+    form = parse_qs(body.decode('latin-1'), keep_blank_values=True)
+    if 'button1' not in form or not os.getenv("OPENWEATHER_API_KEY"):
+        # Nothing to fetch upstream; let Flask handle it exactly as in sync mode.
+        return await flask_asgi(scope, replay_body(body), send)
+    await index_button1(scope, body, send)
+
+
+@observed('index')
+async def index_button1(scope, body, send):
+    api_key = os.getenv("OPENWEATHER_API_KEY")
+    weather_info = await get_weather_for_lodz_async(api_key)
+    message = describe_lodz_weather(weather_info)
+    with flask_app.request_context(wsgi_environ(scope, body)):
+        html = render_index(message, get_current_theme(), weather_info)
+    await send_response(send, 200, html.encode(), 'text/html; charset=utf-8', {'Cache-Control': 'no-store'})
+
+
+@observed('weather_by_coords_route')
+async def weather_by_coords(scope, receive, send):
+    body = await read_body(receive)
+    api_key = os.getenv("OPENWEATHER_API_KEY")
+    if not api_key:
+        return await send_json(send, {"error": "API Key for weather service is not configured."}, 500)
+
+    # GET ?lat=..&lon=.. is the cacheable form; POST takes the same fields as JSON.
+    coords, error = parse_coords(query_args(scope) if scope['method'] == 'GET' else load_json(body))
+    if error:
+        return await send_json(send, {"error": error}, 400)
+
+    lat, lon = coords
+    weather_result = await get_weather_by_coords_async(lat, lon, api_key)
+    headers = await weather_cache.off_loop(weather_cache_headers, lat, lon, weather_result)
+    if scope['method'] == 'GET' and not is_resource_modified(wsgi_environ(scope, body), headers['ETag'],
+                                                             last_modified=headers.get('Last-Modified')):
+        return await send_not_modified(send, headers)
+    await send_json(send, weather_result, headers=headers)
+
+
+@observed('weather_by_coords_batch_route')
+async def weather_by_coords_batch(scope, receive, send):
+    body = await read_body(receive)
+    api_key = os.getenv("OPENWEATHER_API_KEY")
+    if not api_key:
+        return await send_json(send, {"error": "API Key for weather service is not configured."}, 500)
+
+    parsed_points, error = parse_batch(load_json(body))
+    if error:
+        return await send_json(send, {"error": error}, 400)
+
+    cells = unique_cells(parsed_points)
+    semaphore = asyncio.Semaphore(flask_app.config['BATCH_MAX_CONCURRENCY'])
+
+    async def fetch(lat, lon):
+        async with semaphore:
+            return await get_weather_by_coords_async(lat, lon, api_key)
+
+    with upstream_deadline(flask_app.config['UPSTREAM_DEADLINE']):
+        results = await asyncio.gather(*(fetch(lat, lon) for lat, lon in cells.values()))
+    await send_json(send, {"results": batch_results(parsed_points, dict(zip(cells, results)))})
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def weather_stream(scope, receive, send):
+    # Event-loop version of the Flask SSE route: an open stream costs no thread here.
+    # Not wrapped in observed(): a stream's duration is not a request latency.
+    api_key = os.getenv("OPENWEATHER_API_KEY")
+    if not api_key:
+        return await send_json(send, {"error": "API Key for weather service is not configured."}, 500)
+
+    coords, error = parse_coords(query_args(scope))
+    if error:
+        return await send_json(send, {"error": error}, 400)
+
+    lat, lon = coords
+    weather_result = await get_weather_by_coords_async(lat, lon, api_key)
+    subscription = AsyncSubscription(weather_result)
+    key = weather_broadcaster.subscribe(lat, lon, subscription)
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'text/event-stream; charset=utf-8'), (b'cache-control', b'no-cache'),
+                        (b'x-accel-buffering', b'no')],
+        })
+        event = sse_event(weather_result)
+        while True:
+            await send({'type': 'http.response.body', 'body': event.encode(), 'more_body': True})
+            update = asyncio.ensure_future(subscription.wait_async(flask_app.config['WEATHER_STREAM_KEEPALIVE']))
+            await asyncio.wait({update, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if disconnected.done():
+                update.cancel()
+                return
+            weather_data = update.result()
+            event = sse_event(weather_data) if weather_data is not None else ": keepalive\n\n"
+    finally:
+        disconnected.cancel()
+        weather_broadcaster.unsubscribe(key, subscription)
+
+
+ROUTES = {
+    ('POST', '/'): index,
+    ('GET', '/weather_by_coords'): weather_by_coords,
+    ('POST', '/weather_by_coords'): weather_by_coords,
+    ('POST', '/weather_by_coords/batch'): weather_by_coords_batch,
+    ('GET', '/weather/stream'): weather_stream,
+}
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await async_upstream.aclose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    route = ROUTES.get((scope.get('method'), scope['path'])) if scope['type'] == 'http' else None
+    if route is None:
+        return await flask_asgi(scope, receive, send)
+    await route(scope, receive, send)
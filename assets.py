@@ -0,0 +1,144 @@
+import hashlib
+import os
+import posixpath
+import sys
+import threading
+
+from storage import write_bytes_atomic
+
+# Formats that are already compressed (images, fonts) gain nothing from gzip or brotli.
+COMPRESSIBLE_EXTENSIONS = frozenset({'.css', '.js', '.mjs', '.map', '.html', '.svg', '.json', '.txt', '.xml'})
+
+
+def compressors():
+    """Available encodings, best first: ``{name: (file suffix, compress function)}``.
+
+    brotli is used when the optional ``brotli`` package is installed.
+    """
+    import gzip
+    available = {}
+    try:
+        import brotli
+    except ImportError:
+        pass
+    else:
+        available['br'] = ('.br', lambda data: brotli.compress(data, quality=11))
+    # mtime=0 keeps the output identical across builds.
+    available['gzip'] = ('.gz', lambda data: gzip.compress(data, compresslevel=9, mtime=0))
+    return available
+
+
+class AssetManifest:
+    """Content-hashed names for the files under a static directory.
+
+    ``css/index.css`` is published as ``css/index.<hash>.css``, where the hash
+    is taken from the file's bytes. A changed file gets a new URL, so the old
+    one can be cached by browsers and CDNs forever. The directory is scanned
+    once, on first use; call :meth:`reload` after assets change on disk.
+
+    :meth:`precompress` writes gzip (and brotli) variants of text assets to
+    ``build_dir`` under their hashed names, so serving them costs no CPU and a
+    variant can never be mistaken for one of a different version. Unless it
+    has been called already, it runs on the first :meth:`variants` lookup.
+    """
+
+    def __init__(self, root, hash_length=12, build_dir=None):
+        self.root = root
+        self.hash_length = hash_length
+        self.build_dir = build_dir
+        self._tables = None
+        self._variants = None
+        self._lock = threading.Lock()
+
+    def _scan(self):
+        by_path, by_name = {}, {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                full_path = os.path.join(dirpath, filename)
+                path = os.path.relpath(full_path, self.root).replace(os.sep, '/')
+                with open(full_path, 'rb') as f:
+                    digest = hashlib.sha256(f.read()).hexdigest()[:self.hash_length]
+                stem, ext = posixpath.splitext(path)
+                name = f"{stem}.{digest}{ext}"
+                by_path[path] = name
+                by_name[name] = path
+        return by_path, by_name
+
+    @property
+    def tables(self):
+        if self._tables is None:
+            with self._lock:
+                if self._tables is None:
+                    self._tables = self._scan()
+        return self._tables
+
+    def reload(self):
+        with self._lock:
+            self._tables = None
+
+    def hashed_name(self, path):
+        """Return the published name for ``path``; KeyError if there is no such asset."""
+        return self.tables[0][path]
+
+    def resolve(self, name):
+        """Return the path a published name refers to, or None if it is unknown or outdated."""
+        return self.tables[1].get(name)
+
+    def precompress(self):
+        """Write compressed variants of every compressible asset to ``build_dir``.
+
+        Variants that already exist are reused, and ones no smaller than the
+        original are not kept. Returns the number of files written.
+        """
+        written = 0
+        variants = {}
+        encodings = compressors()
+        for path, name in self.tables[0].items():
+            if posixpath.splitext(path)[1].lower() not in COMPRESSIBLE_EXTENSIONS:
+                continue
+            with open(os.path.join(self.root, path), 'rb') as f:
+                data = f.read()
+            for encoding, (suffix, compress) in encodings.items():
+                target = os.path.join(self.build_dir, *name.split('/')) + suffix
+                if not os.path.exists(target):
+                    compressed = compress(data)
+                    if len(compressed) >= len(data):
+                        continue
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    write_bytes_atomic(target, compressed)
+                    written += 1
+                variants.setdefault(name, []).append((encoding, target))
+        self._variants = variants
+        return written
+
+    def prepare(self):
+        """Scan the assets and build their compressed variants now instead of on first use."""
+        self.tables
+        if self._variants is None:
+            if self.build_dir is None:
+                self._variants = {}
+                return
+            try:
+                self.precompress()
+            except OSError:
+                self._variants = {} # Read-only build directory; assets are served uncompressed
+
+    def variants(self, name):
+        """Return ``[(encoding, file path), ...]`` for a published name, best encoding first."""
+        if self._variants is None:
+            self.prepare()
+        return self._variants.get(name, [])
+
+
+def main(argv=None):
+    # python assets.py static build/assets -- precompress as a build step
+    args = sys.argv[1:] if argv is None else argv
+    root = args[0] if args else 'static'
+    build_dir = args[1] if len(args) > 1 else os.path.join('build', 'assets')
+    manifest = AssetManifest(root, build_dir=build_dir)
+    written = manifest.precompress()
+    print(f"{written} compressed variants written to {build_dir}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+import os
+import threading
+
+
+class ProcessThread:
+    """A daemon thread running ``target``, started at most once per process.
+
+    A thread started before a fork does not exist in the child process, so
+    :meth:`ensure_started` starts a new one in each process that calls it.
+    """
+
+    def __init__(self, target, name):
+        self.target = target
+        self.name = name
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive() and self._pid == os.getpid()
+
+    def ensure_started(self, before_start=None):
+        """Start the thread unless it is running in this process; returns True if it was started.
+
+        ``before_start``, if given, is called just before a new thread starts.
+        """
+        if self.running:
+            return False
+        with self._lock:
+            if self.running:
+                return False
+            if before_start is not None:
+                before_start()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self.target, name=self.name, daemon=True)
+            self._thread.start()
+            return True
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
@@ -0,0 +1,100 @@
+"""Compare sync and async upstream throughput against a local fake OpenWeatherMap.
+
+    python -m benchmarks.bench_async --requests 500 --latency 0.2 --workers 8
+
+The sync side models the threaded Flask deployment: ``--workers`` threads
+each make blocking weather calls, like worker threads do. The async side
+issues every call from a single event loop, as ``asgi.py`` does. Every call
+targets a different grid cell so the cache never answers, and the upstream
+quota (UPSTREAM_CALLS_PER_MINUTE) is lifted for the run, as it would
+otherwise set the pace of both. ``rps`` counts successful calls only; a run
+with any errors makes the benchmark exit non-zero. Results are printed as
+JSON.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app, fetch_weather_by_coords, upstream_breaker, upstream_scheduler
+from fake_owm import FakeOpenWeatherMap
+from ratelimit import TokenBucket
+
+API_KEY = "benchmark"
+
+
+def points(count):
+    return [(-60.0 + i * 0.05, 20.0) for i in range(count)]
+
+
+def run_sync(count, workers):
+    from app import upstream
+    upstream.pool_maxsize = workers
+    upstream.close()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(lambda point: fetch_weather_by_coords(*point, API_KEY), points(count)))
+    return time.perf_counter() - started, results
+
+
+def run_async(count):
+    from asgi import async_upstream, fetch_weather_by_coords_async
+
+    async def main():
+        try:
+            return await asyncio.gather(*(fetch_weather_by_coords_async(*point, API_KEY) for point in points(count)))
+        finally:
+            await async_upstream.aclose()
+
+    started = time.perf_counter()
+    results = asyncio.run(main())
+    return time.perf_counter() - started, results
+
+
+def unthrottled(count):
+    # Room for every call of a run at once, and a closed breaker to start from.
+    upstream_scheduler.budget = TokenBucket(count, count)
+    upstream_breaker.reset()
+
+
+def summarize(mode, count, seconds, results):
+    errors = sum(1 for result in results if result["error"])
+    return {"mode": mode, "requests": count, "errors": errors,
+            "seconds": round(seconds, 3), "rps": round((count - errors) / seconds, 1)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.2, help="Seconds added to every upstream response")
+    parser.add_argument('--workers', type=int, default=8, help="Threads in the sync run")
+    parser.add_argument('--output', help="Write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    budget = upstream_scheduler.budget
+    try:
+        with FakeOpenWeatherMap(latency=args.latency) as fake_owm:
+            app.config['OPENWEATHER_API_URL'] = fake_owm.url
+            unthrottled(args.requests)
+            sync = summarize("sync", args.requests, *run_sync(args.requests, args.workers))
+            unthrottled(args.requests)
+            async_ = summarize("async", args.requests, *run_async(args.requests))
+    finally:
+        upstream_scheduler.budget = budget
+
+    report = {"latency": args.latency, "workers": args.workers, "results": [sync, async_],
+              "speedup": round(async_["rps"] / sync["rps"], 1) if sync["rps"] else None}
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    failed = [result["mode"] for result in report["results"] if result["errors"]]
+    for mode in failed:
+        print(f"ERRORS in the {mode} run; its rps leaves them out", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
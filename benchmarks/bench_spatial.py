@@ -0,0 +1,94 @@
+"""Measure nearest-neighbour lookup cost in the weather cache's SpatialIndex against index size.
+
+    python -m benchmarks.bench_spatial --sizes 1000,10000,100000,500000 --queries 20000
+
+Points are spread uniformly over ``--box`` (Poland by default, so the larger
+sizes are far denser than real traffic) and queried at random positions in
+the same box. For each size the report gives insert and lookup times, the
+share of lookups that found a point within ``--radius`` km, and the memory
+the index holds. Results are printed as JSON.
+"""
+import argparse
+import json
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+from spatial_index import SpatialIndex
+
+
+def random_points(rng, box, count):
+    south, west, north, east = box
+    return [(rng.uniform(south, north), rng.uniform(west, east)) for _ in range(count)]
+
+
+def build(index, points):
+    for key, (lat, lon) in enumerate(points):
+        index.add(key, lat, lon, None, stored_at=0)
+
+
+def traced_memory(radius, points):
+    # Built again, as tracing would distort the insert timings.
+    tracemalloc.start()
+    try:
+        index = SpatialIndex(radius, max_entries=len(points))
+        build(index, points)
+        return tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+
+def run(size, queries, radius, box, seed):
+    rng = random.Random(seed)
+    points = random_points(rng, box, size)
+    probes = random_points(rng, box, queries)
+
+    index = SpatialIndex(radius, max_entries=size)
+    started = time.perf_counter()
+    build(index, points)
+    inserted = time.perf_counter()
+
+    timings = []
+    found = 0
+    for lat, lon in probes:
+        started_lookup = time.perf_counter()
+        result = index.nearest(lat, lon, stored_after=-1)
+        timings.append(time.perf_counter() - started_lookup)
+        found += result is not None
+    timings.sort()
+    return {
+        "size": size,
+        "insert_us": round((inserted - started) / size * 1e6, 2),
+        "lookup_us_median": round(statistics.median(timings) * 1e6, 2),
+        "lookup_us_p99": round(timings[int(len(timings) * 0.99) - 1] * 1e6, 2),
+        "hit_rate": round(found / queries, 3),
+        "memory_mb": round(traced_memory(radius, points) / 2**20, 1),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1000,10000,100000,500000', help="Comma-separated index sizes")
+    parser.add_argument('--queries', type=int, default=20000, help="Lookups per size")
+    parser.add_argument('--radius', type=float, default=1.0, help="Search radius in km (WEATHER_NEARBY_RADIUS_KM)")
+    parser.add_argument('--box', default='49.0,14.1,54.8,24.1', help="south,west,north,east of the points")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="Write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    box = tuple(float(value) for value in args.box.split(','))
+    report = {
+        "radius_km": args.radius,
+        "results": [run(int(size), args.queries, args.radius, box, args.seed) for size in args.sizes.split(',')],
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
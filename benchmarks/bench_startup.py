@@ -0,0 +1,81 @@
+"""Measure cold-start cost: import time, memory and time to the first response.
+
+    python -m benchmarks.bench_startup --runs 5 --output startup.json
+
+Every run is a fresh interpreter, as a newly started worker or serverless
+instance would be. ``cold`` serves ``GET /`` straight after ``import app``;
+``warm`` first calls ``app.warm_up()``, which gunicorn.conf.py does once in
+the master, so its first-response time is what a forked worker pays. Medians
+are printed (and optionally written) as JSON.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = r'''
+import json, resource, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+gazetteer_loaded = app.gazetteer._loaded
+rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+app.app.config['THEME_CONFIG_FILE'] = sys.argv[1] + '/theme_config.json'
+app.asset_manifest.build_dir = sys.argv[1] + '/assets'
+if sys.argv[2] == 'warm':
+    app.warm_up()
+warmed = time.perf_counter()
+status = app.app.test_client().get('/').status_code
+responded = time.perf_counter()
+print(json.dumps({
+    "status": status,
+    "import_ms": (imported - started) * 1000,
+    "warm_up_ms": (warmed - imported) * 1000,
+    "first_response_ms": (responded - warmed) * 1000,
+    "total_ms": (responded - started) * 1000,
+    "rss_after_import_mb": rss_kb / 1024,
+    "modules": len(sys.modules),
+    "deferred_loaded": sorted(name for name in ("sqlite3", "gzip", "httpx", "asgiref") if name in sys.modules),
+    "gazetteer_loaded_at_import": gazetteer_loaded,
+}))
+'''
+
+
+def run_once(mode):
+    with tempfile.TemporaryDirectory() as workdir:
+        output = subprocess.run([sys.executable, '-c', CHILD, workdir, mode], cwd=ROOT, check=True,
+                                capture_output=True, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def summarize(samples):
+    summary = {}
+    for key, value in samples[0].items():
+        if isinstance(value, float):
+            summary[key] = round(statistics.median(sample[key] for sample in samples), 2)
+        else:
+            summary[key] = value
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help="Fresh interpreters per mode")
+    parser.add_argument('--output', help="Write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    report = {mode: summarize([run_once(mode) for _ in range(args.runs)]) for mode in ('cold', 'warm')}
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,213 @@
+"""Load test the app against a local fake OpenWeatherMap.
+
+    python -m benchmarks.loadtest --duration 10 --concurrency 16 --latency 0.1 --output results.json
+    python -m benchmarks.loadtest --baseline results.json --max-regression 0.1
+
+Starts the fake upstream and, unless ``--target`` points at an already
+running deployment, serves the app in-process on a threaded WSGI server.
+``--concurrency`` clients, each with its own keep-alive session, then issue a
+weighted mix of ``GET /``, ``POST /toggle-theme`` and ``POST
+/weather_by_coords`` requests for ``--duration`` seconds. The report has RPS,
+p50/p95/p99 latency and errors per scenario, plus upstream call counts, and is
+printed (and optionally written) as JSON.
+
+To load a separately deployed app, start ``python fake_owm.py`` with the same
+latency options, point the deployment's ``OPENWEATHER_API_URL`` at it and
+pass its URL as ``--target``; upstream call counts then come from the fake's
+own process and are not included in the report.
+
+With ``--replay`` the in-process app answers upstream calls from a cassette
+recorded with ``UPSTREAM_MODE=record`` (see cassette.py) instead of the fake,
+at the recorded latencies times ``--time-scale``. Runs are then fully offline
+and repeat the recorded upstream behaviour, including its errors.
+
+With ``--baseline`` the run is compared with an earlier report and the exit
+status is 1 if any scenario's RPS dropped or p95 latency rose by more than
+``--max-regression``.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+from cassette import Cassette
+from fake_owm import FakeOpenWeatherMap
+
+SCENARIOS = {
+    'index': lambda session, base_url, rng, spread: session.get(base_url + '/'),
+    'toggle': lambda session, base_url, rng, spread: session.post(base_url + '/toggle-theme', allow_redirects=False),
+    'coords': lambda session, base_url, rng, spread: session.post(base_url + '/weather_by_coords', json={
+        "lat": 51.7592 + rng.uniform(-spread, spread),
+        "lon": 19.456 + rng.uniform(-spread, spread),
+    }),
+}
+
+
+def parse_mix(text):
+    # "index=5,toggle=1,coords=10" -> {"index": 5.0, "toggle": 1.0, "coords": 10.0}
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"Unknown scenario {name!r}; choose from {', '.join(SCENARIOS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = math.ceil(fraction * len(sorted_values))
+    return sorted_values[max(0, min(len(sorted_values), rank) - 1)]
+
+
+def run_client(base_url, mix, stop_at, seed, spread, samples):
+    rng = random.Random(seed)
+    names, weights = list(mix), list(mix.values())
+    with requests.Session() as session:
+        while time.perf_counter() < stop_at:
+            name = rng.choices(names, weights)[0]
+            started = time.perf_counter()
+            try:
+                response = SCENARIOS[name](session, base_url, rng, spread)
+                ok = response.status_code < 400 and not (
+                    name == 'coords' and response.json().get("error"))
+            except (requests.exceptions.RequestException, ValueError):
+                ok = False
+            samples.append((name, time.perf_counter() - started, ok))
+
+
+def summarize(samples, duration):
+    report = {}
+    for name in sorted({sample[0] for sample in samples}):
+        latencies = sorted(latency for scenario, latency, ok in samples if scenario == name)
+        errors = sum(1 for scenario, latency, ok in samples if scenario == name and not ok)
+        report[name] = {
+            "requests": len(latencies),
+            "errors": errors,
+            "rps": round(len(latencies) / duration, 1),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        }
+    return report
+
+
+def compare(report, baseline, max_regression):
+    """Return human-readable regressions of ``report`` against ``baseline``."""
+    regressions = []
+    for name, current in report["scenarios"].items():
+        previous = baseline["scenarios"].get(name)
+        if previous is None:
+            continue
+        if current["rps"] < previous["rps"] * (1 - max_regression):
+            regressions.append(f"{name}: rps {previous['rps']} -> {current['rps']}")
+        if current["p95_ms"] > previous["p95_ms"] * (1 + max_regression):
+            regressions.append(f"{name}: p95 {previous['p95_ms']}ms -> {current['p95_ms']}ms")
+    return regressions
+
+
+def serve_app(fake_owm, workdir, quota, cassette=None):
+    from werkzeug.serving import WSGIRequestHandler, make_server
+    from app import app, geocode_cache, upstream, upstream_scheduler, weather_cache
+    from ratelimit import TokenBucket
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    os.environ.setdefault('OPENWEATHER_API_KEY', 'loadtest')
+    app.config['OPENWEATHER_API_URL'] = fake_owm.url
+    app.config['THEME_CONFIG_FILE'] = os.path.join(workdir, 'theme_config.json')
+    geocode_cache.load(os.path.join(workdir, 'geocode_cache.json'))
+    weather_cache.clear() # Every run starts cold, whatever ran in this process before
+    upstream_scheduler.budget = TokenBucket(quota / 60, max(1, quota / 6))
+    upstream.cassette = cassette
+    upstream.close() # The next session is built with (or without) the cassette
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def stop_app(server):
+    from app import refresher
+
+    server.shutdown()
+    refresher.stop() # Started by the first request; it must not outlive the run
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--target', help="Base URL of a running deployment (default: serve the app in-process)")
+    parser.add_argument('--duration', type=float, default=10.0, help="Seconds to generate load for")
+    parser.add_argument('--concurrency', type=int, default=16, help="Concurrent clients")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('index=5,toggle=1,coords=10'))
+    parser.add_argument('--spread', type=float, default=0.05,
+                        help="Degrees around Lodz that coordinates are drawn from; controls the cache hit rate")
+    parser.add_argument('--latency', type=float, default=0.05, help="Fake upstream latency in seconds")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Fake upstream latency jitter in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of fake upstream calls that fail")
+    parser.add_argument('--quota', type=float, default=60000,
+                        help="Upstream calls per minute the in-process app may make (UPSTREAM_CALLS_PER_MINUTE)")
+    parser.add_argument('--replay', help="Cassette to replay upstream responses from, instead of the fake")
+    parser.add_argument('--time-scale', type=float, default=1.0, help="Multiplies replayed latencies; 0 is instant")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="Write the JSON report to this file")
+    parser.add_argument('--baseline', help="Earlier JSON report to compare against")
+    parser.add_argument('--max-regression', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    with FakeOpenWeatherMap(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                            seed=args.seed) as fake_owm, tempfile.TemporaryDirectory() as workdir:
+        server = None
+        base_url = args.target
+        cassette = Cassette(args.replay, Cassette.REPLAY, time_scale=args.time_scale) if args.replay else None
+        if base_url is None:
+            server, base_url = serve_app(fake_owm, workdir, args.quota, cassette)
+
+        samples = []
+        stop_at = time.perf_counter() + args.duration
+        clients = [
+            threading.Thread(target=run_client, args=(base_url, args.mix, stop_at, args.seed + i, args.spread, samples))
+            for i in range(args.concurrency)
+        ]
+        started = time.perf_counter()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        elapsed = time.perf_counter() - started
+        if server is not None:
+            stop_app(server)
+
+    report = {
+        "config": {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+        "elapsed_s": round(elapsed, 3),
+        "scenarios": summarize(samples, elapsed),
+        "upstream_calls": dict(cassette.calls if cassette is not None else fake_owm.calls),
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,143 @@
+import asyncio
+import threading
+
+from background import ProcessThread
+
+
+class Subscription:
+    """A subscriber's view of one grid cell: the latest value not yet delivered.
+
+    Values that arrive faster than the subscriber reads them are conflated, so
+    a slow client only ever receives the newest observation.
+    """
+
+    def __init__(self, initial=None):
+        self.last_sent = initial
+        self._pending = None
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+
+    def offer(self, value):
+        # Called by the broadcaster thread.
+        with self._lock:
+            if value == self.last_sent:
+                return False
+            self._pending = value
+        self._ready.set()
+        return True
+
+    def _take(self):
+        with self._lock:
+            value, self._pending = self._pending, None
+            self._ready.clear()
+            if value is not None:
+                self.last_sent = value
+            return value
+
+    def wait(self, timeout=None):
+        """Block until a changed value arrives and return it, or None on timeout."""
+        self._ready.wait(timeout)
+        return self._take()
+
+
+class AsyncSubscription(Subscription):
+    """A :class:`Subscription` that an event loop awaits instead of blocking on."""
+
+    def __init__(self, initial=None):
+        super().__init__(initial)
+        self._loop = asyncio.get_running_loop()
+        self._async_ready = asyncio.Event()
+
+    def offer(self, value):
+        offered = super().offer(value)
+        if offered:
+            self._loop.call_soon_threadsafe(self._async_ready.set)
+        return offered
+
+    async def wait_async(self, timeout=None):
+        try:
+            await asyncio.wait_for(self._async_ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._async_ready.clear()
+        return self._take()
+
+
+class Broadcaster:
+    """Fans cached observations out to everyone subscribed to the same grid cell.
+
+    A background thread compares each subscribed cell's cache entry with what
+    its subscribers last received and hands them only values that changed. It
+    checks every ``interval`` seconds, which also picks up entries written by
+    other processes through a shared cache backend, and at once for cells
+    passed to :meth:`notify` (wire it to ``GridCache.on_store``).
+
+    Keeping the cells fresh is left to the caller: ``on_first(key)`` runs when
+    a cell gains its first subscriber and ``on_last(key)`` when it loses the
+    last one, for example to have a refresher keep watched cells warm.
+    """
+
+    def __init__(self, cache, interval=1.0, on_first=None, on_last=None):
+        self.cache = cache
+        self.interval = interval
+        self.on_first = on_first
+        self.on_last = on_last
+        self._subscribers = {} # key -> set of subscriptions
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = ProcessThread(self._run, 'weather-broadcaster')
+
+    def subscribe(self, lat, lon, subscription):
+        """Add ``subscription`` to the cell containing (lat, lon); returns the cell."""
+        key = self.cache.cell(lat, lon)
+        with self._lock:
+            subscribers = self._subscribers.setdefault(key, set())
+            first = not subscribers
+            subscribers.add(subscription)
+        if first and self.on_first is not None:
+            self.on_first(key)
+        self._thread.ensure_started()
+        return key
+
+    def unsubscribe(self, key, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(key)
+            if subscribers is None or subscription not in subscribers:
+                return
+            subscribers.discard(subscription)
+            last = not subscribers
+            if last:
+                del self._subscribers[key]
+        if last and self.on_last is not None:
+            self.on_last(key)
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def notify(self, key, value=None):
+        """Check ``key`` for subscribers now rather than on the next pass."""
+        if key in self._subscribers:
+            self._wake.set()
+
+    def publish(self):
+        """Offer every subscribed cell's cached value to its subscribers; returns the number of pushes."""
+        with self._lock:
+            cells = {key: list(subscribers) for key, subscribers in self._subscribers.items()}
+        pushed = 0
+        for key, subscribers in cells.items():
+            value = self.cache.peek(*self.cache.cell_center(key))
+            if value is None:
+                continue
+            for subscription in subscribers:
+                pushed += subscription.offer(value)
+        return pushed
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.publish()
+            except Exception:
+                pass # A failing backend read must not end pushes for everyone; retry on the next pass
@@ -0,0 +1,199 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import Counter
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+RECORDED_HEADERS = ('Content-Type', 'Retry-After')
+
+
+class CassetteMiss(requests.exceptions.ConnectionError):
+    """Raised in strict replay mode for a request nothing was recorded for."""
+
+
+class Cassette:
+    """Upstream responses recorded to, or replayed from, a JSON-lines file.
+
+    In ``record`` mode every response the upstream clients receive is
+    appended to ``path`` with its latency. URLs are stored without their host
+    or ``secret_params`` (the API key), so a cassette can be shared and
+    replayed against any ``OPENWEATHER_API_URL``.
+
+    In ``replay`` mode requests are answered from ``path`` without touching
+    the network, each after its recorded latency times ``time_scale`` (0
+    replays instantly). Responses recorded for the same request are replayed
+    in turn, cycling, so a run is repeatable. A request nothing was recorded
+    for is answered with the responses recorded for the same endpoint, so
+    traffic at arbitrary coordinates keeps the recorded latency profile;
+    with ``strict`` it fails with :class:`CassetteMiss` instead.
+
+    ``calls`` counts the requests recorded or replayed, by path.
+    """
+
+    RECORD = 'record'
+    REPLAY = 'replay'
+
+    def __init__(self, path, mode, time_scale=1.0, strict=False, secret_params=('appid',)):
+        if mode not in (self.RECORD, self.REPLAY):
+            raise ValueError(f"Unknown cassette mode {mode!r}; use 'record' or 'replay'.")
+        self.path = path
+        self.mode = mode
+        self.time_scale = time_scale
+        self.strict = strict
+        self.secret_params = frozenset(secret_params)
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._file = None
+        self._pid = None
+        self._by_request = None # (path, query) -> entries, loaded on first replay
+        self._by_path = None
+        self._turns = Counter()
+
+    def key(self, url):
+        """The URL without host or secrets, with parameters sorted: how requests are matched."""
+        parts = urlsplit(str(url))
+        params = sorted((name, value) for name, value in parse_qsl(parts.query) if name not in self.secret_params)
+        return f"{parts.path}?{urlencode(params)}" if params else parts.path
+
+    def record(self, url, status, headers, body, elapsed):
+        entry = {
+            "url": self.key(url),
+            "status": status,
+            "headers": {name: headers[name] for name in RECORDED_HEADERS if name in headers},
+            "body": body,
+            "elapsed": round(elapsed, 6),
+            "recorded_at": round(time.time(), 3),
+        }
+        line = json.dumps(entry) + '\n'
+        with self._lock:
+            if self._pid != os.getpid():
+                # An inherited file object shares its buffer with the parent; open our own.
+                self._file = open(self.path, 'a', encoding='utf-8')
+                self._pid = os.getpid()
+            self._file.write(line)
+            self._file.flush()
+            self.calls[entry["url"].partition('?')[0]] += 1
+
+    def _load(self):
+        by_request, by_path = {}, {}
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    by_request.setdefault(entry["url"], []).append(entry)
+                    by_path.setdefault(entry["url"].partition('?')[0], []).append(entry)
+        self._by_request, self._by_path = by_request, by_path
+
+    def match(self, url):
+        """Return the next recorded response for ``url``; raises :class:`CassetteMiss` if there is none."""
+        key = self.key(url)
+        path = key.partition('?')[0]
+        with self._lock:
+            if self._by_request is None:
+                self._load()
+            entries = self._by_request.get(key)
+            if entries is None and not self.strict:
+                key, entries = path, self._by_path.get(path)
+            if not entries:
+                raise CassetteMiss(f"No recorded response for {key}.")
+            entry = entries[self._turns[key] % len(entries)]
+            self._turns[key] += 1
+            self.calls[path] += 1
+        return entry
+
+    def delay(self, entry):
+        return entry["elapsed"] * self.time_scale
+
+    def close(self):
+        with self._lock:
+            if self._file is not None and self._pid == os.getpid():
+                self._file.close()
+            self._file = None
+            self._pid = None
+
+
+def read_timeout(timeout):
+    # requests takes a number or a (connect, read) pair.
+    return timeout[1] if isinstance(timeout, tuple) else timeout
+
+
+class CassetteAdapter(BaseAdapter):
+    """``requests`` transport adapter that records through ``adapter`` or replays from a cassette."""
+
+    def __init__(self, cassette, adapter):
+        super().__init__()
+        self.cassette = cassette
+        self.adapter = adapter
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        if self.cassette.mode == Cassette.RECORD:
+            started = time.perf_counter()
+            response = self.adapter.send(request, stream=stream, timeout=timeout, verify=verify, cert=cert,
+                                         proxies=proxies)
+            body = response.text # Reads the body, so the latency recorded includes it
+            self.cassette.record(request.url, response.status_code, response.headers, body,
+                                 time.perf_counter() - started)
+            return response
+
+        entry = self.cassette.match(request.url)
+        delay = self.cassette.delay(entry)
+        limit = read_timeout(timeout)
+        if limit is not None and delay > limit:
+            time.sleep(limit)
+            raise requests.exceptions.ReadTimeout(f"Replayed response took longer than {limit}s.", request=request)
+        time.sleep(delay)
+        response = requests.Response()
+        response.status_code = entry["status"]
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response._content = entry["body"].encode('utf-8')
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+
+class AsyncCassetteTransport:
+    """httpx transport that records through ``transport`` or replays from a cassette."""
+
+    def __init__(self, cassette, transport):
+        self.cassette = cassette
+        self.transport = transport
+
+    async def handle_async_request(self, request):
+        import httpx
+        if self.cassette.mode == Cassette.RECORD:
+            started = time.perf_counter()
+            response = await self.transport.handle_async_request(request)
+            body = (await response.aread()).decode('utf-8', errors='replace')
+            self.cassette.record(request.url, response.status_code, response.headers, body,
+                                 time.perf_counter() - started)
+            return response
+
+        entry = self.cassette.match(request.url)
+        delay = self.cassette.delay(entry)
+        limit = request.extensions.get('timeout', {}).get('read')
+        if limit is not None and delay > limit:
+            await asyncio.sleep(limit)
+            raise httpx.ReadTimeout(f"Replayed response took longer than {limit}s.", request=request)
+        await asyncio.sleep(delay)
+        return httpx.Response(entry["status"], headers=entry["headers"], content=entry["body"].encode('utf-8'),
+                              request=request)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+    async def __aenter__(self):
+        await self.transport.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.transport.__aexit__(*exc_info)
@@ -0,0 +1,73 @@
+import threading
+import time
+
+import requests
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """Raised instead of calling upstream while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Fails upstream calls fast after repeated failures.
+
+    After ``failure_threshold`` consecutive failures the circuit opens and
+    every call raises :class:`CircuitOpenError` immediately. Once
+    ``reset_timeout`` seconds have passed, up to ``half_open_max_calls`` probe
+    calls are let through: a success closes the circuit, a failure opens it for
+    another ``reset_timeout``.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, half_open_max_calls=1, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self._clock = clock
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._probes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == self.OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def before_call(self):
+        """Reserve a call; raises CircuitOpenError if upstream must not be called now."""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return
+            retry_in = self.reset_timeout - (self._clock() - self._opened_at)
+            if self._state == self.OPEN and retry_in <= 0:
+                self._state = self.HALF_OPEN
+                self._probes = 0
+            if self._state == self.HALF_OPEN and self._probes < self.half_open_max_calls:
+                self._probes += 1
+                return
+            raise CircuitOpenError(
+                f"Circuit breaker is open; upstream calls are suspended for {max(retry_in, 0):.0f}s.")
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probes = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = self._clock()
+                self._probes = 0
+
+    def reset(self):
+        self.record_success()
@@ -0,0 +1,137 @@
+import argparse
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep connections alive between requests
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.fake.record_connection()
+
+    def do_GET(self):
+        fake = self.server.fake
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        status, body = fake.respond(url.path, params)
+        payload = json.dumps(body).encode()
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):
+            pass # The client gave up waiting, e.g. after its deadline expired
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024 # Benchmarks open many connections at once
+
+
+class FakeOpenWeatherMap:
+    """Local stand-in for the OpenWeatherMap endpoints the app uses.
+
+    Implements ``/geo/1.0/direct`` and ``/data/2.5/weather`` and adds
+    ``latency`` seconds, plus or minus up to ``jitter``, to every response.
+    Failures can be scripted with ``fail_with``, a list of HTTP statuses
+    returned (in order) before normal responses resume, or injected at random
+    with ``error_rate``. ``calls`` counts requests per path.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, temperature=21.5, jitter=0.0, error_rate=0.0,
+                 error_status=500, seed=None):
+        self.latency = latency
+        self.temperature = temperature
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.fail_with = []
+        self.requests = []
+        self.calls = Counter()
+        self.connections = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = _Server((host, port), _Handler)
+        self._server.fake = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def record_connection(self):
+        with self._lock:
+            self.connections += 1
+
+    def respond(self, path, params):
+        with self._lock:
+            self.requests.append((path, params))
+            self.calls[path] += 1
+            failure = self.fail_with.pop(0) if self.fail_with else None
+            if failure is None and self.error_rate and self._random.random() < self.error_rate:
+                failure = self.error_status
+            delay = self.latency + (self._random.uniform(-self.jitter, self.jitter) if self.jitter else 0.0)
+        if delay > 0:
+            time.sleep(delay)
+        if failure is not None:
+            return failure, {"cod": failure, "message": "Injected failure"}
+        if path == '/geo/1.0/direct':
+            return 200, [{"name": params.get("q", "").split(",")[0], "lat": 51.7592, "lon": 19.456}]
+        if path == '/data/2.5/weather':
+            return 200, {"coord": {"lat": float(params["lat"]), "lon": float(params["lon"])},
+                         "main": {"temp": self.temperature}}
+        return 404, {"cod": 404, "message": "Not found"}
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, args=(0.05,), daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a fake OpenWeatherMap API for local testing.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Random +/- seconds added to the latency")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of requests answered with --error-status")
+    parser.add_argument('--error-status', type=int, default=500)
+    parser.add_argument('--temperature', type=float, default=21.5)
+    args = parser.parse_args(argv)
+
+    fake = FakeOpenWeatherMap(args.host, args.port, latency=args.latency, temperature=args.temperature,
+                              jitter=args.jitter, error_rate=args.error_rate, error_status=args.error_status)
+    print(f"Fake OpenWeatherMap listening on {fake.url} (set OPENWEATHER_API_URL to use it)")
+    try:
+        fake._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        fake._server.server_close()
+
+
+if __name__ == '__main__':
+    main()
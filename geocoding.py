@@ -0,0 +1,202 @@
+import bisect
+import heapq
+import json
+import threading
+import unicodedata
+from array import array
+
+from storage import write_json_atomic
+
+
+class GeocodeCache:
+    """Persistent cache of geocoding results, keyed on the query string.
+
+    Results live in memory and are mirrored to a JSON file so a restarted
+    process does not have to resolve the same cities again. Only successful
+    lookups are stored.
+    """
+
+    def __init__(self):
+        self.path = None
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(query):
+        return query.strip().lower()
+
+    def load(self, path):
+        """Replace the in-memory entries with those stored at ``path``."""
+        try:
+            with open(path, 'r') as f:
+                stored = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            stored = {}
+        entries = {}
+        for key, value in stored.items() if isinstance(stored, dict) else ():
+            if isinstance(value, list) and len(value) == 2:
+                entries[key] = (float(value[0]), float(value[1]))
+        with self._lock:
+            self.path = path
+            self._entries = entries
+
+    def get(self, query):
+        """Return the cached (lat, lon) for ``query``, or None on a miss."""
+        return self._entries.get(self._key(query))
+
+    def set(self, query, lat, lon):
+        coords = (float(lat), float(lon))
+        with self._lock:
+            self._entries[self._key(query)] = coords
+            if self.path:
+                write_json_atomic(self.path, {key: list(value) for key, value in self._entries.items()})
+        return coords
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+
+# Letters NFKD does not decompose into a base letter and a combining mark.
+_FOLDED_LETTERS = str.maketrans({'ł': 'l', 'đ': 'd', 'ø': 'o', 'æ': 'ae', 'œ': 'oe', 'ı': 'i', 'þ': 'th'})
+
+
+def normalize_name(name):
+    """Fold a place name for lookups: case, accents, punctuation and spacing are ignored.
+
+    ``"Łódź"``, ``"LODZ"`` and ``" lodz "`` all normalize to ``"lodz"``.
+    """
+    folded = unicodedata.normalize('NFKD', name.casefold().translate(_FOLDED_LETTERS))
+    letters = (' ' if char in "-'.,_" else char for char in folded if not unicodedata.combining(char))
+    return ' '.join(''.join(letters).split())
+
+
+class Gazetteer:
+    """In-process city index: resolves names to coordinates without a network call.
+
+    Cities are read from a tab-separated file, either this repository's
+    ``name, country, lat, lon, population, alternate names`` format (see
+    data/cities.tsv) or a GeoNames ``cities*.txt`` dump, which can be dropped
+    in for worldwide coverage. Of a GeoNames entry only the name and its
+    ASCII form are indexed; its many alternate names would multiply the index.
+
+    Storage is columnar: one ``array`` per attribute indexed by city, plus a
+    sorted list of normalized names (and alternate names) with a parallel
+    array of city numbers. Exact and prefix lookups are binary searches over
+    that list; when several cities share a name the most populous one wins.
+
+    The file is parsed on first use, or up front by :meth:`prepare`.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._loaded = path is None
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._names = [] # Display names, by city number
+        self._countries = [] # ISO 3166-1 alpha-2 codes, by city number
+        self._lats = array('d')
+        self._lons = array('d')
+        self._populations = array('Q')
+        self._keys = [] # Sorted normalized names
+        self._cities = array('L') # City number for each entry of _keys
+
+    def load(self, path):
+        """Index the cities in ``path`` (None for an empty gazetteer), replacing any loaded before."""
+        with self._lock:
+            self.path = path
+            self._loaded = path is None
+            self._reset()
+
+    def clear(self):
+        self.load(None)
+
+    def prepare(self):
+        """Parse the file now rather than on the first lookup."""
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self._read(self.path)
+                    self._loaded = True
+
+    def __len__(self):
+        self.prepare()
+        return len(self._names)
+
+    @staticmethod
+    def _rows(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip() or line.startswith('#'):
+                    continue
+                fields = line.rstrip('\r\n').split('\t')
+                if len(fields) >= 15: # GeoNames: name, asciiname, alternatenames, lat, lon, ..., country code, ..., population
+                    yield fields[1], fields[8], fields[4], fields[5], fields[14], [fields[2]]
+                else:
+                    yield fields[0], fields[1], fields[2], fields[3], fields[4] if len(fields) > 4 else 0, \
+                        fields[5].split(',') if len(fields) > 5 else []
+
+    def _read(self, path):
+        entries = []
+        try:
+            rows = list(self._rows(path))
+        except FileNotFoundError:
+            rows = []
+        for name, country, lat, lon, population, alternate_names in rows:
+            try:
+                coords = (float(lat), float(lon))
+                population = int(population or 0)
+            except ValueError:
+                continue
+            number = len(self._names)
+            self._names.append(name)
+            self._countries.append(country.upper())
+            self._lats.append(coords[0])
+            self._lons.append(coords[1])
+            self._populations.append(population)
+            keys = {normalize_name(alias) for alias in [name, *alternate_names]}
+            entries.extend((key, -population, number) for key in keys if key)
+        entries.sort()
+        self._keys = [key for key, _, _ in entries]
+        self._cities = array('L', (number for _, _, number in entries))
+
+    def _matches(self, low, high, country_code):
+        country_code = country_code.upper() if country_code else None
+        for index in range(low, high):
+            number = self._cities[index]
+            if country_code is None or self._countries[number] == country_code:
+                yield number
+
+    def lookup(self, city_name, country_code=None):
+        """Return (lat, lon) of the most populous city called ``city_name``, or None."""
+        self.prepare()
+        key = normalize_name(city_name)
+        low = bisect.bisect_left(self._keys, key)
+        high = bisect.bisect_right(self._keys, key, low)
+        # Entries with the same key are sorted by falling population, but a
+        # country filter may skip the first ones.
+        number = next(self._matches(low, high, country_code), None)
+        if number is None:
+            return None
+        return (self._lats[number], self._lons[number])
+
+    def search(self, prefix, country_code=None, limit=10):
+        """Return up to ``limit`` cities whose name starts with ``prefix``, most populous first.
+
+        Each result is a dict with ``name``, ``country``, ``lat`` and ``lon``.
+        """
+        self.prepare()
+        key = normalize_name(prefix)
+        if not key:
+            return []
+        low = bisect.bisect_left(self._keys, key)
+        high = bisect.bisect_left(self._keys, key + '\U0010ffff', low)
+        numbers = dict.fromkeys(self._matches(low, high, country_code)) # A city once, however many names match
+        best = heapq.nsmallest(limit, numbers, key=lambda number: (-self._populations[number], self._names[number]))
+        return [
+            {"name": self._names[number], "country": self._countries[number],
+             "lat": self._lats[number], "lon": self._lons[number]}
+            for number in best
+        ]
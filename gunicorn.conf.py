@@ -0,0 +1,31 @@
+"""Gunicorn settings for fast worker start-up::
+
+    gunicorn -c gunicorn.conf.py app:app
+
+The app is imported and warmed up once in the master (``preload_app``), and
+workers are forked from it. A worker the autoscaler adds therefore starts
+without importing anything, reading any file or compiling any template, and
+shares the master's memory copy-on-write.
+"""
+import gc
+import multiprocessing
+import os
+
+bind = os.getenv('BIND', '0.0.0.0:8000')
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv('GUNICORN_THREADS', 4))
+preload_app = True
+
+
+def when_ready(server):
+    # Runs in the master after the app is imported, before any worker is forked.
+    import app
+    app.warm_up()
+    # Objects that exist now are never freed; keeping the collector away from them
+    # stops it from touching (and so copying) the pages workers share.
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import app
+    app.after_fork()
@@ -0,0 +1,181 @@
+import bisect
+import contextlib
+import threading
+import time
+import weakref
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Registry:
+    """Metrics in the Prometheus text exposition format with lock-free updates.
+
+    Each thread writes to its own shard (a dict of small lists), so recording a
+    value never takes a lock or contends with other threads; ``render`` sums
+    the shards. When a thread exits its shard is folded into a retired shard,
+    so short-lived pool threads do not accumulate.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._callbacks = []
+        self._shards = []
+        self._retired = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append(shard)
+            weakref.finalize(threading.current_thread(), self._retire, shard)
+            return shard
+
+    def _retire(self, shard):
+        with self._lock:
+            self._shards.remove(shard)
+            for key, cell in shard.items():
+                self._merge(self._retired, key, cell)
+
+    @staticmethod
+    def _merge(totals, key, cell):
+        total = totals.get(key)
+        if total is None:
+            totals[key] = list(cell)
+        else:
+            for i, value in enumerate(cell):
+                total[i] += value
+
+    def _totals(self):
+        with self._lock:
+            totals = {key: list(cell) for key, cell in self._retired.items()}
+            shards = list(self._shards)
+        for shard in shards:
+            for key, cell in list(shard.items()):
+                self._merge(totals, key, cell)
+        return totals
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter(self, name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self._add(Gauge(self, name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(self, name, help, labelnames, buckets))
+
+    def callback(self, name, help, type, func):
+        """Export ``func()`` (a number) as a metric computed at scrape time."""
+        self._callbacks.append((name, help, type, func))
+
+    def render(self):
+        totals = self._totals()
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            cells = sorted((key[1], cell) for key, cell in totals.items() if key[0] is metric)
+            lines.extend(metric.samples(cells))
+        for name, help, type, func in self._callbacks:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {type}")
+            lines.append(f"{name} {_number(func())}")
+        return "\n".join(lines) + "\n"
+
+
+def _number(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, registry, name, help, labelnames):
+        self._registry = registry
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+    def _cell(self, labels, size):
+        key = (self, labels)
+        shard = self._registry._shard()
+        cell = shard.get(key)
+        if cell is None:
+            cell = shard[key] = [0] * size
+        return cell
+
+    def samples(self, cells):
+        for labels, cell in cells:
+            yield f"{self.name}{_labels(self.labelnames, labels)} {_number(cell[0])}"
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        self._cell(labels, 1)[0] += amount
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def inc(self, *labels, amount=1):
+        self._cell(labels, 1)[0] += amount
+
+    def dec(self, *labels, amount=1):
+        self._cell(labels, 1)[0] -= amount
+
+    @contextlib.contextmanager
+    def track_in_progress(self, *labels):
+        self.inc(*labels)
+        try:
+            yield
+        finally:
+            self.dec(*labels)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, registry, name, help, labelnames, buckets):
+        super().__init__(registry, name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        # Cell layout: one count per bucket, the +Inf count, then the sum.
+        cell = self._cell(labels, len(self.buckets) + 2)
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def samples(self, cells):
+        for labels, cell in cells:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), cell):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _number(bound)
+                yield f"{self.name}_bucket{_labels(self.labelnames, labels, [('le', le)])} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(cell[-1])}"
+            yield f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}"
@@ -0,0 +1,262 @@
+import asyncio
+import contextlib
+import contextvars
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from cassette import AsyncCassetteTransport, CassetteAdapter
+
+# Upstream statuses worth retrying; anything else is returned to the caller as-is.
+RETRY_STATUSES = frozenset({500, 502, 503, 504})
+
+_deadline = contextvars.ContextVar('upstream_deadline', default=None)
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    """Bound the total time spent on upstream calls made inside the block.
+
+    Deadlines nest: an inner block can only shorten the time left, never
+    extend the deadline of the request that contains it.
+    """
+    expires_at = time.monotonic() + seconds
+    current = _deadline.get()
+    if current is not None and current < expires_at:
+        expires_at = current
+    token = _deadline.set(expires_at)
+    try:
+        yield expires_at
+    finally:
+        _deadline.reset(token)
+
+
+def time_remaining():
+    """Return the seconds left before the current deadline, or None if unbounded."""
+    expires_at = _deadline.get()
+    if expires_at is None:
+        return None
+    return expires_at - time.monotonic()
+
+
+def attempt_timeout(timeout):
+    """Clip a per-attempt timeout to the current deadline."""
+    remaining = time_remaining()
+    if remaining is None:
+        return timeout
+    if remaining <= 0:
+        raise requests.exceptions.Timeout("Upstream deadline exceeded.")
+    return min(timeout, remaining)
+
+
+def retry_delay(attempt, max_retries, backoff_factor):
+    """Return the backoff before retry ``attempt + 1``, or None if no retry should be made."""
+    if attempt >= max_retries:
+        return None
+    delay = backoff_factor * (2 ** attempt)
+    remaining = time_remaining()
+    if remaining is not None and remaining <= delay:
+        return None
+    return delay
+
+
+def record_outcome(breaker, response):
+    # 4xx responses mean upstream is up and answering; only 5xx count against it.
+    if response.status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+
+
+class OWMClient:
+    """Shared HTTP client for OpenWeatherMap with pooled keep-alive connections.
+
+    One ``requests.Session`` is reused for every call, so connections (and
+    their TLS sessions) to the API host stay open between requests. Timeouts,
+    connection errors and 5xx responses are retried with exponential backoff,
+    and every attempt is clipped to the active :func:`deadline`. An optional
+    :class:`~circuit_breaker.CircuitBreaker` sees the outcome of each call
+    after retries: exceptions and 5xx responses count as failures. An optional
+    :class:`~scheduler.UpstreamScheduler` admits each call (retries included)
+    against the API quota before it is made. With a
+    :class:`~cassette.Cassette`, responses are recorded to it or replayed
+    from it underneath all of that.
+    """
+
+    def __init__(self, pool_connections=2, pool_maxsize=10, max_retries=2, backoff_factor=0.1, breaker=None,
+                 scheduler=None, cassette=None):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.breaker = breaker
+        self.scheduler = scheduler
+        self.cassette = cassette
+        self._session = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    self._session = self._create_session()
+        return self._session
+
+    def _create_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize)
+        if self.cassette is not None:
+            adapter = CassetteAdapter(self.cassette, adapter)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def close(self):
+        """Drop pooled connections; the next call opens a fresh session."""
+        with self._lock:
+            session, self._session = self._session, None
+        if session is not None:
+            session.close()
+
+    def get(self, url, params=None, timeout=10):
+        if self.scheduler is None:
+            return self._guarded_get(url, params, timeout)
+        if self.breaker is not None and self.breaker.state == self.breaker.OPEN:
+            self.breaker.before_call() # Fail fast without spending quota
+        return self.scheduler.call(self._guarded_get, url, params, timeout)
+
+    def _guarded_get(self, url, params, timeout):
+        if self.breaker is None:
+            return self._get_with_retries(url, params, timeout)
+        self.breaker.before_call()
+        try:
+            response = self._get_with_retries(url, params, timeout)
+        except BaseException:
+            self.breaker.record_failure()
+            raise
+        record_outcome(self.breaker, response)
+        return response
+
+    def _get_with_retries(self, url, params, timeout):
+        attempt = 0
+        while True:
+            try:
+                response = self.session.get(url, params=params, timeout=attempt_timeout(timeout))
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+                delay = retry_delay(attempt, self.max_retries, self.backoff_factor)
+                if delay is None:
+                    raise
+            else:
+                delay = retry_delay(attempt, self.max_retries, self.backoff_factor)
+                if response.status_code not in RETRY_STATUSES or delay is None:
+                    return response
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+
+class AsyncResponse:
+    """The subset of ``requests.Response`` the app uses, backed by an httpx response."""
+
+    def __init__(self, response):
+        self._response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.url = str(response.url)
+
+    def json(self):
+        return self._response.json()
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} Error for url: {self.url}", response=self)
+
+
+class AsyncOWMClient:
+    """Non-blocking counterpart of :class:`OWMClient` built on ``httpx.AsyncClient``.
+
+    Retries, backoff, deadlines, the circuit breaker, the scheduler and the
+    cassette behave exactly as in the sync client, and httpx errors are re-raised as their ``requests``
+    equivalents so callers handle both clients with the same ``except``
+    clauses. httpx is only needed once this client is used.
+    """
+
+    def __init__(self, max_connections=1000, max_keepalive_connections=100, max_retries=2, backoff_factor=0.1,
+                 breaker=None, scheduler=None, cassette=None):
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.breaker = breaker
+        self.scheduler = scheduler
+        self.cassette = cassette
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import httpx
+            limits = httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+            )
+            if self.cassette is None:
+                self._client = httpx.AsyncClient(limits=limits)
+            else:
+                transport = AsyncCassetteTransport(self.cassette, httpx.AsyncHTTPTransport(limits=limits))
+                self._client = httpx.AsyncClient(transport=transport)
+        return self._client
+
+    async def aclose(self):
+        client, self._client = self._client, None
+        if client is not None:
+            await client.aclose()
+
+    async def get(self, url, params=None, timeout=10):
+        if self.scheduler is None:
+            return await self._guarded_get(url, params, timeout)
+        if self.breaker is not None and self.breaker.state == self.breaker.OPEN:
+            self.breaker.before_call() # Fail fast without spending quota
+        return await self.scheduler.call_async(self._guarded_get, url, params, timeout)
+
+    async def _guarded_get(self, url, params, timeout):
+        if self.breaker is None:
+            return await self._get_with_retries(url, params, timeout)
+        self.breaker.before_call()
+        try:
+            response = await self._get_with_retries(url, params, timeout)
+        except BaseException:
+            self.breaker.record_failure()
+            raise
+        record_outcome(self.breaker, response)
+        return response
+
+    async def _get_with_retries(self, url, params, timeout):
+        attempt = 0
+        while True:
+            try:
+                response = AsyncResponse(await self._send(url, params, attempt_timeout(timeout)))
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+                delay = retry_delay(attempt, self.max_retries, self.backoff_factor)
+                if delay is None:
+                    raise
+            else:
+                delay = retry_delay(attempt, self.max_retries, self.backoff_factor)
+                if response.status_code not in RETRY_STATUSES or delay is None:
+                    return response
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _send(self, url, params, timeout):
+        import httpx
+        try:
+            return await self.client.get(url, params=params, timeout=timeout)
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e) or "Upstream request timed out.") from e
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(str(e)) from e
+        except httpx.HTTPError as e:
+            raise requests.exceptions.RequestException(str(e)) from e
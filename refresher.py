@@ -0,0 +1,146 @@
+import heapq
+import threading
+import time
+
+from background import ProcessThread
+
+
+class Refresher:
+    """Background thread that keeps popular grid cells of a GridCache warm.
+
+    Cells are refreshed once they are ``refresh_ahead`` of the way to expiry,
+    so users keep hitting fresh entries. Cells are chosen, in this order, from:
+
+    - cells for which the cache just served a stale value (``request_refresh``)
+    - pinned cells, which are always kept warm (``pin``), and watched cells,
+      kept warm while anyone is watching them (``watch``/``unwatch``)
+    - the ``hot_size`` most requested cells (``track``), with request counts
+      halved every ``decay_period`` seconds
+
+    Every upstream refresh takes a token from ``budget``, a TokenBucket, so
+    background traffic stays within the API quota; when the bucket is empty
+    the remaining cells wait for the next pass.
+    """
+
+    def __init__(self, cache, fetch, budget, cacheable=lambda value: True, hot_size=100, min_requests=2,
+                 max_tracked=10000, refresh_ahead=0.8, interval=1.0, decay_period=60.0, clock=time.monotonic):
+        self.cache = cache
+        self.fetch = fetch
+        self.budget = budget
+        self.cacheable = cacheable
+        self.hot_size = hot_size
+        self.min_requests = min_requests
+        self.max_tracked = max_tracked
+        self.refresh_ahead = refresh_ahead
+        self.interval = interval
+        self.decay_period = decay_period
+        self._clock = clock
+        self._counts = {}
+        self._pinned = set()
+        self._watched = {} # key -> number of watchers
+        self._urgent = set()
+        self._last_decay = clock()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = ProcessThread(self._run, 'weather-refresher')
+
+    def track(self, lat, lon):
+        """Count a request for the cell containing (lat, lon)."""
+        key = self.cache.cell(lat, lon)
+        with self._lock:
+            count = self._counts.get(key)
+            if count is not None:
+                self._counts[key] = count + 1
+            elif len(self._counts) < self.max_tracked:
+                self._counts[key] = 1
+
+    def pin(self, lat, lon):
+        """Keep the cell containing (lat, lon) warm regardless of traffic."""
+        with self._lock:
+            self._pinned.add(self.cache.cell(lat, lon))
+
+    def watch(self, key):
+        """Keep cell ``key`` warm until a matching :meth:`unwatch`."""
+        with self._lock:
+            self._watched[key] = self._watched.get(key, 0) + 1
+
+    def unwatch(self, key):
+        with self._lock:
+            count = self._watched.get(key, 0) - 1
+            if count > 0:
+                self._watched[key] = count
+            else:
+                self._watched.pop(key, None)
+
+    def clear(self):
+        """Forget request counts, pinned cells and queued refreshes; watched cells are left to :meth:`unwatch`."""
+        with self._lock:
+            self._counts.clear()
+            self._pinned.clear()
+            self._urgent.clear()
+
+    def request_refresh(self, key):
+        """Queue an immediate refresh of ``key``; False if no refresher thread is running."""
+        if not self.running:
+            return False
+        with self._lock:
+            self._urgent.add(key)
+        self._wake.set()
+        return True
+
+    @property
+    def running(self):
+        return self._thread.running
+
+    def ensure_started(self):
+        self._thread.ensure_started(before_start=self._stopping.clear)
+
+    def stop(self):
+        self._stopping.set()
+        self._wake.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self.run_once()
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def due(self):
+        """Return the cells that should be refreshed now, most urgent first."""
+        with self._lock:
+            urgent, self._urgent = self._urgent, set()
+            pinned = self._pinned | set(self._watched)
+            hot = heapq.nlargest(self.hot_size, (
+                (count, key) for key, count in self._counts.items() if count >= self.min_requests
+            ))
+
+        threshold = self.refresh_ahead * self.cache.ttl
+        keys, seen = [], set()
+        for key in [*urgent, *pinned, *(key for count, key in hot)]:
+            if key in seen:
+                continue
+            seen.add(key)
+            age = self.cache.age(key)
+            if key in urgent or (age is None and key in pinned) or (age is not None and age >= threshold):
+                keys.append(key)
+        return keys
+
+    def run_once(self):
+        for key in self.due():
+            if not self.budget.try_acquire():
+                break
+            try:
+                self.cache.refresh(key, self.fetch, self.cacheable)
+            except Exception:
+                pass # Keep the loop alive; the entry stays stale and is retried on the next pass
+        self._decay()
+
+    def _decay(self):
+        now = self._clock()
+        if now - self._last_decay < self.decay_period:
+            return
+        with self._lock:
+            self._last_decay = now
+            self._counts = {key: count / 2 for key, count in self._counts.items() if count >= 1}
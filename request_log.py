@@ -0,0 +1,170 @@
+import contextvars
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+import time
+
+_current = contextvars.ContextVar('request_log', default=None)
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line: time, level, event name and the record's ``fields``."""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "event": record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', ()))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class _Listener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel) # Waits for room in a full queue instead of failing to stop
+
+
+class BackgroundHandler(logging.handlers.QueueHandler):
+    """Hands records to ``target`` on a background thread, so logging never blocks a request.
+
+    Records are queued as they are and formatted by the listener thread. When
+    ``max_queue`` records are waiting, further ones are dropped and counted
+    in ``dropped`` rather than making the caller wait. Each process starts
+    its own listener on first use, as a thread started before a fork does
+    not exist in the child.
+    """
+
+    def __init__(self, target, max_queue=10000):
+        super().__init__(queue.Queue(max_queue))
+        self.target = target
+        self.dropped = 0
+        self._listener = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def prepare(self, record):
+        return record # Formatting is left to the listener thread
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        super().emit(record)
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self.queue = queue.Queue(self.queue.maxsize) # Records copied from a parent process are its to write
+            self._listener = _Listener(self.queue, self.target, respect_handler_level=True)
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def flush(self):
+        """Write out every record queued so far; a later record starts a new listener."""
+        with self._lock:
+            listener, self._listener = self._listener, None
+            pid, self._pid = self._pid, None
+        if listener is not None and pid == os.getpid():
+            listener.stop()
+        self.target.flush()
+
+    def close(self):
+        self.flush()
+        super().close()
+
+
+class RequestLog:
+    """Structured request and upstream-call events, sampled to keep their cost down.
+
+    :meth:`begin` opens a context for the request being served; upstream
+    calls made while it is open are counted into its event and share its
+    ``request_id``. A fraction ``sample_rate`` of requests is logged with all
+    their upstream calls. Failed requests and calls, and those taking at
+    least ``slow_ms``, are logged whatever the sample says, so a latency
+    regression or an outage is never sampled away.
+
+    Events go to ``logger`` at INFO (WARNING for failures) with their data in
+    the record's ``fields``, for :class:`JSONFormatter`.
+    """
+
+    def __init__(self, logger, sample_rate=1.0, slow_ms=None):
+        self.logger = logger
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock() # Calls of one request may run on several threads
+
+    def _sampled(self):
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def begin(self, request_id=None, **fields):
+        """Open a context for the current request; pass the returned token to :meth:`end`."""
+        context = {
+            "request_id": request_id, # Generated when first logged
+            "sampled": self._sampled(),
+            "started": time.perf_counter(),
+            "fields": dict(fields, upstream_calls=0, upstream_ms=0.0),
+        }
+        return _current.set(context)
+
+    def annotate(self, **fields):
+        """Add fields to the current request's event; a no-op outside a request."""
+        context = _current.get()
+        if context is not None:
+            context["fields"].update(fields)
+
+    def _request_id(self, context):
+        if context["request_id"] is None:
+            context["request_id"] = f"{os.getpid():x}-{next(self._ids):x}"
+        return context["request_id"]
+
+    def _keep(self, sampled, duration_ms, error):
+        return sampled or error is not None or (self.slow_ms is not None and duration_ms >= self.slow_ms)
+
+    def _log(self, event, error, fields):
+        self.logger.log(logging.WARNING if error is not None else logging.INFO, event, extra={"fields": fields})
+
+    def upstream_call(self, api, duration_ms, status=None, error=None):
+        """Record one upstream call (retries included); ``error`` is an error category or None."""
+        context = _current.get()
+        if context is not None:
+            with self._lock:
+                context["fields"]["upstream_calls"] += 1
+                context["fields"]["upstream_ms"] += duration_ms
+        sampled = context["sampled"] if context is not None else self._sampled()
+        if not self._keep(sampled, duration_ms, error) or not self.logger.isEnabledFor(logging.INFO):
+            return
+        fields = {"api": api, "duration_ms": round(duration_ms, 2), "status": status, "error": error}
+        if context is not None:
+            fields["request_id"] = self._request_id(context)
+        self._log("upstream_call", error, fields)
+
+    def end(self, token, status, error=None):
+        """Close the request's context and log its event if it is kept."""
+        context = _current.get()
+        _current.reset(token)
+        duration_ms = (time.perf_counter() - context["started"]) * 1000
+        if error is None and status >= 500:
+            error = "server_error"
+        if not self._keep(context["sampled"], duration_ms, error) or not self.logger.isEnabledFor(logging.INFO):
+            return
+        fields = {"request_id": self._request_id(context), "status": status, "duration_ms": round(duration_ms, 2)}
+        fields.update(context["fields"])
+        fields["upstream_ms"] = round(fields["upstream_ms"], 2)
+        if error is not None:
+            fields["error"] = error
+        self._log("request", error, fields)
@@ -0,0 +1,260 @@
+import asyncio
+import contextlib
+import contextvars
+import email.utils
+import heapq
+import itertools
+import threading
+import time
+
+import requests
+
+from owm_client import time_remaining
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+_priority = contextvars.ContextVar('upstream_priority', default=INTERACTIVE)
+
+
+class QuotaExceededError(requests.exceptions.RequestException):
+    """Raised instead of calling upstream when the API quota has no room in time."""
+
+
+@contextlib.contextmanager
+def priority(level):
+    """Queue upstream calls made inside the block at ``level`` (INTERACTIVE or BACKGROUND)."""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def retry_after(response, default):
+    """Seconds to hold off after a 429, from its ``Retry-After`` header if it has a usable one."""
+    value = response.headers.get('Retry-After')
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+class _Pending:
+    """An admitted upstream call that identical concurrent calls wait on."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class UpstreamScheduler:
+    """Admission control that keeps upstream calls within an API quota.
+
+    Every call takes a token from ``budget``, a TokenBucket sized to the quota.
+    While none is available calls queue, interactive ones ahead of background
+    ones (see :func:`priority`) and otherwise first come, first served.
+    Interactive calls wait at most ``max_wait`` seconds and every call at most
+    until its :func:`~owm_client.deadline`; a call that cannot get a token in
+    that time, or that finds ``max_queue`` calls already waiting, raises
+    :class:`QuotaExceededError` at once so the caller can fall back to cached
+    data.
+
+    Identical calls (same URL and parameters) made while one is pending share
+    its response: blocking calls with blocking calls and coroutines with
+    coroutines, as each gets its own client's response type. A blocking and
+    an async fetch of the same weather cell are coalesced a level up, by
+    :class:`~weather_cache.GridCache`. A 429 response pauses all calls for its ``Retry-After``
+    (``retry_after`` seconds if it has none), after which the call is queued
+    again if its caller can still wait.
+    """
+
+    def __init__(self, budget, max_queue=1000, max_wait=2.0, retry_after=10.0):
+        self.budget = budget
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self._waiting = [] # Heap of (priority, sequence) tickets
+        self._sequence = itertools.count()
+        self._paused_until = 0.0
+        self._pending = {}
+        self._pending_async = {}
+        self._wakers = {} # ticket -> callback waking a coroutine waiting in _admit_async
+        self._condition = threading.Condition()
+        self.coalesced = 0
+        self.rejected = 0
+        self.throttled = 0
+
+    def queued(self):
+        return len(self._waiting)
+
+    def _enqueue(self):
+        with self._condition:
+            if len(self._waiting) >= self.max_queue:
+                self.rejected += 1
+                raise QuotaExceededError("Upstream call queue is full.")
+            ticket = (_priority.get(), next(self._sequence))
+            heapq.heappush(self._waiting, ticket)
+            return ticket
+
+    def _give_up_at(self):
+        limits = [time_remaining()]
+        if _priority.get() == INTERACTIVE:
+            limits.append(self.max_wait)
+        limits = [limit for limit in limits if limit is not None]
+        return time.monotonic() + min(limits) if limits else None
+
+    def _moved(self):
+        # Called under the condition when the head of the queue may have changed:
+        # waiting threads re-check, and so does the coroutine now at the head, if any.
+        self._condition.notify_all()
+        if self._waiting:
+            wake = self._wakers.get(self._waiting[0])
+            if wake is not None:
+                wake()
+
+    def _poll(self, ticket, give_up_at):
+        """Admit ``ticket`` (returns 0) or return how long to wait before polling again.
+
+        Called under the condition. None means "until another ticket moves".
+        """
+        now = time.monotonic()
+        if self._waiting[0] != ticket:
+            wait = None
+        elif now < self._paused_until:
+            wait = self._paused_until - now
+        elif self.budget.try_acquire():
+            heapq.heappop(self._waiting)
+            self._moved()
+            return 0
+        else:
+            wait = self.budget.wait_time()
+        if give_up_at is not None:
+            if (wait if wait is not None else 0) > give_up_at - now or now >= give_up_at:
+                self.rejected += 1
+                raise QuotaExceededError("Upstream API quota exhausted; the call could not be made in time.")
+            wait = give_up_at - now if wait is None else wait
+        return wait
+
+    def _withdraw(self, ticket):
+        with self._condition:
+            if ticket in self._waiting:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._moved()
+
+    def _admit(self):
+        ticket = self._enqueue()
+        give_up_at = self._give_up_at()
+        try:
+            with self._condition:
+                while True:
+                    wait = self._poll(ticket, give_up_at)
+                    if wait == 0:
+                        return
+                    self._condition.wait(wait)
+        except BaseException:
+            self._withdraw(ticket)
+            raise
+
+    async def _admit_async(self):
+        # Sleeps until the quota is due to have room or, behind other tickets,
+        # until woken at the head of the queue; it never polls the lock meanwhile.
+        ticket = self._enqueue()
+        give_up_at = self._give_up_at()
+        loop = asyncio.get_running_loop()
+        woken = asyncio.Event()
+
+        def wake():
+            try:
+                loop.call_soon_threadsafe(woken.set)
+            except RuntimeError:
+                pass # The loop has closed; nothing is waiting any more
+
+        try:
+            while True:
+                with self._condition:
+                    wait = self._poll(ticket, give_up_at)
+                    if wait == 0:
+                        return
+                    woken.clear()
+                    self._wakers[ticket] = wake
+                try:
+                    await asyncio.wait_for(woken.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            self._withdraw(ticket)
+            raise
+        finally:
+            with self._condition:
+                self._wakers.pop(ticket, None)
+
+    def _throttled(self, response):
+        pause = retry_after(response, self.retry_after)
+        with self._condition:
+            self.throttled += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + pause)
+
+    def call(self, send, url, params=None, timeout=10):
+        """Return ``send(url, params, timeout)`` once the quota allows it."""
+        key = (url, tuple(sorted((params or {}).items())))
+        with self._condition:
+            pending = self._pending.get(key)
+            leader = pending is None
+            if leader:
+                pending = self._pending[key] = _Pending()
+            else:
+                self.coalesced += 1
+        if not leader:
+            pending.event.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.response
+
+        try:
+            while True:
+                self._admit()
+                pending.response = send(url, params, timeout)
+                if pending.response.status_code != 429:
+                    return pending.response
+                self._throttled(pending.response)
+                pending.response.close()
+        except BaseException as e:
+            pending.error = e
+            raise
+        finally:
+            with self._condition:
+                del self._pending[key]
+            pending.event.set()
+
+    async def call_async(self, send, url, params=None, timeout=10):
+        """Coroutine version of :meth:`call`; ``send`` is awaited.
+
+        The shared call runs as a task of its own, so cancelling the caller
+        that started it leaves it running for the others.
+        """
+        key = (url, tuple(sorted((params or {}).items())))
+        task = self._pending_async.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = self._pending_async[key] = asyncio.get_running_loop().create_task(
+                self._send_async(key, send, url, params, timeout))
+        return await asyncio.shield(task)
+
+    async def _send_async(self, key, send, url, params, timeout):
+        try:
+            while True:
+                await self._admit_async()
+                response = await send(url, params, timeout)
+                if response.status_code != 429:
+                    return response
+                self._throttled(response)
+        finally:
+            del self._pending_async[key]
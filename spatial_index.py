@@ -0,0 +1,107 @@
+import math
+import threading
+from collections import OrderedDict
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance between two points, in kilometres."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class SpatialIndex:
+    """Recent observations, searchable for the nearest one within ``radius_km``.
+
+    Points are bucketed on a lat/lon grid whose rows are ``radius_km`` tall,
+    so a search only measures (haversine) the points in the buckets around
+    the query: three rows, and as many columns as the radius spans at that
+    latitude. Its cost depends on how densely points are packed, not on how
+    many there are.
+
+    Each point is stored under a caller-chosen key; adding a key again moves
+    it. Points are dropped once they are ``max_age`` seconds older than the
+    newest one, and the oldest beyond ``max_entries``.
+    """
+
+    def __init__(self, radius_km, max_age=None, max_entries=10000):
+        self.radius_km = radius_km
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self._step = math.degrees(radius_km / EARTH_RADIUS_KM) # Degrees of latitude per bucket row
+        self._columns = math.ceil(360 / self._step)
+        self._buckets = {} # (row, column) -> {key: point}
+        self._points = OrderedDict() # key -> (lat, lon, value, stored_at, bucket), oldest first
+        self._lock = threading.Lock()
+
+    def _bucket(self, lat, lon):
+        return (math.floor(lat / self._step), math.floor((lon + 180) / self._step) % self._columns)
+
+    def _remove(self, key):
+        point = self._points.pop(key, None)
+        if point is not None:
+            bucket = self._buckets[point[4]]
+            del bucket[key]
+            if not bucket:
+                del self._buckets[point[4]]
+
+    def add(self, key, lat, lon, value, stored_at):
+        with self._lock:
+            self._remove(key)
+            bucket = self._bucket(lat, lon)
+            self._points[key] = point = (lat, lon, value, stored_at, bucket)
+            self._buckets.setdefault(bucket, {})[key] = point
+            while len(self._points) > self.max_entries:
+                self._remove(next(iter(self._points)))
+            if self.max_age is not None:
+                # Points are added in time order, so the expired ones are at the front.
+                while self._points and next(iter(self._points.values()))[3] <= stored_at - self.max_age:
+                    self._remove(next(iter(self._points)))
+
+    def remove(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def _candidate_buckets(self, lat, lon):
+        row, column = self._bucket(lat, lon)
+        # A radius spans more degrees of longitude the closer it gets to a pole.
+        edge = min(89.9, abs(lat) + self._step)
+        spread = math.ceil(1 / math.cos(math.radians(edge)))
+        if 2 * spread + 1 >= self._columns:
+            columns = range(self._columns)
+        else:
+            columns = [(column + offset) % self._columns for offset in range(-spread, spread + 1)]
+        for r in (row - 1, row, row + 1):
+            for c in columns:
+                yield (r, c)
+
+    def nearest(self, lat, lon, stored_after=None):
+        """Return (key, value, distance_km) of the closest point within the radius, or None.
+
+        Points stored at or before ``stored_after``, if given, are skipped.
+        """
+        best = None
+        best_distance = self.radius_km
+        with self._lock:
+            for bucket in self._candidate_buckets(lat, lon):
+                for key, point in self._buckets.get(bucket, {}).items():
+                    if stored_after is not None and point[3] <= stored_after:
+                        continue
+                    distance = haversine_km(lat, lon, point[0], point[1])
+                    if distance <= best_distance:
+                        best, best_distance = (key, point[2]), distance
+        if best is None:
+            return None
+        return best[0], best[1], best_distance
+
+    def clear(self):
+        with self._lock:
+            self._points.clear()
+            self._buckets.clear()
+
+    def __len__(self):
+        return len(self._points)
@@ -0,0 +1,84 @@
+document.addEventListener('DOMContentLoaded', function() {
+    const localWeatherBtn = document.getElementById('local-weather-btn');
+    const weatherDisplayDiv = document.querySelector('.weather-display');
+
+    let weatherStream = null;
+
+    function showWeather(data) {
+        if (data.error) {
+            weatherDisplayDiv.textContent = 'Error: ' + data.error;
+        } else if (data.temperature !== null && data.temperature !== undefined) {
+            let displayEmoji = data.emoji || "";
+            weatherDisplayDiv.textContent = `${data.temperature}°C ${displayEmoji}`;
+        } else {
+            weatherDisplayDiv.textContent = 'Error: Could not retrieve weather data.';
+        }
+    }
+
+    if (localWeatherBtn && weatherDisplayDiv) {
+        localWeatherBtn.addEventListener('click', function() {
+            weatherDisplayDiv.textContent = 'Fetching your location...';
+
+            if (!navigator.geolocation) {
+                weatherDisplayDiv.textContent = 'Error: Geolocation is not supported by your browser.';
+                return;
+            }
+
+            navigator.geolocation.getCurrentPosition(
+                function(position) {
+                    const lat = position.coords.latitude;
+                    const lon = position.coords.longitude;
+
+                    weatherDisplayDiv.textContent = 'Fetching weather data...';
+
+                    // GET so the browser and any edge cache can reuse the response
+                    const params = new URLSearchParams({ lat: lat, lon: lon });
+                    fetch(localWeatherBtn.dataset.weatherUrl + "?" + params)
+                    .then(response => {
+                        if (!response.ok) {
+                            return response.json().then(errData => {
+                                throw new Error(errData.error || `HTTP error! status: ${response.status}`);
+                            }).catch(() => {
+                                throw new Error(`HTTP error! status: ${response.status}`);
+                            });
+                        }
+                        return response.json();
+                    })
+                    .then(data => {
+                        showWeather(data);
+                        if (!data.error && window.EventSource && localWeatherBtn.dataset.streamUrl) {
+                            // Live updates, where the server offers them: it pushes only when the observation changes
+                            if (weatherStream) {
+                                weatherStream.close();
+                            }
+                            weatherStream = new EventSource(localWeatherBtn.dataset.streamUrl + "?" + params);
+                            weatherStream.addEventListener('weather', event => showWeather(JSON.parse(event.data)));
+                        }
+                    })
+                    .catch(error => {
+                        console.error('Fetch error:', error);
+                        weatherDisplayDiv.textContent = 'Error: ' + error.message;
+                    });
+                },
+                function(error) {
+                    let errorMessage = 'Error: Could not retrieve location. ';
+                    switch(error.code) {
+                        case error.PERMISSION_DENIED:
+                            errorMessage += "User denied the request for Geolocation.";
+                            break;
+                        case error.POSITION_UNAVAILABLE:
+                            errorMessage += "Location information is unavailable.";
+                            break;
+                        case error.TIMEOUT:
+                            errorMessage += "The request to get user location timed out.";
+                            break;
+                        case error.UNKNOWN_ERROR:
+                            errorMessage += "An unknown error occurred.";
+                            break;
+                    }
+                    weatherDisplayDiv.textContent = errorMessage;
+                }
+            );
+        });
+    }
+});
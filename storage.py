@@ -0,0 +1,28 @@
+import json
+import os
+import tempfile
+
+
+def write_bytes_atomic(path, data):
+    """Write ``data`` to ``path`` so readers never see a partial file.
+
+    The content goes to a temporary file in the same directory which is then
+    renamed over ``path``; the rename is atomic on POSIX and Windows.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def write_json_atomic(path, data):
+    """Write ``data`` as JSON to ``path`` atomically, as :func:`write_bytes_atomic` does."""
+    write_bytes_atomic(path, json.dumps(data).encode())
@@ -1,18 +1,36 @@
 import pytest
 import os
 import json
+import logging
+import time
+import re
+import gzip
 import requests # Added import for requests.exceptions
+from flask import render_template
 from unittest.mock import patch, MagicMock
 from app import app as flask_app # Renaming to avoid conflict
 from app import get_current_theme, set_current_theme, get_weather_for_lodz
+from app import weather_cache, geocode_cache, upstream, upstream_breaker, upstream_scheduler, rendered_pages
+from app import weather_broadcaster, gazetteer
+import app as app_module
+from ratelimit import TokenBucket
+from fake_owm import FakeOpenWeatherMap
 
 TEST_THEME_CONFIG_FILE = 'test_theme_config.json'
+TEST_GEOCODE_CACHE_FILE = 'test_geocode_cache.json'
 
 @pytest.fixture
 def app_instance(): # Changed fixture name to avoid conflict with imported 'app' module
     # Setup: Ensure the app is configured for testing
     flask_app.config['TESTING'] = True
     flask_app.config['THEME_CONFIG_FILE'] = TEST_THEME_CONFIG_FILE
+    flask_app.config['GEOCODE_CACHE_FILE'] = TEST_GEOCODE_CACHE_FILE
+    weather_cache.clear()
+    upstream_breaker.reset()
+    if os.path.exists(TEST_GEOCODE_CACHE_FILE):
+        os.remove(TEST_GEOCODE_CACHE_FILE)
+    geocode_cache.load(TEST_GEOCODE_CACHE_FILE)
+    gazetteer.clear() # Cities go to the (mocked) Geocoding API unless a test loads the gazetteer
 
     # Create an application context
     with flask_app.app_context():
@@ -22,8 +40,10 @@ def app_instance(): # Changed fixture name to avoid conflict with imported 'app'
         yield flask_app # provide the app instance
 
     # Teardown: Clean up the test file after tests if it exists
-    if os.path.exists(TEST_THEME_CONFIG_FILE):
-        os.remove(TEST_THEME_CONFIG_FILE)
+    cleanup_test_file()
+    if os.path.exists(TEST_GEOCODE_CACHE_FILE):
+        os.remove(TEST_GEOCODE_CACHE_FILE)
+    gazetteer.load(flask_app.config['GAZETTEER_FILE'])
 
 @pytest.fixture
 def client(app_instance): # Depends on the app_instance fixture
@@ -33,6 +53,8 @@ def client(app_instance): # Depends on the app_instance fixture
 def cleanup_test_file():
     if os.path.exists(TEST_THEME_CONFIG_FILE):
         os.remove(TEST_THEME_CONFIG_FILE)
+    if os.path.exists(TEST_THEME_CONFIG_FILE + '.lock'):
+        os.remove(TEST_THEME_CONFIG_FILE + '.lock')
 
 # Helper function to create test file with specific content
 def create_test_config(theme_name):
@@ -53,7 +75,7 @@ def test_get_theme_file_not_exists(app_instance):
 
 TEST_API_KEY = "test_api_key_123"
 
-@patch('app.requests.get')
+@patch('app.upstream.get')
 def test_get_weather_success(mock_get, app_instance):
     mock_geo_response = MagicMock()
     mock_geo_response.status_code = 200
@@ -75,7 +97,55 @@ def test_get_weather_success(mock_get, app_instance):
     assert result == {"temperature": 25.5, "emoji": ":)", "error": None}
     assert mock_get.call_count == 2
 
-@patch('app.requests.get')
+@patch('app.upstream.get')
+def test_get_weather_lodz_geocodes_only_once(mock_get, app_instance):
+    mock_geo_response = MagicMock()
+    mock_geo_response.status_code = 200
+    mock_geo_response.json.return_value = [{"lat": 51.7592, "lon": 19.4560}]
+
+    mock_weather_response = MagicMock()
+    mock_weather_response.status_code = 200
+    mock_weather_response.json.return_value = {"main": {"temp": 25.5}}
+
+    def side_effect_func(url, params, timeout):
+        if "geo" in url:
+            return mock_geo_response
+        return mock_weather_response
+    mock_get.side_effect = side_effect_func
+
+    with app_instance.app_context():
+        get_weather_for_lodz(TEST_API_KEY)
+        weather_cache.clear() # Force a fresh weather call
+        result = get_weather_for_lodz(TEST_API_KEY)
+
+    assert result == {"temperature": 25.5, "emoji": ":)", "error": None}
+    geo_calls = [c for c in mock_get.call_args_list if "geo" in c.args[0]]
+    assert len(geo_calls) == 1
+    assert mock_get.call_count == 3
+
+    # The geocoding result survives a restart
+    with open(TEST_GEOCODE_CACHE_FILE, 'r') as f:
+        assert json.load(f) == {"lodz,pl": [51.7592, 19.456]}
+    geocode_cache.clear()
+    geocode_cache.load(TEST_GEOCODE_CACHE_FILE)
+    assert geocode_cache.get("Lodz,PL") == (51.7592, 19.456)
+
+def test_get_weather_lodz_against_local_stub(app_instance):
+    original_api_url = app_instance.config['OPENWEATHER_API_URL']
+    with FakeOpenWeatherMap(temperature=18.0) as fake_owm:
+        app_instance.config['OPENWEATHER_API_URL'] = fake_owm.url
+        try:
+            with app_instance.app_context():
+                result = get_weather_for_lodz(TEST_API_KEY)
+        finally:
+            app_instance.config['OPENWEATHER_API_URL'] = original_api_url
+            upstream.close()
+
+    assert result == {"temperature": 18.0, "emoji": ":(", "error": None}
+    assert [path for path, params in fake_owm.requests] == ['/geo/1.0/direct', '/data/2.5/weather']
+    assert fake_owm.connections == 1 # Geocoding and weather share one keep-alive connection
+
+@patch('app.upstream.get')
 def test_get_weather_geocoding_error(mock_get, app_instance):
     mock_geo_error_response = MagicMock()
     mock_geo_error_response.status_code = 404
@@ -94,7 +164,7 @@ def test_get_weather_geocoding_error(mock_get, app_instance):
     assert mock_get.call_count == 1
 
 
-@patch('app.requests.get')
+@patch('app.upstream.get')
 def test_get_weather_weather_api_error(mock_get, app_instance):
     mock_geo_response = MagicMock()
     mock_geo_response.status_code = 200
@@ -119,7 +189,7 @@ def test_get_weather_weather_api_error(mock_get, app_instance):
     assert result["temperature"] is None
     assert mock_get.call_count == 2
 
-@patch('app.requests.get')
+@patch('app.upstream.get')
 def test_get_weather_lodz_temp_below_20(mock_get, app_instance):
     mock_geo_response = MagicMock()
     mock_geo_response.status_code = 200
@@ -141,7 +211,7 @@ def test_get_weather_lodz_temp_below_20(mock_get, app_instance):
     assert result == {"temperature": 15.0, "emoji": ":(", "error": None}
     assert mock_get.call_count == 2
 
-@patch('app.requests.get')
+@patch('app.upstream.get')
 def test_get_weather_lodz_temp_equals_20(mock_get, app_instance):
     mock_geo_response = MagicMock()
     mock_geo_response.status_code = 200
@@ -189,7 +259,7 @@ def test_index_route_button1_click_weather_success(mock_get_weather_func, client
     else:
         os.environ['OPENWEATHER_API_KEY'] = original_env_key
 
-@patch('app.requests.get')
+@patch('app.upstream.get')
 def test_weather_by_coords_route_success(mock_get, app_instance, client):
     mock_weather_response = MagicMock()
     mock_weather_response.status_code = 200
@@ -243,6 +313,23 @@ def test_weather_by_coords_route_invalid_params(client, app_instance):
     else:
         os.environ['OPENWEATHER_API_KEY'] = original_env_key
 
+@pytest.mark.parametrize("lat, lon", [("nan", 1), (1, "inf"), (1e308, 20.0), (90.5, 20.0), (50.0, -180.5)])
+def test_weather_by_coords_route_rejects_out_of_range_coordinates(client, app_instance, lat, lon):
+    original_env_key = os.environ.get('OPENWEATHER_API_KEY')
+    os.environ['OPENWEATHER_API_KEY'] = TEST_API_KEY
+
+    with app_instance.app_context():
+        posted = client.post('/weather_by_coords', json={"lat": lat, "lon": lon})
+        queried = client.get(f'/weather_by_coords?lat={lat}&lon={lon}')
+
+    assert posted.status_code == queried.status_code == 400
+    assert posted.get_json()["error"] == "Latitude must be within ±90 and longitude within ±180."
+
+    if original_env_key is None:
+        del os.environ['OPENWEATHER_API_KEY']
+    else:
+        os.environ['OPENWEATHER_API_KEY'] = original_env_key
+
 def test_weather_by_coords_route_no_api_key(client, app_instance):
     original_env_key = os.environ.pop('OPENWEATHER_API_KEY', None) # Remove if exists
 
@@ -256,7 +343,7 @@ def test_weather_by_coords_route_no_api_key(client, app_instance):
     if original_env_key is not None: # Restore only if it was originally set
         os.environ['OPENWEATHER_API_KEY'] = original_env_key
 
-@patch('app.requests.get')
+@patch('app.upstream.get')
 def test_weather_by_coords_route_api_error(mock_get, app_instance, client):
     mock_api_error_response = MagicMock()
     mock_api_error_response.status_code = 503
@@ -325,3 +412,562 @@ def test_set_theme(app_instance):
         config = json.load(f)
     assert config == {"theme": "light"}
     cleanup_test_file()
+
+@patch('app.upstream.get')
+def test_weather_by_coords_route_uses_grid_cache(mock_get, app_instance, client):
+    mock_weather_response = MagicMock()
+    mock_weather_response.status_code = 200
+    mock_weather_response.json.return_value = {"main": {"temp": 15.0}}
+    mock_get.return_value = mock_weather_response
+
+    original_env_key = os.environ.get('OPENWEATHER_API_KEY')
+    os.environ['OPENWEATHER_API_KEY'] = TEST_API_KEY
+
+    with app_instance.app_context():
+        first = client.post('/weather_by_coords', json={"lat": 50.0, "lon": 20.0})
+        # A few hundred meters away, same 0.01 degree cell
+        second = client.post('/weather_by_coords', json={"lat": 50.001, "lon": 20.002})
+        stats = client.get('/weather_by_coords/cache_stats').get_json()
+
+    assert first.get_json() == second.get_json() == {"temperature": 15.0, "emoji": ":(", "error": None}
+    assert mock_get.call_count == 1
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+
+    if original_env_key is None:
+        del os.environ['OPENWEATHER_API_KEY']
+    else:
+        os.environ['OPENWEATHER_API_KEY'] = original_env_key
+
+@patch('app.upstream.get')
+def test_weather_by_coords_errors_not_cached(mock_get, app_instance, client):
+    mock_api_error_response = MagicMock()
+    mock_api_error_response.status_code = 503
+    mock_api_error_response.raise_for_status.side_effect = requests.exceptions.HTTPError(response=mock_api_error_response)
+    mock_get.return_value = mock_api_error_response
+
+    original_env_key = os.environ.get('OPENWEATHER_API_KEY')
+    os.environ['OPENWEATHER_API_KEY'] = TEST_API_KEY
+
+    with app_instance.app_context():
+        client.post('/weather_by_coords', json={"lat": 50.0, "lon": 20.0})
+        client.post('/weather_by_coords', json={"lat": 50.0, "lon": 20.0})
+
+    assert mock_get.call_count == 2
+
+    if original_env_key is None:
+        del os.environ['OPENWEATHER_API_KEY']
+    else:
+        os.environ['OPENWEATHER_API_KEY'] = original_env_key
+
+@patch('app.upstream.get')
+def test_weather_by_coords_batch_route(mock_get, app_instance, client):
+    def side_effect_func(url, params, timeout):
+        response = MagicMock()
+        response.status_code = 200
+        response.json.return_value = {"main": {"temp": params["lat"]}} # Echo latitude as temperature
+        return response
+    mock_get.side_effect = side_effect_func
+
+    original_env_key = os.environ.get('OPENWEATHER_API_KEY')
+    os.environ['OPENWEATHER_API_KEY'] = TEST_API_KEY
+
+    points = [
+        {"lat": 30.0, "lon": 20.0},
+        {"lat": 10.0, "lon": 20.0},
+        {"lat": 30.001, "lon": 20.001}, # Same grid cell as the first point
+        {"lat": "north", "lon": 20.0},
+        "not-a-point",
+    ]
+    with app_instance.app_context():
+        response = client.post('/weather_by_coords/batch', json={"points": points})
+
+    assert response.status_code == 200
+    results = response.get_json()["results"]
+    assert results[0] == {"temperature": 30.0, "emoji": ":)", "error": None}
+    assert results[1] == {"temperature": 10.0, "emoji": ":(", "error": None}
+    assert results[2] == results[0]
+    assert "Latitude and longitude must be valid numbers" in results[3]["error"]
+    assert results[4]["error"] == "Each point must be an object with lat and lon."
+    assert mock_get.call_count == 2
+
+    if original_env_key is None:
+        del os.environ['OPENWEATHER_API_KEY']
+    else:
+        os.environ['OPENWEATHER_API_KEY'] = original_env_key
+
+@patch('app.upstream.get')
+def test_weather_by_coords_batch_route_invalid_payload(mock_get, client, app_instance):
+    mock_get.return_value.status_code = 200
+    mock_get.return_value.json.return_value = {"main": {"temp": 30.0}}
+    original_env_key = os.environ.get('OPENWEATHER_API_KEY')
+    os.environ['OPENWEATHER_API_KEY'] = TEST_API_KEY
+
+    with app_instance.app_context():
+        not_a_list = client.post('/weather_by_coords/batch', json={"points": {"lat": 50.0, "lon": 20.0}})
+        too_many = client.post('/weather_by_coords/batch', json={"points": [{"lat": 50.0, "lon": 20.0}] * 501})
+        # json.dumps writes NaN, which Flask's parser accepts; it fails that point only.
+        with_nan = client.post('/weather_by_coords/batch',
+                               json={"points": [{"lat": float("nan"), "lon": 20.0}, {"lat": 50.0, "lon": 20.0}]})
+
+    assert not_a_list.status_code == 400
+    assert "'points' list" in not_a_list.get_json()["error"]
+    assert too_many.status_code == 400
+    assert "Too many points" in too_many.get_json()["error"]
+    assert with_nan.status_code == 200
+    nan_result, valid_result = with_nan.get_json()["results"]
+    assert nan_result["temperature"] is None
+    assert "within ±90" in nan_result["error"]
+    assert valid_result == {"temperature": 30.0, "emoji": ":)", "error": None}
+    assert mock_get.call_count == 1
+
+    if original_env_key is None:
+        del os.environ['OPENWEATHER_API_KEY']
+    else:
+        os.environ['OPENWEATHER_API_KEY'] = original_env_key
+
+def test_weather_by_coords_batch_route_fetches_cells_concurrently(app_instance, client):
+    original_env_key = os.environ.get('OPENWEATHER_API_KEY')
+    os.environ['OPENWEATHER_API_KEY'] = TEST_API_KEY
+    original_api_url = app_instance.config['OPENWEATHER_API_URL']
+
+    points = [{"lat": 40.0 + i, "lon": 20.0} for i in range(8)]
+    with FakeOpenWeatherMap(latency=0.2) as fake_owm:
+        app_instance.config['OPENWEATHER_API_URL'] = fake_owm.url
+        try:
+            started = time.monotonic()
+            with app_instance.app_context():
+                response = client.post('/weather_by_coords/batch', json={"points": points})
+            elapsed = time.monotonic() - started
+        finally:
+            app_instance.config['OPENWEATHER_API_URL'] = original_api_url
+            upstream.close()
+
+    assert [r["temperature"] for r in response.get_json()["results"]] == [21.5] * 8
+    assert len(fake_owm.requests) == 8
+    assert elapsed < 0.2 * 8 / 2 # Far from serial execution
+
+    if original_env_key is None:
+        del os.environ['OPENWEATHER_API_KEY']
+    else:
+        os.environ['OPENWEATHER_API_KEY'] = original_env_key
+
+@patch('app.upstream.get')
+def test_metrics_route(mock_get, app_instance, client):
+    mock_api_error_response = MagicMock()
+    mock_api_error_response.status_code = 503
+    mock_api_error_response.raise_for_status.side_effect = requests.exceptions.HTTPError(response=mock_api_error_response)
+    mock_get.return_value = mock_api_error_response
+
+    original_env_key = os.environ.get('OPENWEATHER_API_KEY')
+    os.environ['OPENWEATHER_API_KEY'] = TEST_API_KEY
+
+    with app_instance.app_context():
+        client.get('/')
+        client.post('/weather_by_coords', json={"lat": 50.0, "lon": 20.0})
+        response = client.get('/metrics')
+
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain')
+    text = response.get_data(as_text=True)
+    assert 'http_request_duration_seconds_count{route="index",method="GET",status="200"}' in text
+    assert 'http_request_duration_seconds_count{route="weather_by_coords_route",method="POST",status="200"}' in text
+    assert 'weather_stage_duration_seconds_count{stage="render"}' in text
+    assert 'weather_stage_duration_seconds_count{stage="theme_read"}' in text
+    assert 'upstream_errors_total{api="weather",category="http_error"}' in text
+    assert 'http_requests_in_flight{route="metrics_route"} 1' in text
+    assert 'weather_cache_misses_total' in text
+
+    if original_env_key is None:
+        del os.environ['OPENWEATHER_API_KEY']
+    else:
+        os.environ['OPENWEATHER_API_KEY'] = original_env_key
+
+def test_open_circuit_serves_last_known_weather(app_instance, client):
+    original_env_key = os.environ.get('OPENWEATHER_API_KEY')
+    os.environ['OPENWEATHER_API_KEY'] = TEST_API_KEY
+
+    weather_cache.get_or_fetch(50.0, 20.0, lambda lat, lon: {"temperature": 15.0, "error": None, "emoji": ":("})
+    for _ in range(upstream_breaker.failure_threshold):
+        upstream_breaker.record_failure()
+
+    with patch.object(weather_cache, 'ttl', 0), patch.object(weather_cache, 'stale_ttl', 0):
+        with app_instance.app_context():
+            cached = client.post('/weather_by_coords', json={"lat": 50.0, "lon": 20.0})
+            uncached = client.post('/weather_by_coords', json={"lat": 10.0, "lon": 20.0})
+
+    assert cached.get_json() == {"temperature": 15.0, "emoji": ":(", "error": None, "stale": True}
+    assert uncached.get_json()["error"].startswith("Weather API request failed: Circuit breaker is open")
+
+    if original_env_key is None:
+        del os.environ['OPENWEATHER_API_KEY']
+    else:
+        os.environ['OPENWEATHER_API_KEY'] = original_env_key
+
+@patch('app.upstream.get')
+def test_weather_by_coords_get_is_cacheable_and_conditional(mock_get, app_instance, client):
+    mock_weather_response = MagicMock()
+    mock_weather_response.status_code = 200
+    mock_weather_response.json.return_value = {"main": {"temp": 15.0}}
+    mock_get.return_value = mock_weather_response
+
+    original_env_key = os.environ.get('OPENWEATHER_API_KEY')
+    os.environ['OPENWEATHER_API_KEY'] = TEST_API_KEY
+
+    with app_instance.app_context():
+        first = client.get('/weather_by_coords?lat=50.0&lon=20.0')
+        revalidated = client.get('/weather_by_coords?lat=50.001&lon=20.002', headers={'If-None-Match': first.headers['ETag']})
+
+    assert first.status_code == 200
+    assert first.get_json() == {"temperature": 15.0, "emoji": ":(", "error": None}
+    assert first.headers['Cache-Control'] in ('public, max-age=59, stale-while-revalidate=240',
+                                              'public, max-age=60, stale-while-revalidate=240')
+    assert 'Last-Modified' in first.headers
+    assert revalidated.status_code == 304 # Same cell, same observation
+    assert revalidated.get_data() == b''
+    assert mock_get.call_count == 1
+
+    if original_env_key is None:
+        del os.environ['OPENWEATHER_API_KEY']
+    else:
+        os.environ['OPENWEATHER_API_KEY'] = original_env_key
+
+@patch('app.upstream.get')
+def test_weather_by_coords_errors_are_not_stored_by_http_caches(mock_get, app_instance, client):
+    mock_get.side_effect = requests.exceptions.Timeout("timed out")
+
+    original_env_key = os.environ.get('OPENWEATHER_API_KEY')
+    os.environ['OPENWEATHER_API_KEY'] = TEST_API_KEY
+
+    with app_instance.app_context():
+        response = client.get('/weather_by_coords?lat=50.0&lon=20.0')
+
+    assert response.get_json()["error"] == "Weather API request timed out."
+    assert response.headers['Cache-Control'] == 'no-store'
+
+    if original_env_key is None:
+        del os.environ['OPENWEATHER_API_KEY']
+    else:
+        os.environ['OPENWEATHER_API_KEY'] = original_env_key
+
+def test_index_get_revalidates_on_theme(app_instance, client):
+    with app_instance.app_context():
+        first = client.get('/')
+        unchanged = client.get('/', headers={'If-None-Match': first.headers['ETag']})
+        client.post('/toggle-theme')
+        toggled = client.get('/', headers={'If-None-Match': first.headers['ETag']})
+
+    assert first.headers['Cache-Control'] == 'no-cache'
+    assert unchanged.status_code == 304
+    assert toggled.status_code == 200
+    assert b'Currently dark' in toggled.data
+
+def test_index_links_hashed_assets_served_as_immutable(app_instance, client):
+    with app_instance.app_context():
+        page = client.get('/').get_data(as_text=True)
+        stylesheet = re.search(r'href="(/assets/css/index\.[0-9a-f]+\.css)"', page).group(1)
+        script = re.search(r'src="(/assets/js/index\.[0-9a-f]+\.js)"', page).group(1)
+        css = client.get(stylesheet)
+        js = client.get(script)
+        outdated = client.get('/assets/css/index.000000000000.css')
+
+    assert '<style>' not in page and 'navigator.geolocation' not in page
+    assert css.status_code == 200 and b'.weather-display' in css.data
+    assert js.status_code == 200 and b'navigator.geolocation' in js.data
+    assert css.headers['Cache-Control'] == 'public, max-age=31536000, immutable'
+    assert outdated.status_code == 404
+    css.close()
+    js.close()
+
+def test_index_without_weather_is_rendered_once_per_theme(app_instance, client):
+    rendered_pages.clear()
+    with app_instance.app_context(), patch('app.render_template', wraps=render_template) as render:
+        light = client.get('/')
+        client.get('/')
+        client.post('/toggle-theme')
+        dark = client.get('/')
+        client.get('/')
+
+    assert render.call_count == 2 # One render per theme variant
+    assert b'Currently light' in light.data
+    assert b'Currently dark' in dark.data
+
+def test_assets_are_served_precompressed_when_accepted(app_instance, client):
+    with app_instance.app_context():
+        page = client.get('/').get_data(as_text=True)
+        stylesheet = re.search(r'href="(/assets/css/index\.[0-9a-f]+\.css)"', page).group(1)
+        compressed = client.get(stylesheet, headers={'Accept-Encoding': 'gzip, deflate'})
+        plain = client.get(stylesheet)
+
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert compressed.content_type.startswith('text/css')
+    assert gzip.decompress(compressed.data) == plain.data
+    assert 'Content-Encoding' not in plain.headers
+    assert compressed.headers['Vary'] == plain.headers['Vary'] == 'Accept-Encoding'
+    compressed.close()
+    plain.close()
+
+def test_exhausted_quota_serves_last_known_weather(app_instance, client):
+    original_env_key = os.environ.get('OPENWEATHER_API_KEY')
+    os.environ['OPENWEATHER_API_KEY'] = TEST_API_KEY
+
+    weather_cache.get_or_fetch(50.0, 20.0, lambda lat, lon: {"temperature": 15.0, "error": None, "emoji": ":("})
+    no_quota = TokenBucket(rate=0.001, capacity=0)
+
+    with patch.object(weather_cache, 'ttl', 0), patch.object(weather_cache, 'stale_ttl', 0), \
+            patch.object(upstream_scheduler, 'budget', no_quota), \
+            patch.object(upstream, '_get_with_retries') as mock_get:
+        with app_instance.app_context():
+            cached = client.post('/weather_by_coords', json={"lat": 50.0, "lon": 20.0})
+            uncached = client.post('/weather_by_coords', json={"lat": 10.0, "lon": 20.0})
+
+    assert mock_get.call_count == 0
+    assert cached.get_json() == {"temperature": 15.0, "emoji": ":(", "error": None, "stale": True}
+    assert uncached.get_json()["error"].startswith("Weather API request failed: Upstream API quota exhausted")
+
+    if original_env_key is None:
+        del os.environ['OPENWEATHER_API_KEY']
+    else:
+        os.environ['OPENWEATHER_API_KEY'] = original_env_key
+
+@patch('app.upstream.get')
+def test_weather_stream_pushes_changed_observations(mock_get, app_instance, client):
+    mock_weather_response = MagicMock()
+    mock_weather_response.status_code = 200
+    mock_weather_response.json.return_value = {"main": {"temp": 15.0}}
+    mock_get.return_value = mock_weather_response
+
+    original_env_key = os.environ.get('OPENWEATHER_API_KEY')
+    os.environ['OPENWEATHER_API_KEY'] = TEST_API_KEY
+
+    with app_instance.app_context():
+        response = client.get('/weather/stream?lat=50.0&lon=20.0', buffered=False)
+        events = iter(response.response)
+        first = next(events)
+        assert weather_broadcaster.subscriber_count() == 1
+        weather_cache.refresh(weather_cache.cell(50.0, 20.0), lambda lat, lon: {"temperature": 25.0, "error": None, "emoji": ":)"})
+        second = next(events)
+        ended = next(events, None) # A stream served by Flask ends after one update
+
+    assert response.mimetype == 'text/event-stream'
+    assert first.startswith(b'event: weather\ndata: ') and first.endswith(b'\n\n')
+    assert json.loads(first.split(b'data: ')[1]) == {"temperature": 15.0, "emoji": ":(", "error": None}
+    assert json.loads(second.split(b'data: ')[1]) == {"temperature": 25.0, "emoji": ":)", "error": None}
+    assert ended is None
+    assert weather_broadcaster.subscriber_count() == 0
+    assert mock_get.call_count == 1
+
+    if original_env_key is None:
+        del os.environ['OPENWEATHER_API_KEY']
+    else:
+        os.environ['OPENWEATHER_API_KEY'] = original_env_key
+
+@patch('app.upstream.get')
+def test_weather_stream_served_by_flask_ends_after_its_wait(mock_get, app_instance, client):
+    mock_get.return_value.status_code = 200
+    mock_get.return_value.json.return_value = {"main": {"temp": 15.0}}
+    original_env_key = os.environ.get('OPENWEATHER_API_KEY')
+    os.environ['OPENWEATHER_API_KEY'] = TEST_API_KEY
+    app_instance.config['WEATHER_STREAM_WAIT'] = 0.05
+
+    with app_instance.app_context():
+        response = client.get('/weather/stream?lat=50.0&lon=20.0')
+
+    assert response.get_data().count(b'event: weather') == 1
+    assert weather_broadcaster.subscriber_count() == 0
+
+    app_instance.config['WEATHER_STREAM_WAIT'] = 15
+    if original_env_key is None:
+        del os.environ['OPENWEATHER_API_KEY']
+    else:
+        os.environ['OPENWEATHER_API_KEY'] = original_env_key
+
+@patch('app.upstream.get')
+def test_weather_stream_head_request_subscribes_nothing(mock_get, app_instance, client):
+    mock_get.return_value.status_code = 200
+    mock_get.return_value.json.return_value = {"main": {"temp": 15.0}}
+    original_env_key = os.environ.get('OPENWEATHER_API_KEY')
+    os.environ['OPENWEATHER_API_KEY'] = TEST_API_KEY
+
+    with app_instance.app_context():
+        responses = [client.head('/weather/stream?lat=50.0&lon=20.0') for _ in range(3)]
+        unread = client.get('/weather/stream?lat=50.0&lon=20.0', buffered=False)
+        unread.close()
+
+    assert all(response.status_code == 200 for response in responses)
+    assert weather_broadcaster.subscriber_count() == 0 # So the refresher watches no cell for them
+
+    if original_env_key is None:
+        del os.environ['OPENWEATHER_API_KEY']
+    else:
+        os.environ['OPENWEATHER_API_KEY'] = original_env_key
+
+def test_page_subscribes_to_live_updates_only_when_enabled(app_instance, client):
+    rendered_pages.clear()
+    with app_instance.app_context():
+        default = client.get('/')
+        app_instance.config['WEATHER_STREAM_LIVE'] = True
+        rendered_pages.clear()
+        live = client.get('/')
+    app_instance.config['WEATHER_STREAM_LIVE'] = False
+    rendered_pages.clear()
+
+    assert b'data-stream-url' not in default.data
+    assert b'data-stream-url="/weather/stream"' in live.data
+
+def test_warm_up_prepares_the_first_response(app_instance, client):
+    rendered_pages.clear()
+    with patch('app.render_template', wraps=render_template) as render:
+        app_module.warm_up()
+        warmed = render.call_count
+        with app_instance.app_context():
+            response = client.get('/')
+
+    assert warmed == 2 # Default page in both themes
+    assert render.call_count == warmed # Served without rendering
+    assert response.status_code == 200
+
+@patch('app.upstream.get')
+def test_get_weather_lodz_resolves_from_gazetteer_without_geocoding(mock_get, app_instance):
+    mock_weather_response = MagicMock()
+    mock_weather_response.status_code = 200
+    mock_weather_response.json.return_value = {"main": {"temp": 25.5}}
+    mock_get.return_value = mock_weather_response
+    gazetteer.load(flask_app.config['GAZETTEER_FILE'])
+
+    with app_instance.app_context():
+        result = get_weather_for_lodz(TEST_API_KEY)
+
+    assert result == {"temperature": 25.5, "emoji": ":)", "error": None}
+    assert [c.args[0] for c in mock_get.call_args_list] == [flask_app.config['OPENWEATHER_API_URL'] + "/data/2.5/weather"]
+
+@patch('app.upstream.get')
+def test_weather_by_city_falls_back_to_geocoding_once(mock_get, app_instance, client):
+    mock_geo_response = MagicMock()
+    mock_geo_response.status_code = 200
+    mock_geo_response.json.return_value = [{"lat": 50.2945, "lon": 18.6714}]
+
+    mock_weather_response = MagicMock()
+    mock_weather_response.status_code = 200
+    mock_weather_response.json.return_value = {"main": {"temp": 15.0}}
+
+    def side_effect_func(url, params, timeout):
+        if "geo" in url:
+            return mock_geo_response
+        return mock_weather_response
+    mock_get.side_effect = side_effect_func
+
+    original_env_key = os.environ.get('OPENWEATHER_API_KEY')
+    os.environ['OPENWEATHER_API_KEY'] = TEST_API_KEY
+
+    with app_instance.app_context():
+        first = client.get('/weather_by_city?name=Gliwice&country=PL')
+        weather_cache.clear()
+        second = client.get('/weather_by_city?name=gliwice&country=pl')
+        missing = client.get('/weather_by_city')
+
+    assert first.status_code == second.status_code == 200
+    assert first.get_json() == second.get_json() == {"temperature": 15.0, "emoji": ":(", "error": None}
+    assert first.headers['Cache-Control'].startswith('public, max-age=')
+    geo_calls = [c for c in mock_get.call_args_list if "geo" in c.args[0]]
+    assert len(geo_calls) == 1
+    assert geo_calls[0].kwargs['params']['q'] == "Gliwice,PL"
+    assert geocode_cache.get("Gliwice,PL") == (50.2945, 18.6714)
+    assert missing.status_code == 400
+
+    if original_env_key is None:
+        del os.environ['OPENWEATHER_API_KEY']
+    else:
+        os.environ['OPENWEATHER_API_KEY'] = original_env_key
+
+@patch('app.upstream.get')
+def test_weather_by_city_geocoding_error_is_not_stored(mock_get, app_instance, client):
+    mock_geo_response = MagicMock()
+    mock_geo_response.status_code = 200
+    mock_geo_response.json.return_value = []
+    mock_get.return_value = mock_geo_response
+
+    original_env_key = os.environ.get('OPENWEATHER_API_KEY')
+    os.environ['OPENWEATHER_API_KEY'] = TEST_API_KEY
+
+    with app_instance.app_context():
+        response = client.get('/weather_by_city?name=Atlantis')
+
+    assert response.get_json()["error"] == "City (Atlantis) not found by Geocoding API."
+    assert response.headers['Cache-Control'] == 'no-store'
+    assert geocode_cache.get("Atlantis") is None
+
+    if original_env_key is None:
+        del os.environ['OPENWEATHER_API_KEY']
+    else:
+        os.environ['OPENWEATHER_API_KEY'] = original_env_key
+
+@patch('app.upstream.get')
+def test_cities_autocomplete_uses_the_gazetteer_only(mock_get, app_instance, client):
+    gazetteer.load(flask_app.config['GAZETTEER_FILE'])
+    with app_instance.app_context():
+        response = client.get('/cities?q=wa')
+        polish = client.get('/cities?q=L&country=PL')
+
+    assert response.status_code == 200
+    assert response.get_json()["cities"][0] == {"name": "Warszawa", "country": "PL", "lat": 52.2297, "lon": 21.0122}
+    assert [city["name"] for city in polish.get_json()["cities"]] == ["Łódź", "Lublin"]
+    assert mock_get.call_count == 0
+
+@patch('app.upstream.get')
+def test_requests_and_upstream_calls_are_logged(mock_get, app_instance, client):
+    mock_weather_response = MagicMock()
+    mock_weather_response.status_code = 200
+    mock_weather_response.json.return_value = {"main": {"temp": 15.0}}
+    mock_get.return_value = mock_weather_response
+
+    original_env_key = os.environ.get('OPENWEATHER_API_KEY')
+    os.environ['OPENWEATHER_API_KEY'] = TEST_API_KEY
+
+    records = []
+    collector = logging.Handler()
+    collector.emit = records.append
+    app_module.event_logger.addHandler(collector)
+    try:
+        with patch.object(app_module.request_log, 'sample_rate', 1.0), app_instance.app_context():
+            client.get('/weather_by_coords?lat=50.0&lon=20.0', headers={'X-Request-ID': 'req-1'})
+            client.get('/weather_by_coords?lat=50.0&lon=20.0')
+    finally:
+        app_module.event_logger.removeHandler(collector)
+
+    call, first, second = records
+    assert call.getMessage() == "upstream_call"
+    assert call.fields["api"] == "weather" and call.fields["status"] == 200 and call.fields["request_id"] == "req-1"
+    assert first.getMessage() == "request"
+    assert first.fields["request_id"] == "req-1"
+    assert first.fields["endpoint"] == "weather_by_coords_route"
+    assert (first.fields["status"], first.fields["cache"], first.fields["upstream_calls"]) == (200, "miss", 1)
+    assert (second.fields["cache"], second.fields["upstream_calls"]) == ("hit", 0)
+
+    if original_env_key is None:
+        del os.environ['OPENWEATHER_API_KEY']
+    else:
+        os.environ['OPENWEATHER_API_KEY'] = original_env_key
+
+def test_lodz_weather_replays_offline_from_a_cassette(app_instance, tmp_path):
+    path = tmp_path / 'cassette.jsonl'
+    path.write_text(
+        json.dumps({"url": "/geo/1.0/direct?limit=1&q=Lodz%2CPL", "status": 200, "headers": {},
+                    "body": json.dumps([{"lat": 51.7592, "lon": 19.456}]), "elapsed": 0.0}) + "\n" +
+        json.dumps({"url": "/data/2.5/weather?lat=51.76&lon=19.46&units=metric", "status": 200, "headers": {},
+                    "body": json.dumps({"main": {"temp": 12.0}}), "elapsed": 0.0}) + "\n"
+    )
+    original_api_url = flask_app.config['OPENWEATHER_API_URL']
+    flask_app.config['OPENWEATHER_API_URL'] = "http://127.0.0.1:9" # Nothing listens here
+    original_cassette = upstream.cassette
+    upstream.cassette = app_module.Cassette(str(path), app_module.Cassette.REPLAY, strict=True)
+    upstream.close() # The next session mounts the cassette
+    try:
+        with app_instance.app_context():
+            result = get_weather_for_lodz(TEST_API_KEY)
+    finally:
+        upstream.cassette = original_cassette
+        upstream.close()
+        flask_app.config['OPENWEATHER_API_URL'] = original_api_url
+
+    assert result == {"temperature": 12.0, "emoji": ":(", "error": None}
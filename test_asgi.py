@@ -0,0 +1,154 @@
+import asyncio
+import os
+import time
+import pytest
+
+httpx = pytest.importorskip("httpx")
+pytest.importorskip("asgiref")
+
+import asgi
+from app import app as flask_app, weather_cache, geocode_cache, gazetteer, upstream_breaker
+from fake_owm import FakeOpenWeatherMap
+
+TEST_API_KEY = "test_api_key_123"
+TEST_GEOCODE_CACHE_FILE = 'test_geocode_cache.json'
+TEST_THEME_CONFIG_FILE = 'test_theme_config.json'
+
+@pytest.fixture
+def fake_owm():
+    original_api_url = flask_app.config['OPENWEATHER_API_URL']
+    flask_app.config['THEME_CONFIG_FILE'] = TEST_THEME_CONFIG_FILE
+    original_env_key = os.environ.get('OPENWEATHER_API_KEY')
+    os.environ['OPENWEATHER_API_KEY'] = TEST_API_KEY
+    weather_cache.clear()
+    upstream_breaker.reset()
+    geocode_cache.load(TEST_GEOCODE_CACHE_FILE)
+    gazetteer.clear() # Exercise the Geocoding API path
+    with FakeOpenWeatherMap() as server:
+        flask_app.config['OPENWEATHER_API_URL'] = server.url
+        yield server
+    flask_app.config['OPENWEATHER_API_URL'] = original_api_url
+    weather_cache.clear()
+    gazetteer.load(flask_app.config['GAZETTEER_FILE'])
+    for path in (TEST_GEOCODE_CACHE_FILE, TEST_THEME_CONFIG_FILE, TEST_THEME_CONFIG_FILE + '.lock'):
+        if os.path.exists(path):
+            os.remove(path)
+    if original_env_key is None:
+        del os.environ['OPENWEATHER_API_KEY']
+    else:
+        os.environ['OPENWEATHER_API_KEY'] = original_env_key
+
+def run(*requests):
+    # Sends the given (method, path, kwargs) requests concurrently through the ASGI app.
+    async def main():
+        transport = httpx.ASGITransport(app=asgi.application)
+        try:
+            async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+                return await asyncio.gather(*(client.request(method, path, **kwargs) for method, path, kwargs in requests))
+        finally:
+            await asgi.async_upstream.aclose()
+    return asyncio.run(main())
+
+def test_weather_by_coords(fake_owm):
+    response, = run(('POST', '/weather_by_coords', {"json": {"lat": 50.0, "lon": 20.0}}))
+    assert response.status_code == 200
+    assert response.json() == {"temperature": 21.5, "emoji": ":)", "error": None}
+
+def test_weather_by_coords_get_is_cacheable_and_conditional(fake_owm):
+    first, = run(('GET', '/weather_by_coords?lat=50.0&lon=20.0', {}))
+    revalidated, = run(('GET', '/weather_by_coords?lat=50.001&lon=20.002', {"headers": {"If-None-Match": first.headers['ETag']}}))
+    assert first.status_code == 200
+    assert first.json() == {"temperature": 21.5, "emoji": ":)", "error": None}
+    assert first.headers['Cache-Control'].startswith('public, max-age=')
+    assert 'Last-Modified' in first.headers
+    assert revalidated.status_code == 304 # Same cell, same observation
+    assert revalidated.content == b''
+    assert revalidated.headers['ETag'] == first.headers['ETag']
+    assert len(fake_owm.requests) == 1
+
+def test_weather_by_coords_invalid_params(fake_owm):
+    response, = run(('POST', '/weather_by_coords', {"json": {"lat": "not-a-number", "lon": 20.0}}))
+    assert response.status_code == 400
+    assert "Latitude and longitude must be valid numbers" in response.json()["error"]
+
+def test_weather_by_coords_upstream_error(fake_owm):
+    fake_owm.fail_with = [401]
+    response, = run(('POST', '/weather_by_coords', {"json": {"lat": 50.0, "lon": 20.0}}))
+    assert response.json()["error"] == "Weather API request failed with HTTP status: 401"
+
+def test_index_button1(fake_owm):
+    response, = run(('POST', '/', {"data": {"button1": "Click"}}))
+    assert response.status_code == 200
+    assert "21.5°C :)" in response.text
+    assert "Weather in Lodz, Poland:" in response.text
+    assert [path for path, params in fake_owm.requests] == ['/geo/1.0/direct', '/data/2.5/weather']
+
+def test_other_routes_are_served_by_flask(fake_owm):
+    get_index, button2 = run(('GET', '/', {}), ('POST', '/', {"data": {"button2": "Click"}}))
+    assert get_index.status_code == 200
+    assert "Please click a button." in get_index.text
+    assert "Button 2 was clicked!" in button2.text
+    assert fake_owm.requests == []
+
+def test_slow_upstream_calls_overlap(fake_owm):
+    fake_owm.latency = 0.3
+    points = [{"lat": 50.0 + i, "lon": 20.0} for i in range(20)]
+    started = time.monotonic()
+    responses = run(*(('POST', '/weather_by_coords', {"json": point}) for point in points[:10]),
+                    *(('GET', f'/weather_by_coords?lat={point["lat"]}&lon={point["lon"]}', {}) for point in points[10:]))
+    elapsed = time.monotonic() - started
+    assert all(r.json()["temperature"] == 21.5 for r in responses)
+    assert len(fake_owm.requests) == 20
+    assert elapsed < 0.3 * 20 / 4 # Far from serial execution
+
+def test_routes_served_by_flask_run_concurrently(fake_owm):
+    fake_owm.latency = 0.3
+    cities = [f"City{i}" for i in range(8)]
+    started = time.monotonic()
+    responses = run(*(('GET', f'/weather_by_city?name={city}&country=PL', {}) for city in cities))
+    elapsed = time.monotonic() - started
+    assert all(r.status_code == 200 for r in responses)
+    assert fake_owm.calls['/geo/1.0/direct'] == 8
+    assert elapsed < 0.3 * 8 / 2 # Serially the geocoding calls alone would take 2.4s
+
+def test_concurrent_misses_for_one_cell_are_coalesced(fake_owm):
+    fake_owm.latency = 0.1
+    responses = run(*(('POST', '/weather_by_coords', {"json": {"lat": 50.0, "lon": 20.0}}) for _ in range(10)))
+    assert all(r.json()["temperature"] == 21.5 for r in responses)
+    assert len(fake_owm.requests) == 1
+
+def test_weather_by_coords_batch(fake_owm):
+    points = [{"lat": 50.0, "lon": 20.0}, {"lat": 51.0, "lon": 20.0}, {"lat": 50.0, "lon": 20.0}, {"lat": 50.0}]
+    response, = run(('POST', '/weather_by_coords/batch', {"json": {"points": points}}))
+    results = response.json()["results"]
+    assert [r["temperature"] for r in results] == [21.5, 21.5, 21.5, None]
+    assert "Missing latitude or longitude" in results[3]["error"]
+    assert len(fake_owm.requests) == 2
+
+def test_weather_stream_ends_when_the_client_disconnects(fake_owm):
+    async def main():
+        disconnect = asyncio.Event()
+        messages = []
+
+        async def receive():
+            await disconnect.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            messages.append(message)
+            if message['type'] == 'http.response.body':
+                disconnect.set() # Hang up after the first event
+        scope = {'type': 'http', 'method': 'GET', 'path': '/weather/stream', 'query_string': b'lat=50.0&lon=20.0',
+                 'headers': []}
+        try:
+            await asyncio.wait_for(asgi.application(scope, receive, send), 5)
+        finally:
+            await asgi.async_upstream.aclose()
+        return messages
+
+    start, first = asyncio.run(main())
+    assert start['status'] == 200
+    assert (b'content-type', b'text/event-stream; charset=utf-8') in start['headers']
+    assert first['body'].startswith(b'event: weather\ndata: ')
+    assert b'"temperature":21.5' in first['body'].replace(b' ', b'')
+    assert asgi.weather_broadcaster.subscriber_count() == 0
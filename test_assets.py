@@ -0,0 +1,40 @@
+import gzip
+import hashlib
+from assets import AssetManifest
+
+
+def test_names_embed_a_hash_of_the_content(tmp_path):
+    (tmp_path / 'css').mkdir()
+    (tmp_path / 'css' / 'index.css').write_text('body { color: red; }')
+    manifest = AssetManifest(str(tmp_path), hash_length=8)
+
+    digest = hashlib.sha256(b'body { color: red; }').hexdigest()[:8]
+    assert manifest.hashed_name('css/index.css') == f'css/index.{digest}.css'
+    assert manifest.resolve(f'css/index.{digest}.css') == 'css/index.css'
+    assert manifest.resolve('css/index.css') is None
+
+def test_reload_picks_up_changed_files(tmp_path):
+    (tmp_path / 'app.js').write_text('one')
+    manifest = AssetManifest(str(tmp_path))
+    old_name = manifest.hashed_name('app.js')
+
+    (tmp_path / 'app.js').write_text('two')
+    assert manifest.hashed_name('app.js') == old_name # Scanned once
+    manifest.reload()
+    assert manifest.hashed_name('app.js') != old_name
+    assert manifest.resolve(old_name) is None
+
+def test_precompress_writes_variants_for_text_assets_only(tmp_path):
+    static = tmp_path / 'static'
+    static.mkdir()
+    (static / 'app.js').write_text('console.log("hello");\n' * 50)
+    (static / 'logo.png').write_bytes(b'\x89PNG' + bytes(range(256)) * 4)
+    manifest = AssetManifest(str(static), build_dir=str(tmp_path / 'build'))
+
+    assert manifest.precompress() >= 1
+    name = manifest.hashed_name('app.js')
+    encodings = dict(manifest.variants(name))
+    with open(encodings['gzip'], 'rb') as f:
+        assert gzip.decompress(f.read()) == ('console.log("hello");\n' * 50).encode()
+    assert manifest.variants(manifest.hashed_name('logo.png')) == []
+    assert manifest.precompress() == 0 # Existing variants are reused
@@ -0,0 +1,22 @@
+import os
+import threading
+from unittest.mock import patch
+from background import ProcessThread
+
+
+def test_thread_is_started_once_per_process():
+    release = threading.Event()
+    starts = []
+    thread = ProcessThread(lambda: (starts.append(os.getpid()), release.wait(5)), 'test-thread')
+
+    assert thread.ensure_started()
+    assert not thread.ensure_started() # Already running here
+    assert thread.running
+    with patch('background.os.getpid', return_value=os.getpid() + 1): # As in a forked child
+        assert not thread.running
+        assert thread.ensure_started(before_start=lambda: starts.append('before'))
+    release.set()
+    thread.join()
+
+    assert starts.count('before') == 1
+    assert len(starts) == 3
@@ -0,0 +1,90 @@
+import json
+import os
+import pytest
+from app import app as flask_app, geocode_cache, refresher, upstream, upstream_scheduler, weather_cache
+from benchmarks import bench_async, bench_spatial, bench_startup, loadtest
+
+
+@pytest.fixture
+def restore_app_state():
+    # The load test serves the real app in-process and points it at its own fake upstream.
+    config = dict(flask_app.config)
+    original_env_key = os.environ.get('OPENWEATHER_API_KEY')
+    geocode_path = geocode_cache.path
+    budget = upstream_scheduler.budget
+    cassette = upstream.cassette
+    yield
+    flask_app.config.update(config)
+    upstream_scheduler.budget = budget
+    upstream.cassette = cassette
+    geocode_cache.load(geocode_path)
+    upstream.close()
+    refresher.stop()
+    refresher.clear()
+    weather_cache.clear()
+    if original_env_key is None:
+        os.environ.pop('OPENWEATHER_API_KEY', None)
+    else:
+        os.environ['OPENWEATHER_API_KEY'] = original_env_key
+
+
+def test_percentile_nearest_rank():
+    values = list(range(1, 101))
+    assert loadtest.percentile(values, 0.50) == 50
+    assert loadtest.percentile(values, 0.95) == 95
+    assert loadtest.percentile(values, 0.99) == 99
+    assert loadtest.percentile([7], 0.99) == 7
+
+def test_compare_flags_regressions():
+    baseline = {"scenarios": {"coords": {"rps": 100.0, "p95_ms": 50.0}}}
+    faster = {"scenarios": {"coords": {"rps": 95.0, "p95_ms": 54.0}}}
+    slower = {"scenarios": {"coords": {"rps": 80.0, "p95_ms": 70.0}}}
+    assert loadtest.compare(faster, baseline, 0.1) == []
+    assert loadtest.compare(slower, baseline, 0.1) == ["coords: rps 100.0 -> 80.0", "coords: p95 50.0ms -> 70.0ms"]
+
+def test_loadtest_smoke(tmp_path, capsys, restore_app_state):
+    output = tmp_path / 'results.json'
+    assert loadtest.main(['--duration', '0.5', '--concurrency', '2', '--latency', '0',
+                          '--mix', 'index=1,coords=1', '--output', str(output)]) == 0
+    report = json.loads(output.read_text())
+    assert set(report["scenarios"]) == {"index", "coords"}
+    assert report["scenarios"]["coords"]["errors"] == 0
+    assert report["upstream_calls"]["/data/2.5/weather"] >= 1
+
+def test_loadtest_replays_a_cassette_offline(tmp_path, capsys, restore_app_state):
+    cassette = tmp_path / 'cassette.jsonl'
+    cassette.write_text(json.dumps({"url": "/data/2.5/weather?lat=51.76&lon=19.46&units=metric", "status": 200,
+                                    "headers": {}, "body": json.dumps({"main": {"temp": 18.0}}), "elapsed": 0.01}) + "\n")
+    output = tmp_path / 'results.json'
+    assert loadtest.main(['--duration', '0.5', '--concurrency', '2', '--mix', 'coords=1', '--spread', '0.001',
+                          '--replay', str(cassette), '--time-scale', '0', '--output', str(output)]) == 0
+    report = json.loads(output.read_text())
+    assert report["scenarios"]["coords"]["errors"] == 0
+    assert report["upstream_calls"]["/data/2.5/weather"] >= 1 # Served from the cassette
+
+def test_bench_async_smoke(tmp_path, capsys, restore_app_state):
+    pytest.importorskip("httpx")
+    pytest.importorskip("asgiref")
+    output = tmp_path / 'async.json'
+    budget = upstream_scheduler.budget
+    # More calls than the default quota's burst, which the benchmark lifts for the run.
+    assert bench_async.main(['--requests', '150', '--latency', '0', '--workers', '4', '--output', str(output)]) == 0
+    report = json.loads(output.read_text())
+    assert [result["errors"] for result in report["results"]] == [0, 0]
+    assert upstream_scheduler.budget is budget
+
+def test_bench_startup_smoke(tmp_path, capsys):
+    output = tmp_path / 'startup.json'
+    assert bench_startup.main(['--runs', '1', '--output', str(output)]) == 0
+    report = json.loads(output.read_text())
+    assert report["cold"]["status"] == report["warm"]["status"] == 200
+    assert report["warm"]["warm_up_ms"] > 0
+    assert "sqlite3" not in report["cold"]["deferred_loaded"] # Only needed by the shared cache backend
+    assert report["cold"]["gazetteer_loaded_at_import"] is False # Parsed by warm_up() or on first use
+
+def test_bench_spatial_smoke(tmp_path, capsys):
+    output = tmp_path / 'spatial.json'
+    assert bench_spatial.main(['--sizes', '100,2000', '--queries', '200', '--output', str(output)]) == 0
+    results = json.loads(output.read_text())["results"]
+    assert [result["size"] for result in results] == [100, 2000]
+    assert results[1]["hit_rate"] >= results[0]["hit_rate"]
@@ -0,0 +1,50 @@
+import threading
+from broadcast import Broadcaster, Subscription
+from weather_cache import GridCache
+
+
+def test_subscribers_get_only_changed_values():
+    cache = GridCache()
+    cache.get_or_fetch(50.0, 20.0, lambda lat, lon: {"temperature": 10.0})
+    broadcaster = Broadcaster(cache, interval=60)
+    first = Subscription({"temperature": 10.0})
+    second = Subscription({"temperature": 10.0})
+    key = broadcaster.subscribe(50.0, 20.0, first)
+    broadcaster.subscribe(50.001, 20.001, second) # Same cell
+
+    assert broadcaster.publish() == 0 # Nothing new yet
+    cache.refresh(key, lambda lat, lon: {"temperature": 12.0})
+    assert broadcaster.publish() == 2
+    assert first.wait(0) == second.wait(0) == {"temperature": 12.0}
+    assert broadcaster.publish() == 0
+    assert first.wait(0) is None
+
+def test_slow_subscribers_only_see_the_latest_value():
+    subscription = Subscription({"temperature": 10.0})
+    subscription.offer({"temperature": 11.0})
+    subscription.offer({"temperature": 12.0})
+    assert subscription.wait(0) == {"temperature": 12.0}
+    assert subscription.wait(0) is None
+
+def test_first_and_last_subscriber_hooks():
+    events = []
+    broadcaster = Broadcaster(GridCache(), on_first=lambda key: events.append(('first', key)),
+                              on_last=lambda key: events.append(('last', key)))
+    one, two = Subscription(), Subscription()
+    key = broadcaster.subscribe(50.0, 20.0, one)
+    broadcaster.subscribe(50.0, 20.0, two)
+    broadcaster.unsubscribe(key, one)
+    assert events == [('first', key)]
+    broadcaster.unsubscribe(key, two)
+    assert events == [('first', key), ('last', key)]
+    assert broadcaster.subscriber_count() == 0
+
+def test_stored_values_are_pushed_without_waiting_for_the_interval():
+    cache = GridCache()
+    broadcaster = Broadcaster(cache, interval=60)
+    cache.on_store = broadcaster.notify
+    subscription = Subscription()
+    broadcaster.subscribe(50.0, 20.0, subscription)
+
+    threading.Thread(target=cache.get_or_fetch, args=(50.0, 20.0, lambda lat, lon: {"temperature": 9.0})).start()
+    assert subscription.wait(5) == {"temperature": 9.0}
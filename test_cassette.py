@@ -0,0 +1,102 @@
+import asyncio
+import json
+import time
+import pytest
+import requests
+from cassette import Cassette, CassetteMiss
+from fake_owm import FakeOpenWeatherMap
+from owm_client import AsyncOWMClient, OWMClient, deadline
+
+UNREACHABLE = "http://127.0.0.1:9" # Replayed calls must never get this far
+
+
+def write_cassette(path, entries):
+    path.write_text(''.join(json.dumps(entry) + '\n' for entry in entries))
+    return str(path)
+
+def weather_entry(url, temp, elapsed=0.0, status=200):
+    return {"url": url, "status": status, "headers": {"Content-Type": "application/json"},
+            "body": json.dumps({"main": {"temp": temp}}), "elapsed": elapsed}
+
+
+def test_records_responses_without_the_api_key(tmp_path):
+    path = str(tmp_path / 'cassette.jsonl')
+    cassette = Cassette(path, Cassette.RECORD)
+    client = OWMClient(cassette=cassette)
+    with FakeOpenWeatherMap(latency=0.05) as fake_owm:
+        response = client.get(fake_owm.url + "/data/2.5/weather", params={"lon": 20.0, "lat": 50.0, "appid": "secret"})
+    client.close()
+    cassette.close()
+
+    assert response.json()["main"]["temp"] == 21.5
+    [entry] = [json.loads(line) for line in open(path)]
+    assert entry["url"] == "/data/2.5/weather?lat=50.0&lon=20.0"
+    assert "secret" not in open(path).read()
+    assert entry["status"] == 200
+    assert json.loads(entry["body"])["main"]["temp"] == 21.5
+    assert entry["elapsed"] >= 0.05
+    assert cassette.calls["/data/2.5/weather"] == 1
+
+def test_replays_recorded_responses_in_turn_without_network(tmp_path):
+    path = write_cassette(tmp_path / 'cassette.jsonl', [
+        weather_entry("/data/2.5/weather?lat=50.0&lon=20.0", 1.0),
+        weather_entry("/data/2.5/weather?lat=50.0&lon=20.0", 2.0),
+    ])
+    client = OWMClient(cassette=Cassette(path, Cassette.REPLAY))
+    temps = [client.get(UNREACHABLE + "/data/2.5/weather", params={"lat": 50.0, "lon": 20.0, "appid": "other"}).json()
+             for _ in range(3)]
+    assert [temp["main"]["temp"] for temp in temps] == [1.0, 2.0, 1.0]
+
+def test_unrecorded_requests_reuse_the_endpoint_unless_strict(tmp_path):
+    path = write_cassette(tmp_path / 'cassette.jsonl', [weather_entry("/data/2.5/weather?lat=50.0&lon=20.0", 1.0)])
+    params = {"lat": 10.0, "lon": 20.0}
+    client = OWMClient(cassette=Cassette(path, Cassette.REPLAY))
+    assert client.get(UNREACHABLE + "/data/2.5/weather", params=params).json()["main"]["temp"] == 1.0
+
+    strict = OWMClient(cassette=Cassette(path, Cassette.REPLAY, strict=True), max_retries=0)
+    with pytest.raises(CassetteMiss):
+        strict.get(UNREACHABLE + "/data/2.5/weather", params=params)
+    with pytest.raises(CassetteMiss):
+        strict.get(UNREACHABLE + "/geo/1.0/direct", params={"q": "Lodz"})
+
+def test_replay_timing_is_scaled_and_bounded_by_the_deadline(tmp_path):
+    path = write_cassette(tmp_path / 'cassette.jsonl', [weather_entry("/data/2.5/weather", 1.0, elapsed=0.4)])
+
+    started = time.perf_counter()
+    OWMClient(cassette=Cassette(path, Cassette.REPLAY, time_scale=0.25)).get(UNREACHABLE + "/data/2.5/weather")
+    assert 0.1 <= time.perf_counter() - started < 0.3
+
+    client = OWMClient(cassette=Cassette(path, Cassette.REPLAY), max_retries=0)
+    started = time.perf_counter()
+    with deadline(0.1), pytest.raises(requests.exceptions.Timeout):
+        client.get(UNREACHABLE + "/data/2.5/weather")
+    assert time.perf_counter() - started < 0.3
+
+def test_replayed_server_errors_are_retried(tmp_path):
+    path = write_cassette(tmp_path / 'cassette.jsonl', [
+        weather_entry("/data/2.5/weather", None, status=503),
+        weather_entry("/data/2.5/weather", 3.0),
+    ])
+    client = OWMClient(cassette=Cassette(path, Cassette.REPLAY), backoff_factor=0.01)
+    assert client.get(UNREACHABLE + "/data/2.5/weather").json()["main"]["temp"] == 3.0
+
+def test_async_client_records_and_replays(tmp_path):
+    pytest.importorskip("httpx")
+    path = str(tmp_path / 'cassette.jsonl')
+
+    async def fetch(cassette, base_url):
+        client = AsyncOWMClient(cassette=cassette)
+        try:
+            return (await client.get(base_url + "/data/2.5/weather", params={"lat": 50.0, "lon": 20.0})).json()
+        finally:
+            await client.aclose()
+
+    with FakeOpenWeatherMap(temperature=7.5) as fake_owm:
+        recorded = asyncio.run(fetch(Cassette(path, Cassette.RECORD), fake_owm.url))
+    replayed = asyncio.run(fetch(Cassette(path, Cassette.REPLAY), UNREACHABLE))
+    assert recorded == replayed
+    assert replayed["main"]["temp"] == 7.5
+
+def test_unknown_mode_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        Cassette(str(tmp_path / 'cassette.jsonl'), 'live')
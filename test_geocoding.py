@@ -0,0 +1,64 @@
+import pytest
+from geocoding import Gazetteer, normalize_name
+
+
+@pytest.fixture
+def cities(tmp_path):
+    path = tmp_path / 'cities.tsv'
+    path.write_text(
+        "# name\tcountry\tlat\tlon\tpopulation\talternate names\n"
+        "Łódź\tPL\t51.7592\t19.456\t670642\tLodz,Lodsch\n"
+        "Paris\tFR\t48.8566\t2.3522\t2148271\t\n"
+        "Paris\tUS\t33.6609\t-95.5555\t24171\t\n"
+        "Poznań\tPL\t52.4064\t16.9252\t546859\tPoznan,Posen\n"
+        "Police\tPL\t53.5521\t14.5718\t33000\t\n",
+        encoding='utf-8',
+    )
+    return Gazetteer(str(path))
+
+
+def test_normalize_name_folds_case_accents_and_punctuation():
+    assert normalize_name("Łódź") == normalize_name(" LODZ ") == "lodz"
+    assert normalize_name("Saint-Étienne") == "saint etienne"
+    assert normalize_name("New  York") == "new york"
+
+def test_lookup_matches_names_and_alternate_names(cities):
+    assert cities.lookup("lodz") == (51.7592, 19.456)
+    assert cities.lookup("Łódź", "pl") == (51.7592, 19.456)
+    assert cities.lookup("Posen") == (52.4064, 16.9252)
+    assert cities.lookup("Lodz", "DE") is None
+    assert cities.lookup("Atlantis") is None
+
+def test_lookup_prefers_the_most_populous_city_unless_a_country_is_given(cities):
+    assert cities.lookup("Paris") == (48.8566, 2.3522)
+    assert cities.lookup("Paris", "US") == (33.6609, -95.5555)
+
+def test_search_by_prefix(cities):
+    assert [city["name"] for city in cities.search("po")] == ["Poznań", "Police"]
+    assert [city["name"] for city in cities.search("PO", limit=1)] == ["Poznań"]
+    assert [city["country"] for city in cities.search("par", "us")] == ["US"]
+    assert cities.search("") == []
+
+def test_search_lists_a_city_once_when_several_names_match(cities):
+    assert cities.search("pos") == [{"name": "Poznań", "country": "PL", "lat": 52.4064, "lon": 16.9252}]
+    assert len(cities.search("lod")) == 1
+
+def test_reads_geonames_dumps(tmp_path):
+    path = tmp_path / 'cities15000.txt'
+    fields = ["3093133", "Łódź", "Lodz", "Lodsch,Lodz", "51.75", "19.46667", "P", "PPLA", "PL",
+              "", "74", "1061", "", "", "768755", "", "207", "Europe/Warsaw", "2019-09-05"]
+    path.write_text("\t".join(fields) + "\n", encoding='utf-8')
+    gazetteer = Gazetteer(str(path))
+    assert len(gazetteer) == 1
+    assert gazetteer.lookup("lodz", "PL") == (51.75, 19.46667)
+    assert gazetteer.lookup("lodsch") is None # GeoNames alternate names are not indexed
+
+def test_missing_or_cleared_gazetteer_is_empty(tmp_path, cities):
+    assert Gazetteer(str(tmp_path / 'missing.tsv')).lookup("Lodz") is None
+    cities.clear()
+    assert len(cities) == 0
+    assert cities.lookup("Lodz") is None
+
+def test_bundled_gazetteer_has_lodz():
+    from app import app
+    assert Gazetteer(app.config['GAZETTEER_FILE']).lookup("Lodz", "PL") == (51.7592, 19.456)
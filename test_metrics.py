@@ -0,0 +1,52 @@
+import gc
+import threading
+from metrics import Registry
+
+
+def test_counter_and_gauge_rendering():
+    registry = Registry()
+    errors = registry.counter('errors_total', 'Errors.', ('category',))
+    in_flight = registry.gauge('in_flight', 'In flight.')
+    errors.inc('timeout')
+    errors.inc('timeout')
+    errors.inc('http_error', amount=3)
+    with in_flight.track_in_progress():
+        assert 'in_flight 1' in registry.render()
+
+    text = registry.render()
+    assert '# TYPE errors_total counter' in text
+    assert 'errors_total{category="http_error"} 3' in text
+    assert 'errors_total{category="timeout"} 2' in text
+    assert 'in_flight 0' in text
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    latency = registry.histogram('latency_seconds', 'Latency.', ('stage',), buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        latency.observe(value, 'weather')
+
+    text = registry.render()
+    assert 'latency_seconds_bucket{stage="weather",le="0.1"} 2' in text
+    assert 'latency_seconds_bucket{stage="weather",le="1"} 3' in text
+    assert 'latency_seconds_bucket{stage="weather",le="+Inf"} 4' in text
+    assert 'latency_seconds_count{stage="weather"} 4' in text
+    assert 'latency_seconds_sum{stage="weather"} 2.65' in text
+
+def test_values_from_finished_threads_are_kept():
+    registry = Registry()
+    requests_total = registry.counter('requests_total', 'Requests.')
+    threads = [threading.Thread(target=lambda: [requests_total.inc() for _ in range(100)]) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    del threads, t
+    gc.collect()
+
+    assert 'requests_total 800' in registry.render()
+    assert registry._shards == [] # Shards of exited threads were folded in
+
+def test_callback_metrics():
+    registry = Registry()
+    registry.callback('cache_entries', 'Entries.', 'gauge', lambda: 42)
+    assert 'cache_entries 42' in registry.render()
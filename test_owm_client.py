@@ -0,0 +1,83 @@
+import time
+import pytest
+import requests
+from fake_owm import FakeOpenWeatherMap
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from owm_client import OWMClient, deadline, time_remaining
+
+
+@pytest.fixture
+def fake_owm():
+    with FakeOpenWeatherMap() as server:
+        yield server
+
+@pytest.fixture
+def client():
+    owm = OWMClient(max_retries=2, backoff_factor=0.01)
+    yield owm
+    owm.close()
+
+def test_connections_are_reused(fake_owm, client):
+    for _ in range(10):
+        response = client.get(fake_owm.url + "/data/2.5/weather", params={"lat": 50.0, "lon": 20.0})
+        assert response.json()["main"]["temp"] == 21.5
+    assert len(fake_owm.requests) == 10
+    assert fake_owm.connections == 1
+
+def test_server_errors_are_retried(fake_owm, client):
+    fake_owm.fail_with = [503, 502]
+    response = client.get(fake_owm.url + "/data/2.5/weather", params={"lat": 50.0, "lon": 20.0})
+    assert response.status_code == 200
+    assert len(fake_owm.requests) == 3
+
+def test_retries_are_bounded(fake_owm, client):
+    fake_owm.fail_with = [500, 500, 500, 500]
+    response = client.get(fake_owm.url + "/data/2.5/weather", params={"lat": 50.0, "lon": 20.0})
+    assert response.status_code == 500
+    assert len(fake_owm.requests) == 3
+
+def test_client_errors_are_not_retried(fake_owm, client):
+    fake_owm.fail_with = [401]
+    response = client.get(fake_owm.url + "/data/2.5/weather", params={"lat": 50.0, "lon": 20.0})
+    assert response.status_code == 401
+    assert len(fake_owm.requests) == 1
+
+def test_deadline_bounds_each_attempt(fake_owm, client):
+    fake_owm.latency = 0.5
+    started = time.monotonic()
+    with deadline(0.1):
+        with pytest.raises(requests.exceptions.Timeout):
+            client.get(fake_owm.url + "/data/2.5/weather", params={"lat": 50.0, "lon": 20.0}, timeout=10)
+    assert time.monotonic() - started < 0.5
+
+def test_nested_deadline_cannot_extend_outer():
+    assert time_remaining() is None
+    with deadline(1):
+        with deadline(60):
+            assert time_remaining() <= 1
+    assert time_remaining() is None
+
+def test_circuit_breaker_fails_fast_after_server_errors(fake_owm):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    client = OWMClient(max_retries=0, breaker=breaker)
+    fake_owm.fail_with = [503, 503]
+    url = fake_owm.url + "/data/2.5/weather"
+    params = {"lat": 50.0, "lon": 20.0}
+    try:
+        assert client.get(url, params=params).status_code == 503
+        assert client.get(url, params=params).status_code == 503
+        with pytest.raises(CircuitOpenError):
+            client.get(url, params=params)
+    finally:
+        client.close()
+    assert len(fake_owm.requests) == 2
+
+def test_client_errors_do_not_trip_the_breaker(fake_owm):
+    breaker = CircuitBreaker(failure_threshold=1)
+    client = OWMClient(breaker=breaker)
+    fake_owm.fail_with = [404]
+    try:
+        client.get(fake_owm.url + "/data/2.5/weather", params={"lat": 50.0, "lon": 20.0})
+    finally:
+        client.close()
+    assert breaker.state == CircuitBreaker.CLOSED
@@ -0,0 +1,106 @@
+import time
+from ratelimit import TokenBucket
+from refresher import Refresher
+from weather_cache import GridCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_refresher(clock, budget=None, **kwargs):
+    cache = GridCache(ttl=60, stale_ttl=240, clock=clock)
+    calls = []
+
+    def fetch(lat, lon):
+        calls.append((lat, lon))
+        return {"temperature": float(len(calls))}
+
+    budget = budget or TokenBucket(rate=100, capacity=100, clock=clock)
+    return Refresher(cache, fetch, budget, clock=clock, **kwargs), calls
+
+def test_stale_values_require_a_scheduled_refresh():
+    clock = FakeClock()
+    cache = GridCache(ttl=60, stale_ttl=240, clock=clock)
+    fetch = lambda lat, lon: {"temperature": clock.now}
+    cache.get_or_fetch(50.0, 20.0, fetch)
+    clock.now = 100.0
+
+    assert cache.get_or_fetch(50.0, 20.0, fetch) == {"temperature": 100.0} # No refresher: a plain miss
+    clock.now = 200.0
+    cache.on_stale = lambda key: True
+    assert cache.get_or_fetch(50.0, 20.0, fetch) == {"temperature": 100.0} # Served stale
+    clock.now = 500.0
+    assert cache.get_or_fetch(50.0, 20.0, fetch) == {"temperature": 500.0} # Too old even for stale
+    assert cache.stats()["stale_hits"] == 1
+
+def test_pinned_cells_are_fetched_and_kept_warm():
+    clock = FakeClock()
+    refresher, calls = make_refresher(clock)
+    refresher.pin(51.7592, 19.456)
+
+    refresher.run_once()
+    assert calls == [(51.76, 19.46)]
+    clock.now = 30.0
+    refresher.run_once()
+    assert len(calls) == 1 # Still fresh
+    clock.now = 48.0 # 80% of the TTL
+    refresher.run_once()
+    assert len(calls) == 2
+
+def test_only_hot_cells_are_refreshed():
+    clock = FakeClock()
+    refresher, calls = make_refresher(clock)
+    fetch = lambda lat, lon: {"temperature": 1.0}
+    for lat in (10.0, 20.0):
+        refresher.cache.get_or_fetch(lat, 0.0, fetch)
+    for _ in range(3):
+        refresher.track(10.0, 0.0)
+    refresher.track(20.0, 0.0) # Requested once: not hot
+
+    clock.now = 50.0
+    refresher.run_once()
+    assert calls == [(10.0, 0.0)]
+
+def test_refreshes_stay_within_budget():
+    clock = FakeClock()
+    refresher, calls = make_refresher(clock, budget=TokenBucket(rate=1 / 60, capacity=2, clock=clock))
+    for lat in (10.0, 20.0, 30.0, 40.0):
+        refresher.pin(lat, 0.0)
+
+    refresher.run_once()
+    assert len(calls) == 2
+    clock.now = 60.0 # One more token
+    refresher.run_once()
+    assert len(calls) == 3
+
+def test_request_counts_decay():
+    clock = FakeClock()
+    refresher, calls = make_refresher(clock, decay_period=60)
+    refresher.track(10.0, 0.0)
+    refresher.track(10.0, 0.0)
+    clock.now = 60.0
+    refresher.run_once()
+    assert refresher._counts == {refresher.cache.cell(10.0, 0.0): 1.0}
+
+def test_stale_hit_triggers_background_refresh():
+    cache = GridCache(ttl=0.5, stale_ttl=60)
+    refresher = Refresher(cache, lambda lat, lon: {"fetched_at": time.monotonic()},
+                          TokenBucket(rate=100, capacity=100), interval=60)
+    cache.on_stale = refresher.request_refresh
+    first = cache.get_or_fetch(50.0, 20.0, lambda lat, lon: {"fetched_at": 0.0})
+    refresher.ensure_started()
+    try:
+        time.sleep(0.55)
+        assert cache.get_or_fetch(50.0, 20.0, lambda lat, lon: {"fetched_at": -1.0}) == first # Stale, not a miss
+        deadline = time.monotonic() + 2
+        while cache.stats()["refreshes"] == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        refresher.stop()
+    assert cache.stats()["refreshes"] == 1
+    assert cache.get_or_fetch(50.0, 20.0, lambda lat, lon: {"fetched_at": -1.0})["fetched_at"] > 0
@@ -0,0 +1,101 @@
+import io
+import json
+import logging
+import threading
+from request_log import BackgroundHandler, JSONFormatter, RequestLog
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def make_log(sample_rate=1.0, slow_ms=None):
+    logger = logging.getLogger(f'test_request_log.{id(object())}')
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    handler = ListHandler()
+    logger.addHandler(handler)
+    return RequestLog(logger, sample_rate=sample_rate, slow_ms=slow_ms), handler.records
+
+
+def test_json_formatter_writes_one_object_per_line():
+    record = logging.LogRecord('events', logging.WARNING, __file__, 1, 'request', None, None)
+    record.fields = {"status": 502, "error": "timeout"}
+    line = JSONFormatter().format(record)
+    assert '\n' not in line
+    assert json.loads(line) == {"ts": round(record.created, 3), "level": "warning", "event": "request",
+                                "status": 502, "error": "timeout"}
+
+def test_background_handler_writes_on_another_thread():
+    stream = io.StringIO()
+    target = logging.StreamHandler(stream)
+    target.setFormatter(JSONFormatter())
+    writers = []
+    target.emit = lambda record, emit=target.emit: (writers.append(threading.current_thread()), emit(record))
+    handler = BackgroundHandler(target)
+    logger = logging.getLogger('test_request_log.background')
+    logger.propagate = False
+    logger.addHandler(handler)
+    try:
+        logger.warning('upstream_call', extra={"fields": {"api": "weather"}})
+        handler.flush()
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+    assert json.loads(stream.getvalue())["api"] == "weather"
+    assert writers and writers[0] is not threading.current_thread()
+
+def test_background_handler_drops_records_instead_of_blocking():
+    release = threading.Event()
+    target = logging.Handler()
+    target.emit = lambda record: release.wait(5)
+    handler = BackgroundHandler(target, max_queue=2)
+    record = logging.LogRecord('events', logging.INFO, __file__, 1, 'request', None, None)
+    for _ in range(10):
+        handler.handle(record)
+    assert handler.dropped >= 7 # One may already be with the blocked listener
+    release.set()
+    handler.close()
+
+def test_request_event_has_upstream_calls_and_cache_outcome():
+    log, records = make_log()
+    token = log.begin("abc", method="GET", path="/weather_by_coords")
+    log.upstream_call('weather', 12.5, status=200)
+    log.annotate(cache="miss")
+    log.end(token, 200)
+
+    call, request = records
+    assert call.getMessage() == "upstream_call"
+    assert call.fields == {"api": "weather", "duration_ms": 12.5, "status": 200, "error": None, "request_id": "abc"}
+    assert request.getMessage() == "request" and request.levelno == logging.INFO
+    assert request.fields["request_id"] == "abc"
+    assert request.fields["upstream_calls"] == 1 and request.fields["upstream_ms"] == 12.5
+    assert request.fields["cache"] == "miss"
+    assert request.fields["status"] == 200 and request.fields["duration_ms"] >= 0
+
+def test_unsampled_requests_are_logged_only_when_failed_or_slow():
+    log, records = make_log(sample_rate=0.0, slow_ms=50)
+    token = log.begin()
+    log.upstream_call('weather', 5.0, status=200)
+    log.end(token, 200)
+    assert records == []
+
+    token = log.begin()
+    log.upstream_call('weather', 80.0, status=200) # Slow
+    log.upstream_call('weather', 5.0, error="timeout")
+    log.end(token, 500)
+    assert [record.getMessage() for record in records] == ["upstream_call", "upstream_call", "request"]
+    assert records[1].levelno == records[2].levelno == logging.WARNING
+    assert records[2].fields["error"] == "server_error"
+
+def test_request_ids_are_generated_when_not_given():
+    log, records = make_log()
+    for _ in range(2):
+        log.end(log.begin(), 200)
+    first, second = (record.fields["request_id"] for record in records)
+    assert first != second
@@ -0,0 +1,154 @@
+import asyncio
+import threading
+import time
+import pytest
+from unittest.mock import patch
+from ratelimit import TokenBucket
+from scheduler import BACKGROUND, QuotaExceededError, UpstreamScheduler, priority, retry_after
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def wait_until(condition):
+    for _ in range(500):
+        if condition():
+            return
+        time.sleep(0.002)
+    raise AssertionError("condition not reached")
+
+
+def test_calls_queue_for_quota():
+    scheduler = UpstreamScheduler(TokenBucket(rate=20, capacity=1))
+    send = lambda url, params, timeout: FakeResponse()
+
+    started = time.monotonic()
+    scheduler.call(send, 'http://owm/weather', {"lat": 1})
+    scheduler.call(send, 'http://owm/weather', {"lat": 2}) # Waits ~50 ms for the next token
+    assert 0.03 < time.monotonic() - started < 1.0
+
+def test_interactive_call_fails_fast_when_quota_cannot_come_in_time():
+    scheduler = UpstreamScheduler(TokenBucket(rate=0.01, capacity=1), max_wait=1.0)
+    send = lambda url, params, timeout: FakeResponse()
+    scheduler.call(send, 'http://owm/weather', {"lat": 1})
+
+    started = time.monotonic()
+    with pytest.raises(QuotaExceededError):
+        scheduler.call(send, 'http://owm/weather', {"lat": 2})
+    assert time.monotonic() - started < 0.5 # The next token is 100 s away; no point waiting
+    assert scheduler.rejected == 1
+    assert scheduler.queued() == 0
+
+def test_interactive_calls_go_before_background_ones():
+    scheduler = UpstreamScheduler(TokenBucket(rate=5, capacity=1))
+    scheduler.budget.try_acquire() # Next token in 200 ms
+    order = []
+
+    def call(name, level):
+        with priority(level):
+            scheduler.call(lambda url, params, timeout: order.append(name) or FakeResponse(), 'http://owm/' + name)
+
+    background = threading.Thread(target=call, args=('background', BACKGROUND))
+    background.start()
+    wait_until(lambda: scheduler.queued() == 1)
+    interactive = threading.Thread(target=call, args=('interactive', 0))
+    interactive.start()
+    for t in (background, interactive):
+        t.join()
+
+    assert order == ['interactive', 'background']
+
+def test_identical_pending_calls_are_coalesced():
+    scheduler = UpstreamScheduler(TokenBucket(rate=100, capacity=100))
+    release = threading.Event()
+    sends = []
+
+    def send(url, params, timeout):
+        sends.append(url)
+        release.wait(5)
+        return FakeResponse()
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(scheduler.call(send, 'http://owm/weather', {"lat": 1})))
+        for _ in range(4)
+    ]
+    for t in threads:
+        t.start()
+    wait_until(lambda: scheduler.coalesced == 3)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert len(sends) == 1
+    assert len({id(result) for result in results}) == 1
+
+def test_queued_coroutines_wait_without_polling():
+    scheduler = UpstreamScheduler(TokenBucket(rate=100, capacity=1))
+
+    async def send(url, params, timeout):
+        return FakeResponse()
+
+    async def main():
+        return await asyncio.gather(*(scheduler.call_async(send, 'http://owm/weather', {"lat": i}) for i in range(30)))
+
+    with patch.object(scheduler, '_poll', wraps=scheduler._poll) as poll:
+        started = time.monotonic()
+        responses = asyncio.run(main())
+        elapsed = time.monotonic() - started
+
+    assert len(responses) == 30
+    assert elapsed < 1.0
+    # Each call is checked when it reaches the head of the queue and when its token
+    # is due, not every few milliseconds while it waits.
+    assert poll.call_count < 30 * 4
+
+def test_cancelling_the_first_async_caller_leaves_the_call_to_the_others():
+    scheduler = UpstreamScheduler(TokenBucket(rate=100, capacity=100))
+    release = asyncio.Event()
+    sends = []
+
+    async def send(url, params, timeout):
+        sends.append(url)
+        await release.wait()
+        return FakeResponse()
+
+    async def main():
+        leader = asyncio.ensure_future(scheduler.call_async(send, 'http://owm/weather', {"lat": 1}))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(scheduler.call_async(send, 'http://owm/weather', {"lat": 1}))
+        await asyncio.sleep(0)
+        leader.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        return leader, await follower
+
+    leader, response = asyncio.run(main())
+    assert leader.cancelled()
+    assert response.status_code == 200
+    assert len(sends) == 1
+
+def test_429_pauses_for_retry_after_then_retries():
+    scheduler = UpstreamScheduler(TokenBucket(rate=100, capacity=100))
+    responses = [FakeResponse(429, {'Retry-After': '0.1'}), FakeResponse(200)]
+    sent_at = []
+
+    def send(url, params, timeout):
+        sent_at.append(time.monotonic())
+        return responses.pop(0)
+
+    assert scheduler.call(send, 'http://owm/weather').status_code == 200
+    assert sent_at[1] - sent_at[0] >= 0.1
+    assert scheduler.throttled == 1
+
+def test_retry_after_accepts_seconds_and_http_dates():
+    assert retry_after(FakeResponse(429, {'Retry-After': '7'}), default=10) == 7.0
+    assert retry_after(FakeResponse(429, {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}), default=10) == 0.0
+    assert retry_after(FakeResponse(429), default=10) == 10
@@ -0,0 +1,67 @@
+import random
+import pytest
+from spatial_index import SpatialIndex, haversine_km
+
+
+def test_haversine_km():
+    assert haversine_km(51.7592, 19.456, 51.7592, 19.456) == 0
+    assert haversine_km(52.2297, 21.0122, 50.0647, 19.9450) == pytest.approx(252, abs=1) # Warsaw to Krakow
+    assert haversine_km(0.0, 179.99, 0.0, -179.99) == pytest.approx(2.22, abs=0.01)
+
+def test_nearest_within_radius():
+    index = SpatialIndex(radius_km=1.0)
+    index.add('a', 50.0, 20.0, {"temperature": 1.0}, stored_at=0)
+    index.add('b', 50.005, 20.0, {"temperature": 2.0}, stored_at=0)
+
+    key, value, distance = index.nearest(50.004, 20.0)
+    assert (key, value) == ('b', {"temperature": 2.0})
+    assert distance == pytest.approx(0.111, abs=0.001)
+    assert index.nearest(50.0, 20.02) is None # ~1.4 km east
+
+def test_nearest_skips_points_stored_too_long_ago():
+    index = SpatialIndex(radius_km=1.0)
+    index.add('old', 50.0, 20.0, "old", stored_at=10)
+    index.add('new', 50.008, 20.0, "new", stored_at=50)
+    assert index.nearest(50.0, 20.0)[0] == 'old'
+    assert index.nearest(50.0, 20.0, stored_after=10)[0] == 'new'
+
+def test_adding_a_key_again_moves_it():
+    index = SpatialIndex(radius_km=1.0)
+    index.add('a', 50.0, 20.0, 1, stored_at=0)
+    index.add('a', 10.0, 20.0, 2, stored_at=1)
+    assert len(index) == 1
+    assert index.nearest(50.0, 20.0) is None
+    assert index.nearest(10.0, 20.0)[1] == 2
+
+def test_old_and_excess_points_are_dropped():
+    index = SpatialIndex(radius_km=1.0, max_age=60, max_entries=3)
+    for i in range(5):
+        index.add(i, 50.0 + i, 20.0, i, stored_at=i)
+    assert len(index) == 3
+    assert index.nearest(50.0, 20.0) is None
+    index.add('late', 10.0, 20.0, 'late', stored_at=63)
+    assert len(index) == 2 # 2 made room for 'late', and 3 is now max_age older than it
+    index.remove('late')
+    index.clear()
+    assert len(index) == 0
+
+@pytest.mark.parametrize("lat", [0.0, 45.0, 70.0, 89.5, -60.0])
+def test_matches_a_linear_scan(lat):
+    rng = random.Random(lat)
+    index = SpatialIndex(radius_km=2.0)
+    points = [(lat + rng.uniform(-0.05, 0.05), rng.uniform(-180, 180) if lat > 89 else 179.97 + rng.uniform(-0.1, 0.1))
+              for _ in range(300)]
+    points = [(min(90.0, p_lat), (p_lon + 180) % 360 - 180) for p_lat, p_lon in points]
+    for i, (p_lat, p_lon) in enumerate(points):
+        index.add(i, p_lat, p_lon, i, stored_at=0)
+
+    for _ in range(50):
+        q_lat, q_lon = rng.choice(points)
+        q_lat, q_lon = min(90.0, q_lat + rng.uniform(-0.02, 0.02)), q_lon
+        in_range = [(haversine_km(q_lat, q_lon, *point), i) for i, point in enumerate(points)]
+        in_range = [item for item in in_range if item[0] <= 2.0]
+        found = index.nearest(q_lat, q_lon)
+        if not in_range:
+            assert found is None
+        else:
+            assert found[2] == pytest.approx(min(in_range)[0])
@@ -0,0 +1,53 @@
+import json
+import os
+import threading
+from unittest.mock import patch
+import pytest
+from theme_store import ThemeStore
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'theme_config.json')
+
+def write_theme(path, theme_name):
+    with open(path, 'w') as f:
+        json.dump({'theme': theme_name}, f)
+
+def test_reads_are_served_from_memory(path):
+    write_theme(path, 'dark')
+    store = ThemeStore()
+    assert store.get(path) == 'dark'
+    with patch('builtins.open', side_effect=AssertionError("file reopened")):
+        assert store.get(path) == 'dark'
+
+def test_external_writes_are_picked_up(path):
+    store = ThemeStore()
+    store.set(path, 'light')
+    assert store.get(path) == 'light'
+    write_theme(path + '.tmp', 'dark') # Another process replacing the file
+    os.replace(path + '.tmp', path)
+    assert store.get(path) == 'dark'
+
+def test_missing_or_invalid_file_raises(path):
+    store = ThemeStore()
+    with pytest.raises(FileNotFoundError):
+        store.get(path)
+    with open(path, 'w') as f:
+        f.write('{"theme": ')
+    with pytest.raises(json.JSONDecodeError):
+        store.get(path)
+
+def test_concurrent_toggles_are_serialized(path):
+    store = ThemeStore()
+    store.set(path, 'light')
+    toggle = lambda theme_name: 'dark' if theme_name == 'light' else 'light'
+    threads = [threading.Thread(target=store.update, args=(path, toggle)) for _ in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    with open(path) as f:
+        assert json.load(f) == {'theme': 'light'} # An even number of toggles, none lost
+    assert [name for name in os.listdir(os.path.dirname(path)) if name.endswith('.tmp')] == []
@@ -0,0 +1,280 @@
+import asyncio
+import threading
+import time
+import pytest
+from weather_cache import GridCache, SQLiteBackend
+from spatial_index import SpatialIndex
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_same_cell_is_served_from_cache():
+    cache = GridCache(grid=0.01, ttl=60)
+    calls = []
+
+    def fetch(lat, lon):
+        calls.append((lat, lon))
+        return {"temperature": 10.0}
+
+    assert cache.get_or_fetch(51.7592, 19.4560, fetch) == {"temperature": 10.0}
+    assert cache.get_or_fetch(51.7612, 19.4580, fetch) == {"temperature": 10.0}
+    assert calls == [(51.76, 19.46)] # Upstream is queried at the cell center
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+def test_entries_expire_after_ttl():
+    clock = FakeClock()
+    cache = GridCache(ttl=60, clock=clock)
+    calls = []
+
+    def fetch(lat, lon):
+        calls.append((lat, lon))
+        return {"temperature": float(len(calls))}
+
+    cache.get_or_fetch(50.0, 20.0, fetch)
+    clock.now = 59.0
+    assert cache.get_or_fetch(50.0, 20.0, fetch) == {"temperature": 1.0}
+    clock.now = 60.0
+    assert cache.get_or_fetch(50.0, 20.0, fetch) == {"temperature": 2.0}
+
+def test_least_recently_used_entry_is_evicted():
+    cache = GridCache(max_entries=2)
+    fetch = lambda lat, lon: {"lat": lat}
+
+    cache.get_or_fetch(1.0, 1.0, fetch)
+    cache.get_or_fetch(2.0, 2.0, fetch)
+    cache.get_or_fetch(1.0, 1.0, fetch) # Touch the first cell
+    cache.get_or_fetch(3.0, 3.0, fetch) # Evicts the second cell
+
+    stats = cache.stats()
+    assert stats["entries"] == 2
+    assert stats["evictions"] == 1
+    assert cache.peek(2.0, 2.0) is None
+    assert cache.peek(1.0, 1.0) == {"lat": 1.0}
+
+def test_uncacheable_results_are_not_stored():
+    cache = GridCache()
+    calls = []
+
+    def fetch(lat, lon):
+        calls.append(1)
+        return {"error": "boom"}
+
+    cache.get_or_fetch(50.0, 20.0, fetch, cacheable=lambda v: v["error"] is None)
+    cache.get_or_fetch(50.0, 20.0, fetch, cacheable=lambda v: v["error"] is None)
+    assert len(calls) == 2
+
+def test_concurrent_misses_trigger_a_single_fetch():
+    cache = GridCache()
+    release = threading.Event()
+    calls = []
+
+    def fetch(lat, lon):
+        calls.append(1)
+        release.wait(5)
+        return {"temperature": 12.0}
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(cache.get_or_fetch(50.0, 20.0, fetch)))
+        for _ in range(8)
+    ]
+    for t in threads:
+        t.start()
+    while cache.stats()["coalesced"] < 7:
+        time.sleep(0.001)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert results == [{"temperature": 12.0}] * 8
+
+def test_fetch_errors_propagate_to_waiting_callers():
+    cache = GridCache()
+
+    def fetch(lat, lon):
+        raise RuntimeError("upstream down")
+
+    with pytest.raises(RuntimeError):
+        cache.get_or_fetch(50.0, 20.0, fetch)
+    assert cache.stats()["entries"] == 0
+
+def test_async_miss_waits_for_a_running_refresh():
+    cache = GridCache()
+    release = threading.Event()
+    calls = []
+
+    def fetch(lat, lon):
+        calls.append("refresh")
+        release.wait(5)
+        return {"temperature": 12.0}
+
+    async def fetch_async(lat, lon):
+        calls.append("async")
+        return {"temperature": 0.0}
+
+    async def main():
+        refresh = threading.Thread(target=cache.refresh, args=(cache.cell(50.0, 20.0), fetch))
+        refresh.start()
+        while not calls:
+            await asyncio.sleep(0.001)
+        waiting = asyncio.ensure_future(cache.get_or_fetch_async(50.0, 20.0, fetch_async))
+        while cache.stats()["coalesced"] < 1:
+            await asyncio.sleep(0.001)
+        release.set()
+        result = await waiting
+        refresh.join()
+        return result
+
+    assert asyncio.run(main()) == {"temperature": 12.0}
+    assert calls == ["refresh"]
+
+def test_cancelling_the_first_async_caller_leaves_the_fetch_to_the_others():
+    cache = GridCache()
+    release = asyncio.Event()
+    calls = []
+
+    async def fetch_async(lat, lon):
+        calls.append(1)
+        await release.wait()
+        return {"temperature": 12.0}
+
+    async def main():
+        leader = asyncio.ensure_future(cache.get_or_fetch_async(50.0, 20.0, fetch_async))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(cache.get_or_fetch_async(50.0, 20.0, fetch_async))
+        await asyncio.sleep(0)
+        leader.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        return leader, await follower
+
+    leader, result = asyncio.run(main())
+    assert leader.cancelled()
+    assert result == {"temperature": 12.0}
+    assert calls == [1]
+    assert cache.stats()["entries"] == 1
+
+def test_refresh_is_skipped_while_an_async_fetch_runs():
+    cache = GridCache()
+    release = asyncio.Event()
+
+    async def fetch_async(lat, lon):
+        await release.wait()
+        return {"temperature": 12.0}
+
+    async def main():
+        fetching = asyncio.ensure_future(cache.get_or_fetch_async(50.0, 20.0, fetch_async))
+        await asyncio.sleep(0)
+        refreshed = cache.refresh(cache.cell(50.0, 20.0), lambda lat, lon: {"temperature": 0.0})
+        release.set()
+        return refreshed, await fetching
+
+    assert asyncio.run(main()) == (False, {"temperature": 12.0})
+    assert cache.stats()["refreshes"] == 0
+
+def test_sqlite_backend_is_shared_between_caches(tmp_path):
+    path = str(tmp_path / 'weather.sqlite3')
+    first = GridCache(backend=SQLiteBackend(path))
+    second = GridCache(backend=SQLiteBackend(path)) # As another worker process would
+    calls = []
+
+    def fetch(lat, lon):
+        calls.append((lat, lon))
+        return {"temperature": 10.0, "emoji": "☀️"}
+
+    first.get_or_fetch(51.7592, 19.4560, fetch)
+    assert second.get_or_fetch(51.7612, 19.4580, fetch) == {"temperature": 10.0, "emoji": "☀️"}
+    assert calls == [(51.76, 19.46)]
+    assert second.stats()["hits"] == 1
+
+def test_sqlite_backend_is_used_off_the_event_loop(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / 'weather.sqlite3'))
+    cache = GridCache(backend=backend)
+    threads = []
+    for name in ('get', 'set'):
+        method = getattr(backend, name)
+        setattr(backend, name, lambda *args, method=method: (threads.append(threading.current_thread()), method(*args))[1])
+
+    async def fetch_async(lat, lon):
+        return {"temperature": 10.0}
+
+    async def main():
+        first = await cache.get_or_fetch_async(50.0, 20.0, fetch_async)
+        return first, await cache.get_or_fetch_async(50.0, 20.0, fetch_async), threading.current_thread()
+
+    first, second, loop_thread = asyncio.run(main())
+    assert first == second == {"temperature": 10.0}
+    assert cache.stats()["hits"] == 1
+    assert threads and loop_thread not in threads
+
+def test_sqlite_backend_entries_expire_after_ttl(tmp_path):
+    clock = FakeClock()
+    cache = GridCache(ttl=60, clock=clock, backend=SQLiteBackend(str(tmp_path / 'weather.sqlite3')))
+    fetch = lambda lat, lon: {"temperature": clock.now}
+
+    cache.get_or_fetch(50.0, 20.0, fetch)
+    clock.now = 59.0
+    assert cache.get_or_fetch(50.0, 20.0, fetch) == {"temperature": 0.0}
+    clock.now = 60.0
+    assert cache.get_or_fetch(50.0, 20.0, fetch) == {"temperature": 60.0}
+
+def test_sqlite_backend_trims_old_and_excess_entries(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / 'weather.sqlite3'), max_entries=3, max_age=100, trim_every=1)
+
+    backend.set((0, 0), {"n": 0}, stored_at=0.0)
+    for n in range(1, 6):
+        backend.set((n, n), {"n": n}, stored_at=200.0 + n)
+
+    assert len(backend) == 3
+    assert backend.evictions == 3
+    assert backend.get((0, 0)) is None # Past max_age
+    assert backend.get((2, 2)) is None # Oldest beyond max_entries
+    assert backend.get((5, 5)) == ({"n": 5}, 205.0)
+
+def test_sqlite_backend_serves_concurrent_readers(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / 'weather.sqlite3'))
+    cache = GridCache(backend=backend)
+    cache.get_or_fetch(50.0, 20.0, lambda lat, lon: {"temperature": 12.0})
+    results = []
+
+    def read():
+        for _ in range(50):
+            results.append(cache.get_or_fetch(50.0, 20.0, lambda lat, lon: {"temperature": None}))
+        backend.close()
+
+    threads = [threading.Thread(target=read) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert results == [{"temperature": 12.0}] * 400
+    assert cache.stats()["hits"] == 400
+
+def test_miss_borrows_a_fresh_observation_from_a_nearby_cell():
+    clock = FakeClock()
+    cache = GridCache(grid=0.01, ttl=60, clock=clock, nearby=SpatialIndex(radius_km=1.0))
+    calls = []
+
+    def fetch(lat, lon):
+        calls.append((lat, lon))
+        return {"temperature": float(len(calls))}
+
+    cache.get_or_fetch(50.0, 20.0, fetch)
+    # Across the cell boundary, 0.6 km from the first cell's center
+    assert cache.get_or_fetch(50.0, 20.0084, fetch) == {"temperature": 1.0}
+    assert cache.get_or_fetch(50.0, 20.03, fetch) == {"temperature": 2.0} # Too far
+    assert cache.stats()["nearby_hits"] == 1
+    clock.now = 61.0
+    assert cache.get_or_fetch(50.0, 20.0084, fetch) == {"temperature": 3.0} # Too old to borrow
+    assert calls == [(50.0, 20.0), (50.0, 20.03), (50.0, 20.01)]
+    cache.clear()
+    assert len(cache.nearby) == 0
@@ -0,0 +1,82 @@
+import contextlib
+import json
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError: # Windows: only threads of this process are serialized
+    fcntl = None
+
+from storage import write_json_atomic
+
+
+class ThemeStore:
+    """The UI theme, kept in memory and persisted to a JSON file.
+
+    Reads are answered from memory while the file's stat signature (mtime,
+    size, inode) is unchanged, so a page render costs one ``stat`` instead of
+    an open/read/parse, yet writes made by other worker processes are still
+    picked up. Writes replace the file atomically under a thread lock plus an
+    ``fcntl`` lock on ``<path>.lock``, so concurrent toggles never leave a
+    partially written file behind.
+    """
+
+    def __init__(self):
+        self._path = None
+        self._signature = None
+        self._theme = None
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _stat_signature(st):
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def get(self, path):
+        """Return the stored theme; raises FileNotFoundError or JSONDecodeError like a plain read."""
+        signature = self._stat_signature(os.stat(path))
+        with self._lock:
+            if path == self._path and signature == self._signature:
+                return self._theme
+        with open(path, 'r') as f:
+            signature = self._stat_signature(os.fstat(f.fileno()))
+            theme = json.load(f).get('theme', 'light')
+        with self._lock:
+            self._path, self._signature, self._theme = path, signature, theme
+        return theme
+
+    def set(self, path, theme_name):
+        with self._locked(path):
+            self._write(path, theme_name)
+
+    def update(self, path, func, default='light'):
+        """Atomically replace the theme with ``func(current theme)`` and return the new theme."""
+        with self._locked(path):
+            try:
+                current = self.get(path)
+            except (FileNotFoundError, json.JSONDecodeError):
+                current = default
+            theme_name = func(current)
+            self._write(path, theme_name)
+        return theme_name
+
+    def _write(self, path, theme_name):
+        write_json_atomic(path, {'theme': theme_name})
+        self._path, self._signature, self._theme = path, self._stat_signature(os.stat(path)), theme_name
+
+    @contextlib.contextmanager
+    def _locked(self, path):
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(path + '.lock', 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def invalidate(self):
+        with self._lock:
+            self._path = self._signature = self._theme = None
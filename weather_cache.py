@@ -0,0 +1,472 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class _InFlight:
+    """A pending upstream fetch that concurrent callers for the same cell wait on."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+        self._wakers = [] # Callbacks of coroutines waiting on an event loop
+        self._lock = threading.Lock()
+
+    def set(self):
+        with self._lock:
+            self.event.set()
+            wakers, self._wakers = self._wakers, []
+        for wake in wakers:
+            wake()
+
+    async def wait_async(self):
+        """Wait for the fetch without blocking the event loop; returns its value or raises its error."""
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+
+        def settle():
+            if not done.done():
+                done.set_result(None)
+
+        def wake():
+            try:
+                loop.call_soon_threadsafe(settle)
+            except RuntimeError:
+                pass # The loop has closed; nobody is waiting any more
+
+        with self._lock:
+            if not self.event.is_set():
+                self._wakers.append(wake)
+            else:
+                settle()
+        await done
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class CacheBackend:
+    """Where :class:`GridCache` keeps its entries.
+
+    Keys are ``(int, int)`` grid cells and values are JSON-serializable dicts.
+    ``get`` returns ``(value, stored_at)`` or None; the value it returns belongs
+    to the caller. Backends bound their own size and count what they drop in
+    ``evictions``. Every method may be called from several threads at once.
+
+    ``blocking`` backends do I/O that may wait, so :class:`GridCache` keeps
+    their calls off the event loop.
+    """
+
+    evictions = 0
+    blocking = False
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, stored_at):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+
+class MemoryBackend(CacheBackend):
+    """Per-process entries, evicted least-recently-used beyond ``max_entries``."""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (value, stored_at)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return dict(entry[0]), entry[1]
+
+    def set(self, key, value, stored_at):
+        with self._lock:
+            self._entries[key] = (dict(value), stored_at)
+            self._entries.move_to_end(key)
+            # Expired entries are kept for stale serving and reclaimed by LRU eviction.
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteBackend(CacheBackend):
+    """Entries in a SQLite file that every worker process on the host shares.
+
+    The database runs in WAL mode, so readers never block each other or the
+    writer, and each thread keeps its own connection (reopened after a fork).
+    Every ``trim_every`` writes, entries older than ``max_age`` seconds are
+    deleted and then the oldest ones until at most ``max_entries`` remain; in
+    between the table may briefly grow past the bound. Eviction is by age
+    rather than recency because recording reads would turn them into writes.
+    ``stored_at`` must come from a clock all processes agree on. ``sqlite3``
+    is only imported once this backend is used.
+    """
+
+    blocking = True # A write may wait up to ``timeout`` for another process's lock
+
+    def __init__(self, path, max_entries=10000, max_age=None, trim_every=100, timeout=5.0):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.trim_every = trim_every
+        self.timeout = timeout
+        self.evictions = 0
+        self._writes = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # Create the schema on a throwaway connection, so a preforking master
+        # does not hand an open database to its workers.
+        connection = self._connect()
+        try:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS weather_cache ("
+                " lat INTEGER NOT NULL, lon INTEGER NOT NULL, value TEXT NOT NULL, stored_at REAL NOT NULL,"
+                " PRIMARY KEY (lat, lon)) WITHOUT ROWID"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS weather_cache_stored_at ON weather_cache (stored_at)")
+        finally:
+            connection.close()
+
+    def _connect(self):
+        import sqlite3
+        connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL") # A crash may lose recent entries, never corrupt the file
+        return connection
+
+    @property
+    def connection(self):
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.connection = self._connect()
+            local.pid = os.getpid()
+        return local.connection
+
+    def get(self, key):
+        row = self.connection.execute(
+            "SELECT value, stored_at FROM weather_cache WHERE lat = ? AND lon = ?", key).fetchone()
+        return None if row is None else (json.loads(row[0]), row[1])
+
+    def set(self, key, value, stored_at):
+        import sqlite3
+        try:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO weather_cache (lat, lon, value, stored_at) VALUES (?, ?, ?, ?)",
+                (*key, json.dumps(value), stored_at),
+            )
+        except sqlite3.OperationalError:
+            return # Database busy past the timeout; the value just is not cached
+        with self._lock:
+            self._writes += 1
+            due = self._writes % self.trim_every == 0
+        if due:
+            self.trim(stored_at)
+
+    def trim(self, now):
+        """Apply ``max_age`` and ``max_entries`` now; returns the number of entries deleted."""
+        import sqlite3
+        connection = self.connection
+        deleted = 0
+        try:
+            if self.max_age is not None:
+                deleted += connection.execute(
+                    "DELETE FROM weather_cache WHERE stored_at < ?", (now - self.max_age,)).rowcount
+            excess = len(self) - self.max_entries
+            if excess > 0:
+                deleted += connection.execute(
+                    "DELETE FROM weather_cache WHERE (lat, lon) IN"
+                    " (SELECT lat, lon FROM weather_cache ORDER BY stored_at LIMIT ?)", (excess,)).rowcount
+        except sqlite3.OperationalError:
+            pass # Another process holds the write lock; the next trim catches up
+        with self._lock:
+            self.evictions += deleted
+        return deleted
+
+    def clear(self):
+        self.connection.execute("DELETE FROM weather_cache")
+        with self._lock:
+            self.evictions = 0
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM weather_cache").fetchone()[0]
+
+    def close(self):
+        """Close the calling thread's connection; it is reopened on next use."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and self._local.pid == os.getpid():
+            connection.close()
+        self._local.__dict__.clear()
+
+
+class GridCache:
+    """TTL cache keyed on lat/lon quantized to a fixed grid.
+
+    Coordinates are snapped to cells of ``grid`` degrees, so every request that
+    lands in the same cell within ``ttl`` seconds shares one upstream result.
+    Entries live in a :class:`CacheBackend`: by default a per-process
+    :class:`MemoryBackend` holding ``max_entries``, or a :class:`SQLiteBackend`
+    that worker processes share. Concurrent misses for one cell in this
+    process are coalesced so only a single fetch runs, whether they come from
+    threads, coroutines or :meth:`refresh`.
+
+    For another ``stale_ttl`` seconds after expiry an entry may still be served
+    (stale-while-revalidate), but only if ``on_stale(key)`` returns true to
+    confirm that a refresh has been scheduled. The callback may run in several
+    threads at once and must not call back into the cache.
+
+    ``on_store(key, value)``, if set, is called after each value is stored,
+    and ``on_lookup(key, outcome)`` after each lookup with one of ``"hit"``,
+    ``"stale"``, ``"nearby"``, ``"coalesced"`` (joined a running fetch) or
+    ``"miss"`` (started one).
+
+    With a :class:`~spatial_index.SpatialIndex` as ``nearby``, a miss is
+    answered from the closest stored observation within the index's radius,
+    if there is one and it is younger than ``ttl``, instead of fetching. It
+    only sees values stored by this process.
+
+    Ages are measured with ``clock``, wall time by default so that entries
+    written by other processes compare correctly.
+    """
+
+    def __init__(self, grid=0.01, ttl=60.0, max_entries=10000, stale_ttl=0.0, clock=time.time, backend=None,
+                 nearby=None):
+        self.grid = grid
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.on_stale = None
+        self.on_store = None
+        self.on_lookup = None
+        self.backend = backend if backend is not None else MemoryBackend(max_entries)
+        self.nearby = nearby
+        self._clock = clock
+        self._in_flight = {}
+        self._in_flight_async = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.stale_hits = 0
+        self.refreshes = 0
+        self.nearby_hits = 0
+
+    def cell(self, lat, lon):
+        """Return the integer grid cell containing (lat, lon)."""
+        return (round(lat / self.grid), round(lon / self.grid))
+
+    def cell_center(self, key):
+        """Return the coordinates upstream is queried with for a cell."""
+        return (round(key[0] * self.grid, 6), round(key[1] * self.grid, 6))
+
+    def _servable(self, key):
+        # (value, is_stale) if the entry is fresh, or stale with a refresh scheduled; else (None, False).
+        entry = self.backend.get(key)
+        if entry is None:
+            return None, False
+        value, stored_at = entry
+        age = self._clock() - stored_at
+        if age < self.ttl:
+            return value, False
+        if age < self.ttl + self.stale_ttl and self.on_stale is not None and self.on_stale(key):
+            return value, True
+        return None, False
+
+    def _borrow(self, lat, lon):
+        # A copy of a fresh observation from a cell near (lat, lon), or None.
+        found = self.nearby.nearest(lat, lon, stored_after=self._clock() - self.ttl)
+        return None if found is None else dict(found[1])
+
+    def _lookup(self, key, point, in_flight, new_call, joinable=None, servable=None):
+        """Return (cached copy, None, False) on a hit, else (None, call, is_leader).
+
+        A miss also joins a fetch running in ``joinable``, if given, instead of
+        starting its own.
+        """
+        value, call, leader, outcome = self._find(key, point, in_flight, new_call, joinable, servable)
+        if self.on_lookup is not None:
+            self.on_lookup(key, outcome)
+        return value, call, leader
+
+    def _find(self, key, point, in_flight, new_call, joinable, servable=None):
+        # The backend is read outside the lock, so hits never wait on each other.
+        # A caller that has read it already passes ``servable`` and skips the
+        # check below; at worst a fetch finishing in between runs once more.
+        value, stale = servable if servable is not None else self._servable(key)
+        if value is None and self.nearby is not None:
+            value = self._borrow(*point)
+            if value is not None:
+                with self._lock:
+                    self.nearby_hits += 1
+                return value, None, False, "nearby"
+        with self._lock:
+            call = in_flight.get(key) or (joinable.get(key) if joinable is not None else None)
+            if value is None and call is None and servable is None:
+                # A fetch may have finished since the read above; check again
+                # before starting another one.
+                value, stale = self._servable(key)
+            if value is not None:
+                if stale:
+                    self.stale_hits += 1
+                else:
+                    self.hits += 1
+                return value, None, False, "stale" if stale else "hit"
+            self.misses += 1
+            if call is not None:
+                self.coalesced += 1
+                return None, call, False, "coalesced"
+            call = in_flight[key] = new_call()
+            return None, call, True, "miss"
+
+    def _finish(self, key, in_flight, value, cacheable):
+        # Store before releasing the key, so later lookups either join the
+        # fetch or find its result.
+        try:
+            if value is not None and cacheable(value):
+                stored_at = self._clock()
+                self.backend.set(key, value, stored_at)
+                if self.nearby is not None:
+                    self.nearby.add(key, *self.cell_center(key), dict(value), stored_at)
+                if self.on_store is not None:
+                    self.on_store(key, value)
+        finally:
+            with self._lock:
+                del in_flight[key]
+
+    def get_or_fetch(self, lat, lon, fetch, cacheable=lambda value: True):
+        """Return the cached value for (lat, lon), calling ``fetch`` on a miss.
+
+        ``fetch`` receives the cell-center coordinates. Its result is stored only
+        when ``cacheable(result)`` is true, so errors are never served from cache.
+        """
+        key = self.cell(lat, lon)
+        cached, call, leader = self._lookup(key, (lat, lon), self._in_flight, _InFlight)
+        if cached is not None:
+            return cached
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return dict(call.value)
+        return dict(self._run(key, call, fetch, cacheable))
+
+    def _run(self, key, call, fetch, cacheable):
+        try:
+            call.value = fetch(*self.cell_center(key))
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            self._finish(key, self._in_flight, call.value, cacheable)
+            call.set()
+        return call.value
+
+    def refresh(self, key, fetch, cacheable=lambda value: True):
+        """Re-fetch ``key`` in the calling thread, unless a fetch for it is already running.
+
+        Requests arriving meanwhile, on threads or the event loop, wait on this
+        fetch as on any other miss. Returns False if the refresh was skipped.
+        """
+        with self._lock:
+            if key in self._in_flight or key in self._in_flight_async:
+                return False
+            call = self._in_flight[key] = _InFlight()
+            self.refreshes += 1
+        self._run(key, call, fetch, cacheable)
+        return True
+
+    def peek(self, lat, lon):
+        """Return a copy of the entry for (lat, lon) regardless of its age, or None."""
+        entry = self.backend.get(self.cell(lat, lon))
+        return None if entry is None else entry[0]
+
+    def age(self, key):
+        """Seconds since ``key`` was stored, or None if it is not cached."""
+        entry = self.backend.get(key)
+        return None if entry is None else self._clock() - entry[1]
+
+    async def get_or_fetch_async(self, lat, lon, fetch, cacheable=lambda value: True):
+        """Coroutine version of :meth:`get_or_fetch`; ``fetch`` is awaited.
+
+        Concurrent misses on the event loop share one pending ``fetch`` the
+        same way threads do in the blocking version. A miss while a blocking
+        fetch for the cell is running (a :meth:`refresh`, say) waits for that
+        one instead of starting another.
+
+        The shared fetch runs as a task of its own, so cancelling the caller
+        that started it leaves it running for the others.
+        """
+        key = self.cell(lat, lon)
+        loop = asyncio.get_running_loop()
+        servable = await self.off_loop(self._servable, key) if self.backend.blocking else None
+        cached, task, leader = self._lookup(
+            key, (lat, lon), self._in_flight_async,
+            lambda: loop.create_task(self._fetch_async(key, fetch, cacheable)),
+            joinable=self._in_flight, servable=servable,
+        )
+        if cached is not None:
+            return cached
+
+        if isinstance(task, _InFlight):
+            return dict(await task.wait_async())
+        return dict(await asyncio.shield(task))
+
+    async def _fetch_async(self, key, fetch, cacheable):
+        value = None
+        try:
+            value = await fetch(*self.cell_center(key))
+            return value
+        finally:
+            await self.off_loop(self._finish, key, self._in_flight_async, value, cacheable)
+
+    async def off_loop(self, function, *args):
+        """Call ``function(*args)``, in a worker thread if the backend is ``blocking``.
+
+        For coroutines that need to read the cache, such as :meth:`age` or
+        :meth:`peek`, without stalling the event loop on disk I/O.
+        """
+        if not self.backend.blocking:
+            return function(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    def clear(self):
+        self.backend.clear()
+        if self.nearby is not None:
+            self.nearby.clear()
+        with self._lock:
+            self.hits = self.misses = self.coalesced = 0
+            self.stale_hits = self.refreshes = self.nearby_hits = 0
+
+    def stats(self):
+        return {
+            "entries": len(self.backend),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.backend.evictions,
+            "coalesced": self.coalesced,
+            "stale_hits": self.stale_hits,
+            "refreshes": self.refreshes,
+            "nearby_hits": self.nearby_hits,
+        }